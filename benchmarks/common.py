@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the benchmarks
+"""
+
+import json
+import platform
+import subprocess
+from os.path import abspath, dirname
+
+
+def git_revision():
+    """
+    Commit the benchmarked tree is at, `None` outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """
+    Where a result has been measured
+    """
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+    }
+
+
+def write_result(result, output=None):
+    """
+    Print `result` as JSON or write it to the file `output`
+    """
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
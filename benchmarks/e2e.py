@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end benchmark of a collector/publisher pair on loopback.
+
+The daemon runs in a separate process, wired up like
+`bin/notifyme-collector.py` does it, so its CPU time and memory can be
+measured on their own. N pushers and M subscribers run as threads in this
+process; every pusher stamps its notifications, so the delay until a
+subscriber receives them can be measured. The result is printed as JSON::
+
+    python3 benchmarks/e2e.py --pushers 4 --subscribers 8 -o run.json
+"""
+
+import sys
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), '..')))
+
+import importlib.util
+import logging
+import resource
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Process, Pipe
+from threading import Thread, Lock, Event
+from time import perf_counter, sleep
+
+from OpenSSL import SSL
+
+from notifyme.notification import Notification
+from notifyme.pushclient import SSLPushClient
+from notifyme.subscriber import SimpleSubscriber
+
+from common import environment, write_result
+
+BIN = abspath(join(dirname(__file__), '..', 'bin'))
+
+
+def load_script(name):
+    """
+    Import one of the scripts in `bin/` as a module
+    """
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'), join(BIN, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_tls_method(method):
+    """
+    The components are built with `SSL.TLSv1_METHOD`, which current OpenSSL
+    builds refuse to negotiate. With `method` "tls" they negotiate the best
+    version both sides support instead.
+    """
+    if method == 'tls':
+        SSL.TLSv1_METHOD = SSL.TLS_METHOD
+
+
+def percentile(values, p):
+    """
+    `p`-th percentile of sorted `values`, nearest rank
+    """
+    rank = int(round(p / 100 * len(values))) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+def latency_summary(latencies):
+    """
+    Percentiles of latencies in seconds, as milliseconds
+    """
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    summary = {'min': latencies[0], 'max': latencies[-1],
+               'mean': sum(latencies) / len(latencies)}
+    for p in (50, 90, 99, 99.9):
+        summary['p%s' % str(p).replace('.', '')] = percentile(latencies, p)
+    return {key: value * 1000 for key, value in summary.items()}
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve(args, certs, client_hash, conn):
+    """
+    Daemon process: run the dispatchers until told to stop and report
+    resource usage on request
+    """
+    use_tls_method(args.tls_method)
+    collector = load_script('notifyme-collector')
+    # the daemon script configures DEBUG logging when it is imported
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.mode == 'asyncio':
+        from notifyme.publisher import AsyncPublisherDispatcher \
+            as PublisherDispatcher
+        from notifyme.collector import AsyncCollectorDispatcher \
+            as CollectorDispatcher
+    else:
+        from notifyme.publisher import PublisherDispatcher
+        from notifyme.collector import CollectorDispatcher
+
+    pub = PublisherDispatcher(
+        address='127.0.0.1', port=args.port, keyfile=certs['server'],
+        certfile=certs['server'],
+        permissions_table=[(client_hash, ['/bench'])],
+        queue_size=args.queue_size, backlog_size=args.backlog_size)
+    manager = collector.NotificationManager(publisher_dispatcher=pub)
+    col = CollectorDispatcher(
+        address='127.0.0.1', port=args.port + 1, keyfile=certs['server'],
+        certfile=certs['server'],
+        permissions_table=[(client_hash, ['/bench'])],
+        callback=manager, batch_callback=manager.batch)
+    pub.daemon = True
+    col.daemon = True
+    pub.start()
+    col.start()
+    sleep(0.5)
+    conn.send('ready')
+    while True:
+        command = conn.recv()
+        conn.send({
+            'cpu_seconds': cpu_seconds(),
+            'max_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'publisher_connections': len(pub.active_connections),
+        })
+        if command == 'stop':
+            return
+
+
+class Receiver:
+    """
+    Notification callback of all subscribers, collects latencies
+    """
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.latencies = []
+        self.lock = Lock()
+        self.done = Event()
+
+    def __call__(self, notification):
+        latency = perf_counter() - notification['data']['sent']
+        with self.lock:
+            self.latencies.append(latency)
+            self.received += 1
+            if self.received >= self.expected:
+                self.done.set()
+
+
+def push(args, certs, server_hash, number, connected):
+    client = SSLPushClient('127.0.0.1', args.port + 1, certs['client'],
+                           certs['client'], serverhash=server_hash)
+    client.connect()
+    connected.wait()
+    target = '/bench/%d' % number
+    padding = 'x' * args.payload_size
+    interval = 1 / args.rate if args.rate else 0
+    started = perf_counter()
+
+    def notifications():
+        for i in range(args.notifications):
+            if interval:
+                delay = started + i * interval - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            yield Notification(target, 50, 'benchmark %d' % i,
+                               data={'sent': perf_counter(),
+                                     'padding': padding})
+
+    if args.batch_size > 1:
+        client.send_notifications(notifications(),
+                                  max_batch_size=args.batch_size)
+    else:
+        for notification in notifications():
+            client.send_notification(notification)
+    return client
+
+
+def run(args):
+    use_tls_method(args.tls_method)
+    gencert = load_script('notifyme-gencert')
+    tmp = tempfile.TemporaryDirectory()
+    certs = {'server': join(tmp.name, 'server.pem'),
+             'client': join(tmp.name, 'client.pem')}
+    server_hash = gencert.gen_cert(certs['server'])
+    client_hash = gencert.gen_cert(certs['client'])
+
+    conn, child_conn = Pipe()
+    server = Process(target=serve, args=(args, certs, client_hash,
+                                         child_conn))
+    server.start()
+    if not conn.poll(30):
+        server.terminate()
+        raise RuntimeError("daemon didn't start")
+    conn.recv()
+
+    total = args.pushers * args.notifications
+    receiver = Receiver(total * args.subscribers)
+    subscribers = []
+    for _ in range(args.subscribers):
+        subscriber = SimpleSubscriber(
+            '127.0.0.1', args.port, certs['client'], certs['client'],
+            ['/bench'], receiver, serverhash=server_hash, reconnect=False)
+        subscriber.daemon = True
+        subscriber.start()
+        subscribers.append(subscriber)
+    deadline = perf_counter() + args.timeout
+    while sum(s.connected for s in subscribers) < args.subscribers:
+        if perf_counter() > deadline:
+            conn.send('stop')
+            server.join(5)
+            raise RuntimeError("subscribers couldn't connect")
+        sleep(0.05)
+    # give the last subscriptions time to be confirmed
+    sleep(0.2 + 0.002 * args.subscribers)
+
+    connected = Event()
+    clients = []
+    pushers = [Thread(target=lambda n: clients.append(
+        push(args, certs, server_hash, n, connected)), args=(n,))
+        for n in range(args.pushers)]
+    for pusher in pushers:
+        pusher.start()
+    sleep(0.2 + 0.01 * args.pushers)
+
+    conn.send('mark')
+    before = conn.recv()
+    started = perf_counter()
+    connected.set()
+    for pusher in pushers:
+        pusher.join()
+    pushed = perf_counter() - started
+    receiver.done.wait(args.timeout)
+    elapsed = perf_counter() - started
+    conn.send('mark')
+    after = conn.recv()
+
+    for subscriber in subscribers:
+        subscriber.stop()
+    for client in clients:
+        client.close()
+    conn.send('stop')
+    conn.recv()
+    server.join(5)
+    if server.is_alive():
+        server.terminate()
+    tmp.cleanup()
+
+    server_cpu = after['cpu_seconds'] - before['cpu_seconds']
+    result = environment()
+    result.update({
+        'parameters': vars(args),
+        'pushed': total,
+        'expected_deliveries': receiver.expected,
+        'delivered': receiver.received,
+        'lost': receiver.expected - receiver.received,
+        'push_seconds': pushed,
+        'elapsed_seconds': elapsed,
+        'push_rate': total / pushed if pushed else None,
+        'delivery_rate': receiver.received / elapsed if elapsed else None,
+        'latency_ms': latency_summary(receiver.latencies),
+        'server': {
+            'cpu_seconds': server_cpu,
+            'cpu_percent': server_cpu / elapsed * 100 if elapsed else None,
+            'max_rss_kb': after['max_rss_kb'],
+        },
+    })
+    return result
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description="End-to-end benchmark of notifymed")
+    p.add_argument('-n', '--pushers', type=int, default=4,
+                   help="number of pushing clients")
+    p.add_argument('-m', '--subscribers', type=int, default=4,
+                   help="number of subscribers")
+    p.add_argument('-c', '--notifications', type=int, default=1000,
+                   help="notifications per pusher")
+    p.add_argument('-r', '--rate', type=float, default=0,
+                   help="notifications per second and pusher, 0 for as "
+                   "fast as possible")
+    p.add_argument('-b', '--batch-size', type=int, default=1,
+                   help="send batches of up to this many notifications")
+    p.add_argument('-s', '--payload-size', type=int, default=100,
+                   help="bytes of padding per notification")
+    p.add_argument('--mode', choices=['threaded', 'asyncio'],
+                   default='threaded', help="dispatchers to benchmark")
+    p.add_argument('--queue-size', type=int, default=1000,
+                   help="outbound queue size per subscriber")
+    p.add_argument('--backlog-size', type=int, default=100,
+                   help="backlog size of the publisher")
+    p.add_argument('--tls-method', choices=['tls', 'tlsv1'], default='tls',
+                   help="'tlsv1' keeps the TLS 1.0 method the components "
+                   "are built with, which many OpenSSL builds refuse")
+    p.add_argument('--port', type=int, default=17000,
+                   help="publisher port, the collector uses the next one")
+    p.add_argument('--timeout', type=float, default=60,
+                   help="seconds to wait for outstanding deliveries")
+    p.add_argument('-o', '--output', help="write the JSON result to this "
+                   "file instead of stdout")
+    args = p.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s',
+                        level=logging.WARNING)
+    write_result(run(args), args.output)
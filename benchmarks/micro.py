@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks of the code that runs for every notification: the message
+codec and resource matching.
+
+Workloads are generated from a fixed seed, so two runs measure the same
+thing. Every benchmark reports operations per second, the memory a single
+operation allocates at its peak and the memory blocks that are still
+allocated afterwards (the result included), both measured with
+`tracemalloc`::
+
+    python3 benchmarks/micro.py -o before.json
+    # change something
+    python3 benchmarks/micro.py --baseline before.json --threshold 5
+
+With `--baseline`, the exit status is 1 if any benchmark got slower by more
+than `--threshold` percent.
+"""
+
+import sys
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), '..')))
+
+import gc
+import json
+import random
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+from notifyme.messages import NotificationMessage, WrappedProtocolMessage, \
+    EncodedMessage, FRAME_HEADER
+from notifyme.notification import Notification
+from notifyme.resources import convert_to_path, is_subresource, \
+    ResourceMatcher, SubscriptionIndex
+
+from common import environment, write_result
+
+#: notification payload sizes in bytes
+PAYLOAD_SIZES = (100, 1024, 8192, 65536)
+#: resource depths
+DEPTHS = (1, 4, 8, 16)
+#: numbers of subscriptions
+SUBSCRIPTIONS = (1000, 10000, 100000)
+
+
+class Workload:
+    """
+    Deterministic test data
+    """
+    def __init__(self, seed=0, fanout=8, depth=8):
+        self.random = random.Random(seed)
+        self.fanout = fanout
+        self.depth = depth
+
+    def resource(self, depth):
+        """
+        A resource `depth` levels deep in a tree with `fanout` children per
+        node
+        """
+        return '/' + '/'.join('n%d' % self.random.randrange(self.fanout)
+                              for _ in range(depth))
+
+    def resources(self, count):
+        """
+        `count` resources of varying depth
+        """
+        return [self.resource(self.random.randint(1, self.depth))
+                for _ in range(count)]
+
+    def notification(self, size, depth=4):
+        """
+        A notification whose serialized data is about `size` bytes
+        """
+        words = []
+        length = 0
+        while length < size:
+            word = ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz')
+                           for _ in range(self.random.randint(2, 10)))
+            words.append(word)
+            length += len(word) + 1
+        return Notification(resource=self.resource(depth),
+                            urgency=self.random.randint(0, 100),
+                            subject='benchmark notification',
+                            data={'text': ' '.join(words)[:size],
+                                  'id': self.random.randrange(2 ** 32)})
+
+
+def codec_benchmarks(workload):
+    for size in PAYLOAD_SIZES:
+        notification = workload.notification(size)
+        message = NotificationMessage(notification)
+        frame = EncodedMessage(message).frame
+        payload = frame[FRAME_HEADER.size:]
+
+        yield 'NotificationMessage(%d)' % size, \
+            lambda n=notification: NotificationMessage(n)
+        yield 'ProtocolMessage.text(%d)' % size, \
+            lambda m=message: m.text
+        yield 'EncodedMessage(%d)' % size, \
+            lambda m=message: EncodedMessage(m)
+        yield 'WrappedProtocolMessage.parse(%d)' % size, \
+            lambda p=payload: WrappedProtocolMessage.parse(p)
+        yield 'NotificationMessage.notification(%d)' % size, \
+            lambda m=message: m.notification
+
+
+def resource_benchmarks(workload, subscriptions):
+    for depth in DEPTHS:
+        child = workload.resource(depth)
+        parent = '/'.join(child.split('/')[:depth // 2 + 1]) or '/'
+        yield 'convert_to_path(%d)' % depth, \
+            lambda r=child: convert_to_path(r)
+        yield 'is_subresource(%d)' % depth, \
+            lambda c=child, p=parent: is_subresource(c, p)
+
+    lookups = workload.resources(1000)
+    for count in subscriptions:
+        resources = workload.resources(count)
+        matcher = ResourceMatcher(resources)
+        index = SubscriptionIndex()
+        # a tenth of the resources per subscriber, like many subscribers
+        # sharing a few popular subtrees
+        for i in range(0, count, 10):
+            index.subscribe(i, resources[i:i + 10])
+        state = {'i': 0}
+
+        def next_lookup(state=state):
+            state['i'] = (state['i'] + 1) % len(lookups)
+            return lookups[state['i']]
+
+        yield 'ResourceMatcher.matches(%d)' % count, \
+            lambda m=matcher, n=next_lookup: m.matches(n())
+        yield 'SubscriptionIndex.lookup(%d)' % count, \
+            lambda x=index, n=next_lookup: x.lookup(n())
+
+
+def measure(function, min_time, repeat):
+    """
+    Best operations per second of `repeat` runs of at least `min_time`
+    seconds each
+    """
+    number = 1
+    while True:
+        started = perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = perf_counter()
+            for _ in range(number):
+                function()
+            elapsed = perf_counter() - started
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return number / best
+
+
+def allocations(function, number=100):
+    """
+    Peak bytes allocated by one call, and the memory blocks per call that
+    are still allocated afterwards, the result included
+    """
+    function()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            function()
+            _, high = tracemalloc.get_traced_memory()
+            peak = max(peak, high - before)
+        before = tracemalloc.take_snapshot()
+        results = [function() for _ in range(number)]
+        after = tracemalloc.take_snapshot()
+        del results
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in
+                 after.compare_to(before, 'filename'))
+    return peak, blocks / number
+
+
+def run(args):
+    workload = Workload(seed=args.seed)
+    subscriptions = [s for s in SUBSCRIPTIONS if s <= args.max_subscriptions]
+    benchmarks = list(codec_benchmarks(workload)) + \
+        list(resource_benchmarks(workload, subscriptions))
+
+    results = {}
+    for name, function in benchmarks:
+        if args.filter and args.filter not in name:
+            continue
+        ops = measure(function, args.min_time, args.repeat)
+        peak, blocks = allocations(function)
+        results[name] = {
+            'ops_per_sec': ops,
+            'usec_per_op': 1e6 / ops,
+            'peak_bytes_per_op': peak,
+            'retained_blocks_per_op': blocks,
+        }
+        print("%-45s %12.0f ops/s %10d B peak" % (name, ops, peak),
+              file=sys.stderr)
+    result = environment()
+    result['parameters'] = vars(args)
+    result['benchmarks'] = results
+    return result
+
+
+def compare(result, baseline, threshold):
+    """
+    Print the change of every benchmark against `baseline`
+
+    Returns:
+        list of names of benchmarks that got slower than `threshold`
+        percent
+    """
+    regressions = []
+    for name, current in sorted(result['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['ops_per_sec']
+        change = (current['ops_per_sec'] - before) / before * 100
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-45s %+7.1f%%%s" % (name, change, flag), file=sys.stderr)
+    return regressions
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description="Microbenchmarks of the notifyme hot "
+                       "paths")
+    p.add_argument('-k', '--filter', help="only run benchmarks whose name "
+                   "contains this")
+    p.add_argument('--min-time', type=float, default=0.2,
+                   help="seconds per measurement")
+    p.add_argument('--repeat', type=int, default=5,
+                   help="measurements per benchmark, the best one counts")
+    p.add_argument('--max-subscriptions', type=int, default=100000,
+                   help="largest number of subscriptions to generate")
+    p.add_argument('--seed', type=int, default=0,
+                   help="seed of the generated workload")
+    p.add_argument('--baseline', help="JSON result of an earlier run to "
+                   "compare with")
+    p.add_argument('--threshold', type=float, default=10,
+                   help="percent a benchmark may get slower than the "
+                   "baseline")
+    p.add_argument('-o', '--output', help="write the JSON result to this "
+                   "file instead of stdout")
+    args = p.parse_args()
+
+    result = run(args)
+    if args.output or not args.baseline:
+        write_result(result, args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        if regressions:
+            print("%d benchmarks got slower than %.1f%%: %s"
+                  % (len(regressions), args.threshold,
+                     ', '.join(regressions)), file=sys.stderr)
+            sys.exit(1)
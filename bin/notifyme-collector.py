@@ -26,6 +26,7 @@ from os.path import abspath, dirname, join, exists
 sys.path.append(abspath(join(dirname(__file__), '..')))
 
 import argparse
+import asyncio
 
 try:
     import yaml
@@ -41,9 +42,14 @@ except ImportError as e:
 
 from time import sleep
 
-from notifyme.publisher import PublisherDispatcher
-from notifyme.collector import CollectorDispatcher
-from notifyme.resources import is_subresource
+from notifyme.publisher import PublisherDispatcher, AsyncPublisherDispatcher
+from notifyme.collector import CollectorDispatcher, AsyncCollectorDispatcher
+from notifyme.permissions import PermissionStore, FingerprintCache
+from notifyme.log import NotificationLog
+from notifyme.history import NotificationHistory
+from notifyme.metrics import ServerMetrics, MetricsServer
+from notifyme.tracing import Tracer
+from notifyme.handshake import HANDSHAKE_TIMEOUT
 
 
 def load_config_from_file(file):
@@ -51,14 +57,31 @@ def load_config_from_file(file):
         return yaml.safe_load(f)
 
 class NotificationManager:
-    def __init__(self, publisher_dispatcher):
+    def __init__(self, publisher_dispatcher, log=None, history=None):
         self.publisher_dispatcher = publisher_dispatcher
+        self.log = log
+        self.history = history
 
     def __call__(self, notification):
-        for sub in self.publisher_dispatcher.active_connections:
-            for res in sub.subscribed_resources:
-                if is_subresource(notification.resource, res):
-                    sub.send_notification(notification)
+        self.publisher_dispatcher.send_notification(notification)
+        if self.history is not None:
+            self.history.add(notification)
+
+    def batch(self, notifications):
+        self.publisher_dispatcher.send_notifications(notifications)
+        if self.history is not None:
+            for notification in notifications:
+                self.history.add(notification)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+        if self.history is not None:
+            self.history.close()
+
+
+async def serve(*dispatchers):
+    await asyncio.gather(*[d.serve() for d in dispatchers])
 
 
 if __name__ == '__main__':
@@ -79,29 +102,111 @@ if __name__ == '__main__':
         print("[!] config file not found!")
         sys.exit(1)
 
-    # build permission tables
-    publisher_permissions = [(o['hash'], o['resources']) for o in
-                             config['publisher']['permissions']]
-    collector_permissions = [(o['hash'], o['resources']) for o in
-                             config['collector']['permissions']]
+    # build permission tables, both share the fingerprint cache
+    fingerprints = FingerprintCache()
+    publisher_permissions = PermissionStore(
+        [(o['hash'], o['resources']) for o in
+         config['publisher']['permissions']],
+        fingerprints=fingerprints)
+    collector_permissions = PermissionStore(
+        [(o['hash'], o['resources']) for o in
+         config['collector']['permissions']],
+        fingerprints=fingerprints)
+
+    # "threaded" spawns a thread per connection, "asyncio" serves all
+    # connections on a single event loop.
+    mode = config.get('mode', 'threaded')
+    if mode == 'threaded':
+        publisher_dispatcher_class = PublisherDispatcher
+        collector_dispatcher_class = CollectorDispatcher
+    elif mode == 'asyncio':
+        publisher_dispatcher_class = AsyncPublisherDispatcher
+        collector_dispatcher_class = AsyncCollectorDispatcher
+    else:
+        print("[!] unknown mode: %s" % mode)
+        sys.exit(1)
+
+    # notifications are persisted in the log if one is configured,
+    # otherwise only the in-memory backlog of the publisher keeps them
+    log = None
+    if 'log' in config:
+        log = NotificationLog(
+            path=config['log']['path'],
+            segment_size=config['log'].get('segment_size', 64 * 1024 * 1024),
+            max_bytes=config['log'].get('max_bytes'),
+            max_age=config['log'].get('max_age'),
+            fsync_every=config['log'].get('fsync_every', 100),
+            fsync_interval=config['log'].get('fsync_interval', 1.0))
+
+    # optional history subscribers can query
+    history = None
+    if 'history' in config:
+        history = NotificationHistory(
+            path=config['history']['path'],
+            batch_size=config['history'].get('batch_size', 500),
+            flush_interval=config['history'].get('flush_interval', 0.5))
+
+    # optional metrics, served over plain HTTP on loopback
+    metrics = None
+    tracer = None
+    if 'metrics' in config:
+        metrics = ServerMetrics()
+        # notifications the push clients stamped are traced as soon as a
+        # sample rate is set, 0 traces only those
+        if 'trace_sample_rate' in config['metrics']:
+            tracer = Tracer(metrics.registry,
+                            sample_rate=config['metrics']['trace_sample_rate'])
+        metrics_server = MetricsServer(
+            metrics.registry,
+            address=config['metrics'].get('address', '127.0.0.1'),
+            port=config['metrics'].get('port', 9100))
+        metrics_server.start()
 
     # start publisher dispatcher
-    pub = PublisherDispatcher(address='localhost',
-                              port=config['publisher']['port'],
-                              keyfile=config['publisher']['keyfile'],
-                              certfile=config['publisher']['certfile'],
-                              permissions_table=publisher_permissions)
+    pub = publisher_dispatcher_class(
+        address='localhost',
+        port=config['publisher']['port'],
+        keyfile=config['publisher']['keyfile'],
+        certfile=config['publisher']['certfile'],
+        permissions_table=publisher_permissions,
+        queue_size=config['publisher'].get('queue_size', 1000),
+        overflow_policy=config['publisher'].get('overflow_policy',
+                                                'drop-oldest'),
+        handshake_workers=config['publisher'].get('handshake_workers'),
+        handshake_timeout=config['publisher'].get('handshake_timeout',
+                                                  HANDSHAKE_TIMEOUT),
+        backlog_size=config['publisher'].get('backlog_size', 0),
+        backlog_max_age=config['publisher'].get('backlog_max_age'),
+        backlog=log,
+        history=history,
+        protocol_hooks=[metrics.transition] if metrics else None,
+        metrics=metrics,
+        tracer=tracer)
 
     # start collector dispatcher
-    col = CollectorDispatcher(address='localhost',
-                              port=config['collector']['port'],
-                              keyfile=config['collector']['keyfile'],
-                              certfile=config['collector']['certfile'],
-                              permissions_table=collector_permissions,
-                              callback=NotificationManager(
-                                  publisher_dispatcher=pub)
-                              )
-
+    manager = NotificationManager(publisher_dispatcher=pub, log=log,
+                                  history=history)
+    col = collector_dispatcher_class(
+        address='localhost',
+        port=config['collector']['port'],
+        keyfile=config['collector']['keyfile'],
+        certfile=config['collector']['certfile'],
+        permissions_table=collector_permissions,
+        callback=manager,
+        batch_callback=manager.batch,
+        handshake_workers=config['collector'].get('handshake_workers'),
+        handshake_timeout=config['collector'].get('handshake_timeout',
+                                                  HANDSHAKE_TIMEOUT),
+        metrics=metrics,
+        tracer=tracer)
+
+    if mode == 'asyncio':
+        try:
+            asyncio.run(serve(pub, col))
+        except KeyboardInterrupt:
+            logging.debug("Caught SIGINT, Quitting.")
+        manager.close()
+        sys.exit(0)
 
     pub.daemon = True
     pub.start()
@@ -116,3 +221,4 @@ if __name__ == '__main__':
         logging.debug("Caught SIGINT, Quitting.")
         pub.running = False
         col.running = False
+        manager.close()
@@ -0,0 +1,699 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator for a running notifymed.
+
+Simulates a population of subscribers and pushers against the publisher
+and collector of a daemon. Every worker process runs its share of the
+connections on one asyncio event loop, so a few processes handle thousands
+of connections. The client certificate has to be allowed to subscribe and
+push to `--root` on the daemon.
+
+Notifications go to the leaves of a resource tree shaped by `--shape`,
+subscribers subscribe to nodes at `--subscription-depth`. Both pick their
+resources by Zipf popularity. The pushed rate follows a schedule of phases,
+e.g. a burst with `--schedule 100:30,2000:5,100:30` or a load that doubles
+every phase with `--ramp 100:8:10`.
+
+For every phase, the load generator reports the offered and delivered rate,
+the share of notifications that were lost and the push to delivery latency.
+If the daemon serves metrics (see `--metrics-url`), it also reports the
+daemon's queue depths and drops. The first phase that loses notifications,
+exceeds the latency threshold or makes the daemon drop notifications is
+reported as the saturation point::
+
+    python3 bin/notifyme-loadgen.py -k client.pem -c client.pem \\
+        -s 10000 -P 20 -j 4 --ramp 500:6:10 \\
+        --metrics-url http://127.0.0.1:9100/metrics
+"""
+
+import sys
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), '..')))
+
+import asyncio
+import json
+import logging
+import random
+import resource
+from argparse import ArgumentParser
+from multiprocessing import Process, Pipe
+from time import time, sleep
+from urllib.request import urlopen
+
+from OpenSSL import SSL
+
+from notifyme.aio import TLSStream
+from notifyme.messages import FrameDecoder, FrameError
+from notifyme.metrics import HistogramValue
+from notifyme.notification import Notification
+from notifyme.pushclient import SimplePushClient
+from notifyme.resources import SubscriptionIndex
+from notifyme.session import ProtocolSession
+from notifyme.subscriber import SubscriberProtocol, VerificationHelper
+
+#: Upper bounds in seconds of the latency histogram, 0.1 ms to about 2 min
+LATENCY_BUCKETS = tuple(0.0001 * 1.25 ** i for i in range(64))
+
+#: Seconds between two rounds of a pusher
+TICK = 0.01
+
+#: Share of the offered rate the pushers have to reach, otherwise the load
+#: generator itself is the bottleneck
+GENERATOR_TOLERANCE = 0.9
+
+
+class ResourceTree:
+    """
+    Resources of a tree with `shape[i]` children per node on level `i`
+    """
+    def __init__(self, root, shape):
+        self.root = root.rstrip('/')
+        self.shape = shape
+
+    def level(self, depth):
+        """
+        All resources `depth` levels below the root
+        """
+        paths = ['']
+        for i, fanout in enumerate(self.shape[:depth]):
+            paths = ['%s/%s%d' % (path, chr(ord('a') + i % 26), n)
+                     for path in paths for n in range(fanout)]
+        return [self.root + path for path in paths]
+
+    @property
+    def leaves(self):
+        return self.level(len(self.shape))
+
+
+class Zipf:
+    """
+    Picks items with Zipf distributed popularity: the `k`-th most popular
+    item is picked with a probability proportional to `1 / k ** exponent`.
+    The popularity ranks are a permutation of the items given by `seed`, so
+    all workers agree on them.
+    """
+    def __init__(self, items, exponent, seed, rng):
+        self.items = list(items)
+        random.Random(seed).shuffle(self.items)
+        self.random = rng
+        self.cum_weights = []
+        total = 0
+        for rank in range(1, len(self.items) + 1):
+            total += 1 / rank ** exponent
+            self.cum_weights.append(total)
+
+    def pick(self, k=1):
+        return self.random.choices(self.items, cum_weights=self.cum_weights,
+                                   k=k)
+
+
+def urgency_distribution(spec, rng):
+    """
+    Parse an urgency distribution
+
+    Args:
+        spec(str): `constant:U`, `uniform:LOW:HIGH`, `normal:MEAN:STDDEV`
+            or `weights:U=W,U=W,...`
+        rng(:class:`random.Random`): source of randomness
+
+    Returns:
+        callable returning the urgency of the next notification
+    """
+    kind, _, args = spec.partition(':')
+    if kind == 'constant':
+        urgency = int(args)
+        return lambda: urgency
+    if kind == 'uniform':
+        low, high = (int(a) for a in args.split(':'))
+        return lambda: rng.randint(low, high)
+    if kind == 'normal':
+        mean, stddev = (float(a) for a in args.split(':'))
+        return lambda: min(100, max(0, int(rng.gauss(mean, stddev))))
+    if kind == 'weights':
+        pairs = [pair.split('=') for pair in args.split(',')]
+        urgencies = [int(u) for u, _ in pairs]
+        weights = [float(w) for _, w in pairs]
+        return lambda: rng.choices(urgencies, weights)[0]
+    raise ValueError("unknown urgency distribution: %s" % spec)
+
+
+def parse_schedule(args):
+    """
+    Phases of the load as a list of `(notifications per second, seconds)`
+    """
+    if args.ramp:
+        start, steps, seconds = args.ramp.split(':')
+        return [(float(start) * 2 ** i, float(seconds))
+                for i in range(int(steps))]
+    phases = []
+    for phase in args.schedule.split(','):
+        rate, seconds = phase.split(':')
+        phases.append((float(rate), float(seconds)))
+    return phases
+
+
+def plan(args):
+    """
+    Resources of every subscriber and pusher, and the number of
+    subscribers of every resource that is pushed to
+    """
+    rng = random.Random(args.seed)
+    tree = ResourceTree(args.root, args.shape)
+    depth = min(args.subscription_depth, len(args.shape))
+    nodes = Zipf(tree.level(depth), args.zipf, args.seed, rng)
+    subscriptions = [sorted(set(nodes.pick(args.subscriptions)))
+                     for _ in range(args.subscribers)]
+
+    index = SubscriptionIndex()
+    for i, resources in enumerate(subscriptions):
+        index.subscribe(i, resources)
+    leaves = tree.leaves
+    fanout = {leaf: len(index.lookup(leaf)) for leaf in leaves}
+    return subscriptions, leaves, fanout
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class StreamConnection:
+    """
+    Lets a :class:`notifyme.pushclient.SimplePushClient` write to a
+    :class:`notifyme.aio.TLSStream`
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def sendall(self, data):
+        self.stream.write(data)
+
+
+class PhaseStats:
+    """
+    What happened to the notifications pushed during one phase, as seen by
+    one worker
+    """
+    def __init__(self):
+        self.pushed = 0
+        self.expected = 0
+        self.delivered = 0
+        self.latency = HistogramValue(LATENCY_BUCKETS)
+
+    def to_dict(self):
+        return {'pushed': self.pushed, 'expected': self.expected,
+                'delivered': self.delivered,
+                'latency_counts': self.latency.counts,
+                'latency_sum': self.latency.sum}
+
+
+class Worker:
+    """
+    Runs a share of the subscribers and pushers on an event loop
+    """
+    def __init__(self, args, number, subscriptions, leaves, fanout, conn):
+        self.args = args
+        self.number = number
+        self.subscriptions = subscriptions
+        self.fanout = fanout
+        self.conn = conn
+        self.rng = random.Random('%s-%d' % (args.seed, number))
+        self.leaves = Zipf(leaves, args.zipf, args.seed, self.rng)
+        self.urgency = urgency_distribution(args.urgency, self.rng)
+        self.phases = parse_schedule(args)
+        self.stats = [PhaseStats() for _ in self.phases]
+        self.subscribed = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.handshakes = HistogramValue(LATENCY_BUCKETS)
+        self.padding = 'x' * args.payload_size
+        self.running = True
+
+        method = SSL.TLS_METHOD if args.tls_method == 'tls' \
+            else SSL.TLSv1_METHOD
+        self.ssl_context = SSL.Context(method)
+        self.ssl_context.use_privatekey_file(args.key)
+        self.ssl_context.use_certificate_file(args.certificate)
+        self.ssl_context.set_verify(SSL.VERIFY_NONE,
+                                    VerificationHelper(args.serverhash))
+
+    async def connect(self, port, slots):
+        """
+        Open a TLS connection, at most `--connect-concurrency` connections
+        are opened at the same time per worker
+        """
+        async with slots:
+            started = time()
+            reader, writer = await asyncio.open_connection(
+                self.args.hostname, port)
+            stream = TLSStream(self.ssl_context, reader, writer,
+                               server_side=False)
+            try:
+                await stream.do_handshake()
+            except BaseException:
+                stream.close()
+                raise
+            self.handshakes.observe(time() - started)
+            return stream
+
+    def delivered(self, notification):
+        data = notification['data']
+        if not isinstance(data, dict) or 'phase' not in data:
+            return
+        stats = self.stats[data['phase']]
+        stats.delivered += 1
+        stats.latency.observe(time() - data['sent'])
+
+    async def subscriber(self, resources, slots):
+        try:
+            stream = await self.connect(self.args.portnumber, slots)
+        except (SSL.Error, EOFError, OSError):
+            self.connect_failures += 1
+            return
+        received = []
+        protocol = SubscriberProtocol(received.append, resources)
+        session = ProtocolSession(protocol, answer_errors=False)
+        session.start()
+        subscribed = False
+        try:
+            while self.running:
+                await stream.read_into(session.decoder)
+                session.receive_data()
+                data = session.data_to_send()
+                if data:
+                    stream.write(data)
+                    await stream.drain()
+                if not subscribed and protocol.state == 'subscribed':
+                    subscribed = True
+                    self.subscribed += 1
+                for notification in received:
+                    self.delivered(notification)
+                received.clear()
+        except (EOFError, FrameError, SSL.Error, OSError):
+            if self.running:
+                self.disconnects += 1
+        except Exception as e:
+            # the publisher refused the subscription
+            logging.error("subscription failed: %s" % e)
+            self.connect_failures += 1
+        finally:
+            stream.close()
+
+    async def discard(self, stream):
+        """
+        Read and drop what the collector sends, i.e. error messages
+        """
+        decoder = FrameDecoder()
+        try:
+            while self.running:
+                await stream.read_into(decoder)
+                for _ in decoder.frames():
+                    pass
+        except (EOFError, FrameError, SSL.Error, OSError):
+            pass
+
+    def notification(self, phase):
+        return Notification(self.leaves.pick()[0], self.urgency(),
+                            'load', data={'sent': time(), 'phase': phase,
+                                          'padding': self.padding})
+
+    async def pusher(self, stream, share, start):
+        """
+        Push `share` of the notifications of every phase, starting at the
+        UNIX time `start`
+        """
+        client = SimplePushClient(StreamConnection(stream),
+                                  self.args.trace_sample_rate)
+        reader = asyncio.ensure_future(self.discard(stream))
+        try:
+            phase_start = start
+            for phase, (rate, seconds) in enumerate(self.phases):
+                stats = self.stats[phase]
+                phase_end = phase_start + seconds
+                sent = 0
+                await asyncio.sleep(max(0, phase_start - time()))
+                while self.running:
+                    now = time()
+                    if now >= phase_end:
+                        break
+                    due = int((now - phase_start) * rate * share) - sent
+                    if due > 0:
+                        batch = [self.notification(phase)
+                                 for _ in range(due)]
+                        if self.args.batch_size > 1:
+                            for i in range(0, due, self.args.batch_size):
+                                client.send_batch(
+                                    batch[i:i + self.args.batch_size])
+                        else:
+                            for notification in batch:
+                                client.send_notification(notification)
+                        await stream.drain()
+                        sent += due
+                        stats.pushed += due
+                        stats.expected += sum(self.fanout[n.resource]
+                                              for n in batch)
+                    await asyncio.sleep(TICK)
+                phase_start = phase_end
+        except (SSL.Error, OSError):
+            self.disconnects += 1
+        finally:
+            reader.cancel()
+            stream.close()
+
+    async def run(self):
+        raise_file_limit()
+        slots = asyncio.Semaphore(self.args.connect_concurrency)
+        subscribers = [asyncio.ensure_future(self.subscriber(r, slots))
+                       for r in self.subscriptions]
+        pushers = []
+        for _ in range(self.args.pushers_per_worker[self.number]):
+            try:
+                pushers.append(await self.connect(self.args.collector_port,
+                                                  slots))
+            except (SSL.Error, EOFError, OSError):
+                self.connect_failures += 1
+
+        # wait until every subscriber has been confirmed or failed
+        deadline = time() + self.args.connect_timeout
+        while self.subscribed + self.connect_failures + self.disconnects \
+                < len(subscribers) and time() < deadline:
+            await asyncio.sleep(0.1)
+        self.conn.send({'subscribed': self.subscribed,
+                        'pushers': len(pushers),
+                        'connect_failures': self.connect_failures,
+                        'handshake_counts': self.handshakes.counts})
+        loop = asyncio.get_running_loop()
+        start = await loop.run_in_executor(None, self.conn.recv)
+
+        total_pushers = sum(self.args.pushers_per_worker)
+        tasks = [asyncio.ensure_future(self.pusher(stream, 1 / total_pushers,
+                                                   start))
+                 for stream in pushers]
+        if tasks:
+            await asyncio.gather(*tasks)
+        duration = sum(seconds for _, seconds in self.phases)
+        await asyncio.sleep(max(0, start + duration - time()) +
+                            self.args.drain)
+        self.running = False
+        for task in subscribers:
+            task.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+        self.conn.send({'phases': [s.to_dict() for s in self.stats],
+                        'disconnects': self.disconnects})
+
+
+def run_worker(args, number, subscriptions, leaves, fanout, conn):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    worker = Worker(args, number, subscriptions, leaves, fanout, conn)
+    asyncio.run(worker.run())
+
+
+def scrape(url):
+    """
+    Samples of a Prometheus text exposition as a dict, `None` if it can't
+    be fetched
+    """
+    if not url:
+        return None
+    try:
+        with urlopen(url, timeout=5) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+def percentile(counts, p):
+    """
+    Upper bound of the latency bucket of the `p`-th percentile
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = p / 100 * total
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+
+def merge(results, phases):
+    merged = []
+    for i, (rate, seconds) in enumerate(phases):
+        counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        phase = {'rate': rate, 'seconds': seconds, 'pushed': 0,
+                 'expected': 0, 'delivered': 0}
+        latency_sum = 0
+        for result in results:
+            stats = result['phases'][i]
+            for key in ('pushed', 'expected', 'delivered'):
+                phase[key] += stats[key]
+            counts = [a + b for a, b in zip(counts, stats['latency_counts'])]
+            latency_sum += stats['latency_sum']
+        phase['push_rate'] = phase['pushed'] / seconds
+        # the pushers share the event loops with the subscribers, if those
+        # are busy the offered rate isn't reached
+        phase['generator_limited'] = \
+            phase['push_rate'] < rate * GENERATOR_TOLERANCE
+        phase['delivery_rate'] = phase['delivered'] / seconds
+        phase['loss'] = 1 - phase['delivered'] / phase['expected'] \
+            if phase['expected'] else 0
+        phase['latency_ms'] = {
+            'mean': latency_sum / phase['delivered'] * 1000
+            if phase['delivered'] else None}
+        for p in (50, 90, 99):
+            value = percentile(counts, p)
+            phase['latency_ms']['p%d' % p] = value * 1000 \
+                if value is not None else None
+        merged.append(phase)
+    return merged
+
+
+def server_stats(before, samples, after):
+    """
+    Queue depths and drops of the daemon during a phase
+    """
+    if before is None or after is None:
+        return None
+    depths = [s.get('notifyme_queue_depth_max', 0) for s in samples]
+    return {
+        'queue_depth_max': max(depths, default=0),
+        'dropped': after.get('notifyme_queue_dropped', 0) -
+        before.get('notifyme_queue_dropped', 0),
+        'publisher_connections': after.get(
+            'notifyme_connections{dispatcher="publisher"}'),
+    }
+
+
+def saturation(phases, args):
+    """
+    First phase the daemon couldn't keep up with, and why
+    """
+    for i, phase in enumerate(phases):
+        reasons = []
+        if phase['loss'] > args.loss_threshold:
+            reasons.append('lost %.1f%% of the deliveries'
+                           % (phase['loss'] * 100))
+        p99 = phase['latency_ms']['p99']
+        if p99 is not None and p99 > args.latency_threshold * 1000:
+            reasons.append('p99 latency %.0f ms' % p99)
+        server = phase.get('server')
+        if server and server['dropped'] > 0:
+            reasons.append('the daemon dropped %d notifications'
+                           % server['dropped'])
+        if reasons:
+            return {'phase': i, 'rate': phase['rate'], 'reasons': reasons,
+                    'max_sustained_rate': phases[i - 1]['rate']
+                    if i else None}
+    return None
+
+
+def main(args):
+    phases = parse_schedule(args)
+    subscriptions, leaves, fanout = plan(args)
+    workers = []
+    for number in range(args.processes):
+        conn, child_conn = Pipe()
+        process = Process(target=run_worker, args=(
+            args, number, subscriptions[number::args.processes], leaves,
+            fanout, child_conn), daemon=True)
+        process.start()
+        workers.append((process, conn))
+
+    ready = [conn.recv() for _, conn in workers]
+    connected = {key: sum(r[key] for r in ready)
+                 for key in ('subscribed', 'pushers', 'connect_failures')}
+    handshakes = [sum(c) for c in zip(*[r['handshake_counts']
+                                        for r in ready])]
+    connected['handshake_p99_ms'] = (percentile(handshakes, 99) or 0) * 1000
+    print("connected %(subscribed)d subscribers and %(pushers)d pushers, "
+          "%(connect_failures)d connections failed" % connected,
+          file=sys.stderr)
+
+    start = time() + 1
+    for _, conn in workers:
+        conn.send(start)
+
+    # scrape the daemon's metrics during every phase
+    phase_start = start
+    server = []
+    before = scrape(args.metrics_url)
+    for rate, seconds in phases:
+        samples = []
+        phase_end = phase_start + seconds
+        while time() < phase_end:
+            sleep(max(0, min(args.scrape_interval, phase_end - time())))
+            sample = scrape(args.metrics_url)
+            if sample is not None:
+                samples.append(sample)
+        after = samples[-1] if samples else None
+        server.append(server_stats(before, samples, after))
+        before = after
+        phase_start = phase_end
+
+    results = [conn.recv() for _, conn in workers]
+    for process, _ in workers:
+        process.join()
+
+    merged = merge(results, phases)
+    for phase, stats in zip(merged, server):
+        phase['server'] = stats
+    for phase in merged:
+        latency = phase['latency_ms']
+        print("%8.0f/s offered %8.0f/s pushed %8.0f/s delivered "
+              "%5.1f%% lost p50 %s p99 %s" % (
+                  phase['rate'], phase['push_rate'], phase['delivery_rate'],
+                  phase['loss'] * 100,
+                  '%.1fms' % latency['p50'] if latency['p50'] else '-',
+                  '%.1fms' % latency['p99'] if latency['p99'] else '-'),
+              file=sys.stderr)
+    limited = sum(phase['generator_limited'] for phase in merged)
+    if limited:
+        print("the load generator couldn't push the offered rate in %d "
+              "phases, use more --processes or fewer subscribers per "
+              "process" % limited, file=sys.stderr)
+    saturated = saturation(merged, args)
+    if saturated is None:
+        print("no saturation", file=sys.stderr)
+    else:
+        print("saturated at %.0f notifications/s: %s" % (
+            saturated['rate'], ', '.join(saturated['reasons'])),
+            file=sys.stderr)
+    return {
+        'parameters': vars(args),
+        'connections': connected,
+        'disconnects': sum(r['disconnects'] for r in results),
+        'phases': merged,
+        'saturation': saturated,
+    }
+
+
+if __name__ == '__main__':
+    p = ArgumentParser(description="Load generator for notifymed")
+    p.add_argument('-k', '--key', help="key file", required=True)
+    p.add_argument('-c', '--certificate', help="certificate file",
+                   required=True)
+    p.add_argument('-n', '--hostname', default='localhost',
+                   help="daemon hostname")
+    p.add_argument('-p', '--portnumber', type=int, default=10023,
+                   help="publisher port")
+    p.add_argument('--collector-port', type=int, default=10024,
+                   help="collector port")
+    p.add_argument('--serverhash', help="sha256 hash of the server's cert")
+    p.add_argument('--tls-method', choices=['tlsv1', 'tls'], default='tlsv1',
+                   help="'tls' negotiates the best version both sides "
+                   "support instead of TLS 1.0")
+    p.add_argument('-s', '--subscribers', type=int, default=100,
+                   help="number of subscribers")
+    p.add_argument('-P', '--pushers', type=int, default=4,
+                   help="number of pushers")
+    p.add_argument('-j', '--processes', type=int, default=1,
+                   help="worker processes, each runs an event loop")
+    p.add_argument('--connect-concurrency', type=int, default=100,
+                   help="connections opened at the same time per process")
+    p.add_argument('--connect-timeout', type=float, default=60,
+                   help="seconds to wait for all subscriptions")
+    p.add_argument('--root', default='/load',
+                   help="resource the tree is rooted at")
+    p.add_argument('--shape', default='8,8,8',
+                   type=lambda s: [int(n) for n in s.split(',')],
+                   help="children per node on each level of the tree")
+    p.add_argument('--subscription-depth', type=int, default=2,
+                   help="level of the tree subscribers subscribe to, "
+                   "0 is the root")
+    p.add_argument('--subscriptions', type=int, default=1,
+                   help="resources per subscriber")
+    p.add_argument('--zipf', type=float, default=1.0,
+                   help="exponent of the resource popularity, 0 for a "
+                   "uniform distribution")
+    p.add_argument('--urgency', default='uniform:0:100',
+                   help="constant:U, uniform:LOW:HIGH, normal:MEAN:STDDEV "
+                   "or weights:U=W,U=W,...")
+    p.add_argument('--schedule', default='100:10',
+                   help="phases of the load as RATE:SECONDS,... with RATE "
+                   "notifications per second over all pushers")
+    p.add_argument('--ramp', help="START:STEPS:SECONDS, double the rate "
+                   "every phase instead of --schedule")
+    p.add_argument('-b', '--batch-size', type=int, default=1,
+                   help="push batches of up to this many notifications")
+    p.add_argument('--payload-size', type=int, default=100,
+                   help="bytes of padding per notification")
+    p.add_argument('--trace-sample-rate', type=float, default=0,
+                   help="fraction of the notifications to stamp for "
+                   "tracing")
+    p.add_argument('--drain', type=float, default=5,
+                   help="seconds to wait for deliveries after the last "
+                   "phase")
+    p.add_argument('--metrics-url', help="metrics endpoint of the daemon, "
+                   "e.g. http://127.0.0.1:9100/metrics")
+    p.add_argument('--scrape-interval', type=float, default=1,
+                   help="seconds between two scrapes of the metrics")
+    p.add_argument('--loss-threshold', type=float, default=0.01,
+                   help="share of lost deliveries that counts as saturated")
+    p.add_argument('--latency-threshold', type=float, default=1,
+                   help="p99 latency in seconds that counts as saturated")
+    p.add_argument('--seed', type=int, default=0,
+                   help="seed of the generated subscriptions and load")
+    p.add_argument('-o', '--output', help="write the JSON result to this "
+                   "file instead of stdout")
+    args = p.parse_args()
+    if args.processes < 1:
+        p.error("--processes has to be at least 1")
+    args.pushers_per_worker = [len(range(n, args.pushers, args.processes))
+                               for n in range(args.processes)]
+
+    logging.basicConfig(format='%(levelname)s:%(message)s',
+                        level=logging.WARNING)
+    result = main(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -20,35 +20,63 @@
 import sys
 from os.path import abspath, dirname, join
 sys.path.append(abspath(join(dirname(__file__), '..')))
-import logging
 
-from notifyme.pushclient import SSLPushClient
 from notifyme.notification import Notification
 
 from argparse import ArgumentParser
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Notifyme subscriber component")
-    parser.add_argument('-k', '--key', help="key file",
-                        required=True)
-    parser.add_argument('-c', '--certificate', help="certificate file",
-                        required=True)
-    parser.add_argument('-n', '--hostname', help="publisher hostname",
-                        required=True)
-    parser.add_argument('-p', '--portnumber', help="publisher port",
-                        required=True)
+    parser.add_argument('-k', '--key', help="key file")
+    parser.add_argument('-c', '--certificate', help="certificate file")
+    parser.add_argument('-n', '--hostname', help="publisher hostname")
+    parser.add_argument('-p', '--portnumber', help="publisher port")
     parser.add_argument('-r', '--resource', help="push to resource",
                         required=True)
     parser.add_argument('-s', '--subject', help="subject of ntoification",
                         required=True)
     parser.add_argument('-u', '--urgency', help="urgency of ntoification",
                         required=False)
-    parser.add_argument('--serverhash', 
+    parser.add_argument('--serverhash',
                         help="sha256 hash of the server's cert",
                         required=False)
+    parser.add_argument('--trace', action='store_true',
+                        help="stamp the notification for latency tracing")
+    parser.add_argument('-a', '--agent', nargs='?', const='',
+                        help="hand the notification to a running "
+                             "notifyme-pushd instead of connecting to the "
+                             "collector, optionally at the given socket path",
+                        required=False)
 
     args = parser.parse_args()
 
+    if args.urgency is None:
+        urgency = 50
+    else:
+        urgency = int(args.urgency)
+
+    notification = Notification(subject=args.subject,
+                                urgency=urgency,
+                                resource=args.resource,
+                                data=None)
+
+    if args.agent is not None:
+        # keep this path free of pyOpenSSL so it starts quickly
+        from notifyme.pushagent import send_to_agent
+        if args.trace:
+            # the agent forwards the stamp along with the notification
+            from notifyme.tracing import stamp
+            stamp([notification])
+        send_to_agent([notification], socket_path=args.agent or None)
+        sys.exit(0)
+
+    for option in ('key', 'certificate', 'hostname', 'portnumber'):
+        if getattr(args, option) is None:
+            parser.error("--%s is required unless --agent is used" % option)
+
+    import logging
+    from notifyme.pushclient import SSLPushClient
+
     logging.basicConfig(format='%(levelname)s:%(message)s',
                         level=logging.DEBUG)
 
@@ -56,14 +84,8 @@ if __name__ == '__main__':
                            port=int(args.portnumber),
                            keyfile=args.key,
                            certfile=args.certificate,
-                           serverhash=args.serverhash)
-
-    if args.urgency == None:
-        urgency = 50
-
-    notification = Notification(subject=args.subject,
-                                urgency=urgency,
-                                resource=args.resource,
-                                data=None)
+                           serverhash=args.serverhash,
+                           trace_sample_rate=1 if args.trace else 0)
 
     client.send_notification(notification)
+    client.close()
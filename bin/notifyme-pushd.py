@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from os.path import abspath, dirname, join
+sys.path.append(abspath(join(dirname(__file__), '..')))
+import logging
+
+from notifyme.pushclient import SSLPushClient
+from notifyme.pushagent import PushAgent
+
+from argparse import ArgumentParser
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Notifyme local push agent")
+    parser.add_argument('-k', '--key', help="key file",
+                        required=True)
+    parser.add_argument('-c', '--certificate', help="certificate file",
+                        required=True)
+    parser.add_argument('-n', '--hostname', help="collector hostname",
+                        required=True)
+    parser.add_argument('-p', '--portnumber', help="collector port",
+                        required=True)
+    parser.add_argument('--serverhash',
+                        help="sha256 hash of the server's cert",
+                        required=False)
+    parser.add_argument('--socket', help="path of the local UNIX socket",
+                        required=False)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s',
+                        level=logging.DEBUG)
+
+    client = SSLPushClient(hostname=args.hostname,
+                           port=int(args.portnumber),
+                           keyfile=args.key,
+                           certfile=args.certificate,
+                           serverhash=args.serverhash)
+
+    agent = PushAgent(client, socket_path=args.socket)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        agent.shutdown()
+        client.close()
+    except OSError as e:
+        logging.critical("could not listen: %s" % e.strerror)
+        client.close()
+        sys.exit(1)
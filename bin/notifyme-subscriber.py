@@ -22,7 +22,7 @@ from os.path import abspath, dirname, join, exists
 sys.path.append(abspath(join(dirname(__file__), '..')))
 import logging
 
-from time import sleep
+from time import sleep, time
 from notifyme.subscriber import SimpleSubscriber
 
 from argparse import ArgumentParser
@@ -51,18 +51,36 @@ if __name__ == '__main__':
                         required=True)
     parser.add_argument('-r', '--resource', help="subscribe to resource",
                         required=True, action='append')
+    parser.add_argument('--since', help="replay notifications of the last "
+                        "SINCE seconds from the publisher's backlog first",
+                        type=float, required=False)
+    parser.add_argument('-u', '--min-urgency', help="only receive "
+                        "notifications with at least this urgency",
+                        type=int, required=False)
+    parser.add_argument('--no-reconnect', help="exit when the connection "
+                        "to the publisher is lost", action='store_true')
     args = parser.parse_args()
     logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    since_timestamp = None
+    filters = None
+    if args.min_urgency is not None:
+        filters = {'min_urgency': args.min_urgency}
+    if args.since is not None:
+        since_timestamp = time() - args.since
     subscriber = SimpleSubscriber(hostname=args.hostname,
                                   port=int(args.portnumber),
                                   certfile=args.certificate,
                                   keyfile=args.key,
                                   notification_callback=notification_callback,
-                                  subscribed_resources=args.resource)
+                                  subscribed_resources=args.resource,
+                                  since_timestamp=since_timestamp,
+                                  reconnect=not args.no_reconnect,
+                                  filters=filters)
     subscriber.daemon = True
     try:
         subscriber.run()
     except KeyboardInterrupt:
+        subscriber.stop()
         sys.exit(1)
     except Exception as e:
         sys.exit(1)
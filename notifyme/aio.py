@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from OpenSSL import SSL
+
+from notifyme.messages import WrappedProtocolMessage, READ_SIZE
+
+
+class TLSStream:
+    """
+    Non-blocking TLS on top of an asyncio stream.
+
+    pyOpenSSL is used with memory BIOs, so the same `SSL.Context` (and
+    verify callback) as in the threaded components can be used on an event
+    loop.
+    """
+    def __init__(self, ssl_context, reader, writer, server_side=True):
+        """
+        Initialize a TLS stream
+
+        Args:
+            ssl_context(:class:`OpenSSL.SSL.Context`): context to use
+            reader(:class:`asyncio.StreamReader`): plain text reader
+            writer(:class:`asyncio.StreamWriter`): plain text writer
+            server_side(bool): whether we accept or initiate the handshake
+        """
+        self.reader = reader
+        self.writer = writer
+        self.connection = SSL.Connection(ssl_context, None)
+        if server_side:
+            self.connection.set_accept_state()
+        else:
+            self.connection.set_connect_state()
+
+    def _flush(self):
+        """
+        Move all pending encrypted bytes to the transport
+        """
+        while True:
+            try:
+                data = self.connection.bio_read(READ_SIZE)
+            except SSL.WantReadError:
+                return
+            self.writer.write(data)
+
+    async def _fill(self):
+        """
+        Wait for encrypted bytes from the peer and feed them to OpenSSL
+
+        Raises:
+            :class:`EOFError` if the peer closed the connection.
+        """
+        await self.writer.drain()
+        data = await self.reader.read(READ_SIZE)
+        if not data:
+            self.connection.bio_shutdown()
+            raise EOFError("Connection closed by peer")
+        self.connection.bio_write(data)
+
+    async def do_handshake(self):
+        """
+        Perform the TLS handshake
+
+        Raises:
+            :class:`OpenSSL.SSL.Error` if the handshake failed.
+        """
+        while True:
+            try:
+                self.connection.do_handshake()
+                break
+            except SSL.WantReadError:
+                self._flush()
+                await self._fill()
+        self._flush()
+        await self.writer.drain()
+
+    async def receive_message(self, decoder):
+        """
+        Receive the next message, waiting for data only if no complete
+        frame is buffered in `decoder`.
+
+        Args:
+            decoder(:class:`notifyme.messages.FrameDecoder`): decoder of this
+                connection
+
+        Returns:
+            :class:`notifyme.messages.ProtocolMessage`
+        """
+        frame = decoder.next_frame()
+        while frame is None:
+            await self.read_into(decoder)
+            frame = decoder.next_frame()
+        return WrappedProtocolMessage.parse(frame)
+
+    async def read_into(self, decoder):
+        """
+        Wait for data from the peer and read it into `decoder`
+
+        Args:
+            decoder(:class:`notifyme.messages.FrameDecoder`): decoder of this
+                connection
+
+        Returns:
+            number of bytes read
+
+        Raises:
+            :class:`EOFError` if the peer closed the connection.
+        """
+        while True:
+            try:
+                return decoder.read_from(self.connection)
+            except SSL.WantReadError:
+                self._flush()
+                await self._fill()
+
+    def write(self, data):
+        """
+        Encrypt `data` and hand it to the transport without blocking
+
+        Args:
+            data(bytes): data to send
+        """
+        self.connection.sendall(data)
+        self._flush()
+
+    async def drain(self):
+        """
+        Wait until the transport's write buffer has been flushed
+        """
+        await self.writer.drain()
+
+    def close(self):
+        """
+        Close the underlying transport
+        """
+        self.writer.close()
@@ -0,0 +1,275 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from heapq import merge
+from itertools import islice
+from threading import RLock
+from time import time
+from uuid import uuid4
+
+from notifyme.messages import NotificationMessage
+from notifyme.resources import ResourceMatcher
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the most recent notifications of a single resource.
+
+    Sequence numbers and timestamps live in flat arrays, the encoded
+    notifications in a preallocated list, so appending never allocates.
+    """
+    __slots__ = ('capacity', 'sequences', 'timestamps', 'messages',
+                 'start', 'count')
+
+    def __init__(self, capacity):
+        """
+        Initialize an empty buffer
+
+        Args:
+            capacity(int): maximum number of notifications kept
+        """
+        self.capacity = capacity
+        self.sequences = array('Q', [0]) * capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.messages = [None] * capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sequence, timestamp, message):
+        """
+        Add a notification, evicting the oldest one if the buffer is full
+
+        Args:
+            sequence(int): sequence number of the notification
+            timestamp(float): time the notification was received
+            message(:class:`notifyme.messages.EncodedMessage`): notification
+        """
+        if self.count == self.capacity:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            i = (self.start + self.count) % self.capacity
+            self.count += 1
+        self.sequences[i] = sequence
+        self.timestamps[i] = timestamp
+        self.messages[i] = message
+
+    def expire(self, oldest_timestamp):
+        """
+        Evict all notifications older than `oldest_timestamp`
+        """
+        while self.count and self.timestamps[self.start] < oldest_timestamp:
+            self.messages[self.start] = None
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+
+    def _first(self, values, value):
+        """
+        Logical position of the first entry in `values` that is not smaller
+        than `value`. Both sequences and timestamps grow monotonically.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if values[(self.start + mid) % self.capacity] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def since(self, sequence=None, timestamp=None, limit=None):
+        """
+        Notifications after `sequence` and not older than `timestamp`, at
+        most `limit` of them
+
+        Returns:
+            list of (sequence, :class:`notifyme.messages.EncodedMessage`)
+            tuples, oldest first
+        """
+        first = 0
+        if sequence is not None:
+            first = max(first, self._first(self.sequences, sequence + 1))
+        if timestamp is not None:
+            first = max(first, self._first(self.timestamps, timestamp))
+        end = self.count
+        if limit is not None:
+            end = min(end, first + limit)
+        result = []
+        for n in range(first, end):
+            i = (self.start + n) % self.capacity
+            result.append((self.sequences[i], self.messages[i]))
+        return result
+
+
+class Backlog:
+    """
+    Recent notifications of all resources, so subscribers can catch up on
+    what happened while they were away.
+
+    Every notification gets a sequence number that grows monotonically
+    across all resources. Each resource keeps at most `max_notifications`
+    notifications, and notifications older than `max_age` seconds are
+    evicted.
+
+    The numbering starts over whenever a backlog is created, `epoch` is a
+    random string that tells subscribers which numbering their sequence
+    numbers belong to.
+
+    `lock` is reentrant and held during every operation. Callers that need
+    to send notifications in the order they were added can hold it
+    themselves.
+    """
+    #: number of appends after which empty buffers are removed
+    CLEANUP_INTERVAL = 1024
+
+    def __init__(self, max_notifications=100, max_age=None):
+        """
+        Initialize an empty backlog
+
+        Args:
+            max_notifications(int): notifications kept per resource
+            max_age(float): seconds after which notifications are evicted,
+                `None` keeps them until they are pushed out by newer ones
+        """
+        if max_notifications < 1:
+            raise ValueError("max_notifications must be at least 1")
+        self.max_notifications = max_notifications
+        self.max_age = max_age
+        self.sequence = 0
+        self.epoch = uuid4().hex
+        self.lock = RLock()
+        self._buffers = {}
+        self._appends = 0
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(b) for b in self._buffers.values())
+
+    def _oldest_timestamp(self, now):
+        if self.max_age is None:
+            return None
+        return now - self.max_age
+
+    def append(self, notification, timestamp=None):
+        """
+        Number, encode and store a notification
+
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to store
+            timestamp(float): time of arrival, defaults to now
+
+        Returns:
+            :class:`notifyme.messages.EncodedMessage` of the
+            :class:`notifyme.messages.NotificationMessage` carrying the
+            sequence number and timestamp
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self.lock:
+            return self._append(notification, timestamp)
+
+    def extend(self, notifications, timestamp=None):
+        """
+        Number, encode and store several notifications at once, e.g. the
+        content of a :class:`notifyme.messages.NotificationBatchMessage`
+
+        Args:
+            notifications(list): :class:`notifyme.notification.Notification`
+                objects to store
+            timestamp(float): time of arrival, defaults to now
+
+        Returns:
+            list of :class:`notifyme.messages.EncodedMessage`, one per
+            notification
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self.lock:
+            return [self._append(notification, timestamp)
+                    for notification in notifications]
+
+    def _append(self, notification, timestamp):
+        """
+        Store a single notification. Must be called with the lock held.
+        """
+        self.sequence += 1
+        message = NotificationMessage(notification,
+                                      sequence=self.sequence,
+                                      timestamp=timestamp).encoded
+        buffer = self._buffers.get(notification.resource)
+        if buffer is None:
+            buffer = self._buffers[notification.resource] = \
+                RingBuffer(self.max_notifications)
+        oldest = self._oldest_timestamp(timestamp)
+        if oldest is not None:
+            buffer.expire(oldest)
+        buffer.append(self.sequence, timestamp, message)
+
+        self._appends += 1
+        if self._appends % self.CLEANUP_INTERVAL == 0:
+            self.expire(timestamp)
+        return message
+
+    def expire(self, now=None):
+        """
+        Evict notifications that are too old and forget resources without
+        any notifications left
+        """
+        if now is None:
+            now = time()
+        oldest = self._oldest_timestamp(now)
+        with self.lock:
+            for resource, buffer in list(self._buffers.items()):
+                if oldest is not None:
+                    buffer.expire(oldest)
+                if not len(buffer):
+                    del self._buffers[resource]
+
+    def replay(self, resources, since_sequence=None, since_timestamp=None,
+               limit=None):
+        """
+        Stored notifications of `resources` and their subresources
+
+        Args:
+            resources(list): resources, each as a string
+            since_sequence(int): only notifications with a higher sequence
+                number
+            since_timestamp(float): only notifications that arrived at or
+                after this time
+            limit(int): only the oldest `limit` notifications, `None` for
+                all of them
+
+        Returns:
+            list of :class:`notifyme.messages.EncodedMessage`, ordered by
+            sequence number
+        """
+        matcher = ResourceMatcher(resources)
+        oldest = self._oldest_timestamp(time())
+        if oldest is not None and (since_timestamp is None
+                                   or since_timestamp < oldest):
+            since_timestamp = oldest
+        with self.lock:
+            entries = [buffer.since(since_sequence, since_timestamp, limit)
+                       for resource, buffer in self._buffers.items()
+                       if matcher.matches(resource)]
+        return [message for _, message in islice(merge(*entries), limit)]
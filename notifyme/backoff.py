@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from random import uniform
+
+
+class ExponentialBackoff:
+    """
+    Delays between reconnection attempts.
+
+    The delay doubles (by default) with every failed attempt up to
+    `maximum`. A random part of it is cut off, so clients that lost their
+    connection at the same moment don't all come back at the same moment.
+    """
+    def __init__(self, initial=0.5, maximum=60.0, multiplier=2.0,
+                 jitter=0.5):
+        """
+        Args:
+            initial(float): delay after the first failure in seconds
+            maximum(float): upper bound for the delay in seconds
+            multiplier(float): factor the delay grows by per attempt
+            jitter(float): fraction of the delay that is randomized, 0
+                disables jitter, 1 picks anything between 0 and the delay
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.attempts = 0
+        self.last_delay = 0.0
+
+    def next_delay(self):
+        """
+        Delay before the next attempt, counts the attempt
+
+        Returns:
+            seconds as float
+        """
+        # the exponent is capped so the power can't overflow
+        delay = min(self.maximum,
+                    self.initial * self.multiplier ** min(self.attempts, 64))
+        delay -= uniform(0, delay * self.jitter)
+        self.attempts += 1
+        self.last_delay = delay
+        return delay
+
+    def reset(self):
+        """
+        Start over after a successful connection
+        """
+        self.attempts = 0
+        self.last_delay = 0.0
+
+    @property
+    def stats(self):
+        """
+        Number of attempts and the last delay as a dict
+        """
+        return {'attempts': self.attempts, 'last_delay': self.last_delay}
@@ -16,25 +16,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from hashlib import sha256
+import asyncio
 import logging
-from threading import Thread, Lock
-from socket import socket, AF_INET, SOCK_STREAM
+from os import cpu_count
+from threading import Thread
+from socket import socket, AF_INET, SOCK_STREAM, SOMAXCONN
+from time import perf_counter
 
-from OpenSSL import SSL, crypto
+from OpenSSL import SSL
 
-from notifyme.statemachine import ReceivingProtocolState, \
-    ProtocolStateMachine
+from notifyme.statemachine import ProtocolStateMachine, TransitionTable, \
+    ANY
 from notifyme.messages import NotificationMessage, ErrorMessage, \
-    WrappedProtocolMessage
-from notifyme.resources import is_subresource
+    NotificationBatchMessage, WrappedProtocolMessage, FrameError
+from notifyme.resources import ResourceMatcher
+from notifyme.permissions import PermissionStore
+from notifyme.aio import TLSStream
+from notifyme.handshake import HandshakePool, handshake_done, \
+    HANDSHAKE_TIMEOUT
+from notifyme.session import ProtocolSession
 
 
-class CollectorProtocol:
+class CollectorProtocol(ProtocolStateMachine):
     """
-    Protocol spoken by the collector
+    Protocol spoken by the collector. A session accepts any number of
+    NotificationMessages until the peer disconnects.
     """
-    def __init__(self, allowed_resources, notification_callback):
+    def __init__(self, allowed_resources, notification_callback,
+                 batch_callback=None):
         """
         Initialize a new CollectorProtocol
 
@@ -49,65 +58,114 @@ class CollectorProtocol:
             allowed_resources(list): List of resources the connected client
                 is allowed to push to.
 
+            batch_callback(:class:`types.FunctionType`): Optional, executed
+                with the list of permitted notifications whenever we receive
+                a NotificationBatchMessage. If omitted,
+                `notification_callback` is called for each of them.
+
         """
         if not callable(notification_callback):
             raise ValueError("notification_callback has to be callable!")
 
         self.allowed_resources = allowed_resources
+        self.resource_matcher = ResourceMatcher(allowed_resources)
         self.notification_callback = notification_callback
+        self.batch_callback = batch_callback
+        self.metrics = None
+        self.tracer = None
+
+        ProtocolStateMachine.__init__(self, CollectorProtocol.TRANSITIONS,
+                                      self)
 
-        self._state = CollectorProtocol.ReceiveNotificationState(self)
+    @staticmethod
+    def receive_notification(context, in_msg):
+        """
+        Hand a permitted notification to the callback
 
-    def __call__(self, in_msg):
-        self._state, out_msg = self._state(in_msg)
-        return out_msg
+        Args:
+            in_msg(:class:`notifyme.messages.NotificationMessage`):
+                Message to handle
 
-    class ReceiveNotificationState(ReceivingProtocolState):
+        Returns:
+            optional ErrorMessage
         """
-        Initial State of a collector Thread
+        if not context.resource_matcher.matches(in_msg.data['resource']):
+            logging.debug("Client tried to push in a resource without permission")
+            return None
+
+        if context.metrics is not None:
+            context.metrics.notification_received(in_msg.data['resource'])
+        notification = in_msg.notification
+        if context.tracer is not None:
+            context.tracer.received(notification)
+        try:
+            context.notification_callback(notification)
+        except ValueError as e:
+            return ErrorMessage(e.args[0])
+
+        return None
+
+    @staticmethod
+    def receive_batch(context, in_msg):
         """
-        def __call__(self, in_msg):
-            """
-            Properly handle incoming ProtocolMessages.
-
-            Args:
-                in_msg(:class:`notifyme.messages.ProtocolMessage`):
-                    Message to handle
-
-            Returns:
-                Tuple of new state and optional ErrorMessage
-            """
-            if type(in_msg) is not NotificationMessage:
-                return (self, ErrorMessage("This node only accepts \
-                                           NotificationMessages"))
-
-            #if not is_subresource(in_msg.data['resource'] not in self.context.allowed_resources:
-                #return self,\
-                    #ErrorMessage("Not allowed to post in this resource")
-
-            found = False
-            for res in self.context.allowed_resources:
-                if is_subresource(in_msg.data['resource'], res):
-                    found = True
-                    break
+        Hand all permitted notifications of a NotificationBatchMessage
+        to the callback at once.
 
-            if not found:
-                logging.debug("Client tried to push in a resource without permission")
-                return (self, None)
+        Args:
+            in_msg(:class:`notifyme.messages.NotificationBatchMessage`):
+                Message to handle
 
-            try:
-                self.context.notification_callback(in_msg.notification)
-            except ValueError as e:
-                return (self, ErrorMessage(e.message))
+        Returns:
+            optional ErrorMessage
+        """
+        matcher = context.resource_matcher
+        notifications = [n for n in in_msg.notifications
+                         if matcher.matches(n.resource)]
+        if len(notifications) < len(in_msg):
+            logging.debug("Client tried to push in a resource without permission")
+        if not notifications:
+            return None
+
+        metrics = context.metrics
+        if metrics is not None:
+            for notification in notifications:
+                metrics.notification_received(notification.resource)
+        tracer = context.tracer
+        if tracer is not None:
+            for notification in notifications:
+                tracer.received(notification)
+        try:
+            if context.batch_callback is not None:
+                context.batch_callback(notifications)
+            else:
+                for notification in notifications:
+                    context.notification_callback(notification)
+        except ValueError as e:
+            return ErrorMessage(e.args[0])
+
+        return None
 
-            return (self, None)
+    @staticmethod
+    def unexpected_message(context, in_msg):
+        return ErrorMessage("This node only accepts NotificationMessages")
+
+    TRANSITIONS = TransitionTable('receive_notification', [
+        ('receive_notification', NotificationMessage, receive_notification,
+         'receive_notification'),
+        ('receive_notification', NotificationBatchMessage, receive_batch,
+         'receive_notification'),
+        ('receive_notification', ANY, unexpected_message,
+         'receive_notification'),
+    ])
 
 
 class SimpleCollector(Thread):
     """
     Simple Collector, interacts with a :class:`socket.connection`
     """
-    def __init__(self, connection, notification_callback, allowed_resources):
+    def __init__(self, connection, notification_callback, allowed_resources,
+                 resource_matcher=None, batch_callback=None, metrics=None,
+                 tracer=None):
         """
         Create a new SimpleCollector that handles a `socket.connection`
 
@@ -119,15 +177,37 @@ class SimpleCollector(Thread):
                 object that is being called when a notification is
                 received
 
+            allowed_resources(list): List of resources the connected client
+                is allowed to push to.
+
+            resource_matcher(:class:`notifyme.resources.ResourceMatcher`):
+                compiled `allowed_resources`, compiled on demand if omitted.
+
+            batch_callback(:class:`types.FunctionType`): optional callable
+                that is being called with the list of notifications of a
+                received batch.
+
+            metrics(:class:`notifyme.metrics.ServerMetrics`): metrics to
+                update, optional
+
+            tracer(:class:`notifyme.tracing.Tracer`): tracer of received
+                notifications, optional
+
         """
         Thread.__init__(self)
         self.connection = connection
         self.running = True
         self.notification_callback = notification_callback
         self.allowed_resources = allowed_resources
-        self._protocol = ProtocolStateMachine(
-            initial_state=CollectorProtocol.ReceiveNotificationState(self)
-        )
+        if resource_matcher is None:
+            resource_matcher = ResourceMatcher(allowed_resources)
+        self.resource_matcher = resource_matcher
+        self.batch_callback = batch_callback
+        self.metrics = metrics
+        self.tracer = tracer
+        self._protocol = ProtocolStateMachine(CollectorProtocol.TRANSITIONS,
+                                              self)
+        self._protocol_session = ProtocolSession(self._protocol)
 
     def send_message(self, message):
         """
@@ -138,7 +218,7 @@ class SimpleCollector(Thread):
                 message to be sent.
         """
         wrapped_message = WrappedProtocolMessage(message)
-        self.connection.send(wrapped_message.text.encode('utf-8'))
+        self.connection.sendall(wrapped_message.frame)
 
     def receive_message(self):
         """
@@ -148,80 +228,121 @@ class SimpleCollector(Thread):
         Returns:
             :class:`notifyme.messages.ProtocolMessage`
         """
-        received_bytes = self.connection.recv(1024)
-        received_string = received_bytes.decode('utf-8')
-        in_msg = WrappedProtocolMessage.parse(received_string)
-        return in_msg
+        decoder = self._protocol_session.decoder
+        return decoder.receive_message(self.connection)
 
     def run(self):
         """
-        Handle the communication with a peer.
+        Handle the communication with a peer until it disconnects.
         """
+        connections = None
+        if self.metrics is not None:
+            connections = self.metrics.connections.labels('collector')
+            connections.inc()
+        session = self._protocol_session
+        session.start()
         while self.running:
             try:
-                if self._protocol.wait_for_input:
-                    in_msg = self.receive_message()
-                else:
-                    in_msg = None
-                out_msg = self._protocol(in_msg)
-                self.running = False
-            except Exception as e:
-                out_msg = ErrorMessage(e.args[0])
-            if out_msg is not None:
+                session.decoder.read_from(self.connection)
+                session.receive_data()
+            except (EOFError, FrameError, SSL.Error, OSError):
+                break
+            data = session.data_to_send()
+            if data:
                 try:
-                    self.send_message(out_msg)
+                    self.connection.sendall(data)
                 except Exception as e:
                     self.running = False
+        self.connection.close()
+        if connections is not None:
+            connections.dec()
 
 
-class CollectorDispatcher(Thread):
-    class VerificationHelper:
+class AsyncCollector:
+    """
+    Collector that interacts with a :class:`notifyme.aio.TLSStream` on an
+    asyncio event loop
+    """
+    def __init__(self, stream, notification_callback, allowed_resources,
+                 resource_matcher=None, batch_callback=None, metrics=None,
+                 tracer=None):
         """
-        Helper that serves as verify_callback for OpenSSL
+        Create a new AsyncCollector that handles a TLS stream
+
+        Args:
+            stream(:class:`notifyme.aio.TLSStream`): Network connection
+                to the peer
+
+            notification_callback(:class:`types.FunctionType`): callable
+                object that is being called when a notification is
+                received. Runs on the event loop, so it must not block.
+
+            allowed_resources(list): List of resources the connected client
+                is allowed to push to.
+
+            resource_matcher(:class:`notifyme.resources.ResourceMatcher`):
+                compiled `allowed_resources`, compiled on demand if omitted.
+
+            batch_callback(:class:`types.FunctionType`): optional callable
+                that is being called with the list of notifications of a
+                received batch.
+
+            metrics(:class:`notifyme.metrics.ServerMetrics`): metrics to
+                update, optional
+
+            tracer(:class:`notifyme.tracing.Tracer`): tracer of received
+                notifications, optional
+
         """
-        def __init__(self, permissions):
-            """
-            Initialize Helper and set permissions. Saves the permitted
-            resources of the incoming certificate in `permitted_resources`.
-            call `reset()` before you re-use it!
-
-            Args:
-                permissions: list of tuples, each consisting of the
-                    hex representation of a sha256 hash as a string
-                    and a list of allowed resources, each as a string.
-            """
-            self.permissions = permissions
-            self.permitted_resources = []
-            self.in_use = Lock()
-
-        def reset(self):
-            """
-            Resets the object, call before reuse!
-            """
-            self.permitted_resources = []
-
-        def __call__(self, conn, cert, a, b, c):
-            """
-            Actually perform the verification
-            """
-            # determine certificate sha256 hash
-            cert_hash = sha256()
-            cert_hash.update(crypto.dump_certificate(1, cert))
-            cert_hashdigest = cert_hash.hexdigest()
-
-            # check against permissions table
-            res = list(filter(lambda x: x[0] == cert_hashdigest,
-                              self.permissions))
-            if len(res) < 1:
-                logging.debug("found unknown cert hash")
-                return False
-            else:
-                self.permitted_resources = res[0][1]
-                logging.debug("found known cert hash")
-                return True
+        self.stream = stream
+        self.running = True
+        self.notification_callback = notification_callback
+        self.allowed_resources = allowed_resources
+        if resource_matcher is None:
+            resource_matcher = ResourceMatcher(allowed_resources)
+        self.resource_matcher = resource_matcher
+        self.batch_callback = batch_callback
+        self.metrics = metrics
+        self.tracer = tracer
+        self._protocol = ProtocolStateMachine(CollectorProtocol.TRANSITIONS,
+                                              self)
+        self._protocol_session = ProtocolSession(self._protocol)
+
+    async def run(self):
+        """
+        Handle the communication with a peer until it disconnects.
+        """
+        connections = None
+        if self.metrics is not None:
+            connections = self.metrics.connections.labels('collector')
+            connections.inc()
+        try:
+            session = self._protocol_session
+            session.start()
+            while self.running:
+                try:
+                    await self.stream.read_into(session.decoder)
+                    session.receive_data()
+                except (EOFError, FrameError, SSL.Error, OSError):
+                    break
+                data = session.data_to_send()
+                if data:
+                    try:
+                        self.stream.write(data)
+                        await self.stream.drain()
+                    except (SSL.Error, OSError):
+                        self.running = False
+        finally:
+            self.stream.close()
+            if connections is not None:
+                connections.dec()
 
+
+class CollectorDispatcher(Thread):
     def __init__(self, address, port, keyfile, certfile, permissions_table,
-                 callback):
+                 callback, handshake_workers=None, batch_callback=None,
+                 metrics=None, tracer=None,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
         """
         Initialize server dispatcher for publishers
 
@@ -232,17 +353,36 @@ class CollectorDispatcher(Thread):
             certfile (string): path to certfile
             permissions_table (list): list of tuples with sha256 hashes of the
                 client's certificate and the list of the resorces the client
-                may push to.
+                may push to, or a
+                :class:`notifyme.permissions.PermissionStore`.
+            handshake_workers (int): number of TLS handshakes performed in
+                parallel, defaults to the number of CPUs
+            callback: called with every received notification
+            batch_callback: called with the notifications of a received
+                batch, optional.
+            metrics (:class:`notifyme.metrics.ServerMetrics`): metrics to
+                update, optional
+            tracer (:class:`notifyme.tracing.Tracer`): tracer of received
+                notifications, optional
+            handshake_timeout (float): seconds a push client gets to
+                complete the TLS handshake, `None` for no limit
         """
         Thread.__init__(self)
         self.running = True
         self.permissions = permissions_table
-        self._verifier = CollectorDispatcher.VerificationHelper(
-            permissions=permissions_table)
+        if isinstance(permissions_table, PermissionStore):
+            self._verifier = permissions_table
+        else:
+            self._verifier = PermissionStore(permissions_table)
         self.active_connections = []
         self.address = address
         self.port = port
         self.callback = callback
+        self.batch_callback = batch_callback
+        self.metrics = metrics
+        self.tracer = tracer
+        self.handshake_workers = handshake_workers or cpu_count() or 1
+        self.handshake_timeout = handshake_timeout
 
         # initialize SSL Context
         self._ssl_context = SSL.Context(SSL.TLSv1_METHOD)
@@ -255,28 +395,76 @@ class CollectorDispatcher(Thread):
         self._server = SSL.Connection(self._ssl_context,
                                       socket(AF_INET, SOCK_STREAM))
         self._server.bind((self.address, self.port))
-        self._server.listen(5)
+        self._server.listen(SOMAXCONN)
         logging.debug("starting CollectorDispatcher")
+        pool = HandshakePool(self.handshake_workers, self._connected,
+                             timeout=self.handshake_timeout,
+                             metrics=self.metrics, role='collector')
+        try:
+            pool.accept_from(self._server, lambda: self.running)
+        except KeyboardInterrupt:
+            self.running = False
+
+    def _connected(self, conn, resource_matcher):
+        """
+        Start a `SimpleCollector` for a connection that completed the
+        handshake. Runs on the handshake pool.
+        """
+        col = SimpleCollector(connection=conn,
+                              allowed_resources=resource_matcher.resources,
+                              resource_matcher=resource_matcher,
+                              notification_callback=self.callback,
+                              batch_callback=self.batch_callback,
+                              metrics=self.metrics,
+                              tracer=self.tracer)
+        col.start()
 
-        while self.running:
-            try:
-                conn, addr = self._server.accept()
-                logging.debug("incoming connection from %s" % str(addr))
-                self._verifier.in_use.acquire()
-                conn.do_handshake()
-                allowed_resources = self._verifier.permitted_resources
-                self._verifier.reset()
-                self._verifier.in_use.release()
-
-                col = SimpleCollector(connection=conn,
-                                      allowed_resources=allowed_resources,
-                                      notification_callback=self.callback)
-                col.start()
-
-            except KeyboardInterrupt:
-                self.running = False
-            except SSL.Error:
-                self._verifier.reset()
-                self._verifier.in_use.release()
-            except OSError:
-                pass
+
+class AsyncCollectorDispatcher(CollectorDispatcher):
+    """
+    Serves all push clients on a single asyncio event loop instead of
+    spawning a thread per connection.
+
+    `serve()` can be run on an existing event loop; `start()` runs it on a
+    new event loop in a separate thread.
+    """
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Accept connections until cancelled
+        """
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self.address, self.port)
+        logging.debug("starting AsyncCollectorDispatcher")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        logging.debug("incoming connection from %s" %
+                      str(writer.get_extra_info('peername')))
+        stream = TLSStream(self._ssl_context, reader, writer)
+        started = perf_counter()
+        try:
+            await asyncio.wait_for(stream.do_handshake(),
+                                   self.handshake_timeout)
+        except (SSL.Error, EOFError, OSError, asyncio.TimeoutError):
+            handshake_done(self.metrics, 'collector', started, False)
+            stream.close()
+            return
+        resource_matcher = stream.connection.get_app_data()
+        handshake_done(self.metrics, 'collector', started,
+                       resource_matcher is not None)
+        if resource_matcher is None:
+            stream.close()
+            return
+
+        col = AsyncCollector(stream=stream,
+                             allowed_resources=resource_matcher.resources,
+                             resource_matcher=resource_matcher,
+                             notification_callback=self.callback,
+                             batch_callback=self.batch_callback,
+                             metrics=self.metrics,
+                             tracer=self.tracer)
+        await col.run()
@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+# The regex checks below look at the pattern as parsed by the private
+# parser of the `re` module. It has moved before and may go away, the
+# checks are skipped then.
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    try:
+        import sre_parse
+    except ImportError:
+        sre_parse = None
+
+
+#: keys a filter dict in a SubscribeMessage may contain
+FILTER_KEYS = ('min_urgency', 'max_urgency', 'subject_prefix',
+               'subject_regex', 'data_keys')
+
+#: longest `subject_regex` a subscriber may send
+MAX_REGEX_LENGTH = 256
+
+#: `subject_regex` only sees this many characters of the subject, which
+#: bounds the time a single match can take
+MAX_MATCH_LENGTH = 256
+
+#: unbounded repetitions a `subject_regex` may go through one after another
+MAX_REPETITIONS = 2
+
+
+def _subpatterns(value):
+    """
+    Subpatterns in the argument of a parsed regex opcode
+    """
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _subpatterns(item)
+
+
+def _unbounded(op, av):
+    return op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and \
+        av[1] == sre_parse.MAXREPEAT
+
+
+def backtracks_exponentially(pattern, repeated=False):
+    """
+    Whether a parsed regex has an unbounded repetition that contains
+    another unbounded repetition or an alternation, like `(a+)+` or
+    `(a|ab)*`. Matching those can take exponential time in the length of
+    the subject.
+
+    This is a heuristic, it doesn't catch every pattern that is slow to
+    match and rejects some that aren't.
+
+    Args:
+        pattern: regex as returned by `sre_parse.parse()`
+        repeated(bool): `pattern` is inside an unbounded repetition
+    """
+    for op, av in pattern:
+        inner = repeated
+        if _unbounded(op, av):
+            if repeated:
+                return True
+            inner = True
+        elif op == sre_parse.BRANCH and repeated:
+            return True
+        for subpattern in _subpatterns(av):
+            if backtracks_exponentially(subpattern, inner):
+                return True
+    return False
+
+
+def repetitions(pattern):
+    """
+    Number of unbounded repetitions a match of a parsed regex can go
+    through one after another, like the three of `\\d+\\d+\\d+$`.
+    Matching takes up to polynomial time in the length of the subject,
+    with this number as the degree.
+
+    Args:
+        pattern: regex as returned by `sre_parse.parse()`
+    """
+    count = 0
+    for op, av in pattern:
+        if op == sre_parse.BRANCH:
+            count += max(repetitions(branch) for branch in av[1])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            inner = repetitions(av[2])
+            if _unbounded(op, av):
+                count += inner + 1
+            else:
+                count += inner * av[1]
+        else:
+            count += sum(repetitions(subpattern)
+                         for subpattern in _subpatterns(av))
+    return count
+
+
+class NotificationFilter:
+    """
+    Compiled filter of a subscription. A notification passes if it
+    satisfies every predicate that has been set.
+    """
+    def __init__(self, min_urgency=None, max_urgency=None,
+                 subject_prefix=None, subject_regex=None, data_keys=None):
+        """
+        Compile a filter
+
+        Args:
+            min_urgency(int): lowest urgency that passes
+            max_urgency(int): highest urgency that passes
+            subject_prefix(str): subject has to start with this
+            subject_regex(str): regular expression that has to match the
+                beginning of the subject. Filters run while notifications
+                are routed, so only the first `MAX_MATCH_LENGTH` characters
+                of the subject are matched, and regexes that are likely to
+                be slow are rejected on a best-effort basis, see
+                :func:`backtracks_exponentially` and :func:`repetitions`.
+            data_keys(list): keys that have to be present in the data of
+                the notification
+
+        Raises:
+            :class:`ValueError` if any of the predicates is invalid.
+        """
+        for bound in (min_urgency, max_urgency):
+            if bound is not None and type(bound) not in (int, float):
+                raise ValueError('urgency bounds must be numbers')
+        if subject_prefix is not None and type(subject_prefix) is not str:
+            raise ValueError('subject_prefix must be a str')
+        if data_keys is not None and (
+                type(data_keys) is not list or
+                any(type(key) is not str for key in data_keys)):
+            raise ValueError('data_keys must be a list of str')
+        self.min_urgency = min_urgency
+        self.max_urgency = max_urgency
+        self.subject_prefix = subject_prefix
+        self.data_keys = data_keys
+        self.subject_regex = subject_regex
+        self._regex = None
+        if subject_regex is not None:
+            if type(subject_regex) is not str:
+                raise ValueError('invalid subject_regex')
+            if len(subject_regex) > MAX_REGEX_LENGTH:
+                raise ValueError('subject_regex is too long')
+            try:
+                self._regex = re.compile(subject_regex)
+            except (re.error, RecursionError):
+                raise ValueError('invalid subject_regex')
+            if sre_parse is not None:
+                self._check_regex(sre_parse.parse(subject_regex))
+
+    @staticmethod
+    def _check_regex(parsed):
+        """
+        Reject a parsed `subject_regex` that is likely to be slow to match
+        """
+        if backtracks_exponentially(parsed):
+            raise ValueError('subject_regex must not repeat a '
+                             'repetition or an alternation')
+        if repetitions(parsed) > MAX_REPETITIONS:
+            raise ValueError('subject_regex has too many repetitions')
+
+    @classmethod
+    def from_dict(cls, filter_dict):
+        """
+        Compile the filter dict of a SubscribeMessage
+
+        Returns:
+            :class:`NotificationFilter` or `None` if the dict is empty
+        """
+        if not filter_dict:
+            return None
+        if type(filter_dict) is not dict:
+            raise ValueError('filters must be a dict')
+        unknown = set(filter_dict) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError('unknown filters: %s'
+                             % ', '.join(sorted(unknown)))
+        return cls(**filter_dict)
+
+    def __call__(self, notification):
+        """
+        Check a notification
+
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to check
+
+        Returns:
+            `True` if the notification passes
+        """
+        # pushers aren't forced to send sane types, anything unexpected
+        # fails the predicates that look at it
+        urgency = notification.urgency
+        if self.min_urgency is not None or self.max_urgency is not None:
+            if type(urgency) not in (int, float):
+                return False
+            if self.min_urgency is not None and urgency < self.min_urgency:
+                return False
+            if self.max_urgency is not None and urgency > self.max_urgency:
+                return False
+        subject = notification.subject
+        if self.subject_prefix is not None or self._regex is not None:
+            if type(subject) is not str:
+                return False
+            if self.subject_prefix is not None and \
+                    not subject.startswith(self.subject_prefix):
+                return False
+            if self._regex is not None and \
+                    not self._regex.match(subject, 0, MAX_MATCH_LENGTH):
+                return False
+        if self.data_keys is not None:
+            data = notification.data
+            if type(data) is not dict:
+                return False
+            for key in self.data_keys:
+                if key not in data:
+                    return False
+        return True
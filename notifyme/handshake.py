@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from select import select
+from threading import BoundedSemaphore
+from time import monotonic, perf_counter, sleep
+
+from OpenSSL import SSL
+
+
+#: Seconds a client gets to complete the TLS handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+#: Seconds to wait before accepting again after `accept()` failed
+ACCEPT_BACKOFF = 0.1
+
+
+def handshake(connection, timeout=HANDSHAKE_TIMEOUT):
+    """
+    Perform the TLS handshake of an accepted connection, giving up after
+    `timeout` seconds in total. A client that connects and doesn't
+    finish the handshake could otherwise block a handshake worker forever.
+
+    The socket is switched to non-blocking mode for the handshake and back
+    to blocking mode afterwards.
+
+    Args:
+        connection(:class:`OpenSSL.SSL.Connection`): accepted connection
+        timeout(float): seconds, `None` to wait forever
+
+    Raises:
+        :class:`OpenSSL.SSL.Error` if the handshake failed,
+        :class:`TimeoutError` if it took too long.
+    """
+    if timeout is None:
+        connection.do_handshake()
+        return
+    deadline = monotonic() + timeout
+    connection.setblocking(False)
+    try:
+        while True:
+            try:
+                connection.do_handshake()
+                return
+            except SSL.WantReadError:
+                readable, writable = [connection], []
+            except SSL.WantWriteError:
+                readable, writable = [], [connection]
+            remaining = deadline - monotonic()
+            if remaining <= 0 or \
+                    not any(select(readable, writable, [], remaining)):
+                raise TimeoutError("TLS handshake timed out")
+    finally:
+        connection.setblocking(True)
+
+
+def handshake_done(metrics, role, started, accepted):
+    """
+    Record the duration of a handshake started at `started`, or its failure
+
+    Args:
+        metrics(:class:`notifyme.metrics.ServerMetrics`): metrics to
+            update, may be `None`
+        role(str): `publisher` or `collector`
+        started(float): `time.perf_counter()` when the handshake started
+        accepted(bool): the handshake succeeded and the client's
+            certificate is permitted
+    """
+    if metrics is None:
+        return
+    if accepted:
+        metrics.handshake_seconds.labels(role).observe(
+            perf_counter() - started)
+    else:
+        metrics.handshake_failures.labels(role).inc()
+
+
+class HandshakePool:
+    """
+    Accepts connections on a listening :class:`OpenSSL.SSL.Connection`
+    and performs their TLS handshakes on a pool of threads. Accepting stops
+    while all workers are busy.
+    """
+    def __init__(self, workers, connected, timeout=HANDSHAKE_TIMEOUT,
+                 metrics=None, role=None):
+        """
+        Args:
+            workers(int): number of handshakes performed in parallel
+            connected(callable): called on the pool with the connection and
+                the :class:`notifyme.resources.ResourceMatcher` of the
+                client's permissions after a successful handshake
+            timeout(float): seconds a client gets to complete the handshake
+            metrics(:class:`notifyme.metrics.ServerMetrics`): metrics to
+                update, optional
+            role(str): label of the handshake metrics
+        """
+        self.connected = connected
+        self.timeout = timeout
+        self.metrics = metrics
+        self.role = role
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = BoundedSemaphore(workers)
+
+    def accept_from(self, server, running):
+        """
+        Accept connections from `server` as long as `running()` is true.
+
+        If accepting fails, e.g. because the process ran out of file
+        descriptors, the error is logged and the next attempt waits
+        `ACCEPT_BACKOFF` seconds instead of retrying right away.
+        """
+        try:
+            while running():
+                try:
+                    conn, addr = server.accept()
+                except OSError as e:
+                    logging.warning("accepting a connection failed: %s" % e)
+                    sleep(ACCEPT_BACKOFF)
+                    continue
+                logging.debug("incoming connection from %s" % str(addr))
+                self._slots.acquire()
+                self._pool.submit(self._handshake, conn)
+        finally:
+            self._pool.shutdown(wait=False)
+
+    def _handshake(self, conn):
+        """
+        Perform the handshake on `conn` and hand it to `connected`. Runs on
+        the pool.
+        """
+        started = perf_counter()
+        try:
+            handshake(conn, self.timeout)
+            resource_matcher = conn.get_app_data()
+            handshake_done(self.metrics, self.role, started,
+                           resource_matcher is not None)
+            if resource_matcher is None:
+                conn.close()
+                return
+            self.connected(conn, resource_matcher)
+        except (SSL.Error, OSError):
+            logging.debug("TLS handshake failed")
+            handshake_done(self.metrics, self.role, started, False)
+            conn.close()
+        finally:
+            self._slots.release()
@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Queryable history of notifications, stored in SQLite.
+
+Next to the notifications themselves, every prefix of a notification's
+resource is indexed together with the notification's timestamp, so asking
+for everything under `/irc/highlights` in a given week is a single range
+scan over an index.
+"""
+
+import json
+import logging
+import sqlite3
+from collections import deque
+from threading import Thread, Condition, local
+from time import time, monotonic
+
+from notifyme.messages import NotificationMessage
+from notifyme.resources import convert_to_path
+
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY,
+        timestamp REAL NOT NULL,
+        resource TEXT NOT NULL,
+        notification TEXT NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS resource_prefixes (
+        prefix TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        notification INTEGER NOT NULL,
+        PRIMARY KEY (prefix, timestamp, notification)) WITHOUT ROWID''',
+]
+
+
+def resource_prefixes(resource):
+    """
+    Index keys of `resource` and all of its parents
+
+    Args:
+        resource(str): resource
+
+    Returns:
+        list of strings, starting with the root resource
+    """
+    path = convert_to_path(resource)
+    return ['/'.join(path[:depth]) for depth in range(len(path) + 1)]
+
+
+class NotificationHistory:
+    """
+    Stores notifications in an SQLite database in WAL mode.
+
+    Notifications are written by a background thread in batches of up to
+    `batch_size`, at the latest `flush_interval` seconds after they have
+    been added. Queries use a connection per thread and don't block the
+    writer.
+    """
+    #: upper bound for the number of notifications returned by one query
+    MAX_LIMIT = 500
+
+    def __init__(self, path, batch_size=500, flush_interval=0.5):
+        """
+        Open or create the database
+
+        Args:
+            path(str): database file
+            batch_size(int): maximum number of notifications written in
+                one transaction
+            flush_interval(float): maximum number of seconds a notification
+                waits before it is written
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.closed = False
+        self._local = local()
+        self._pending = deque()
+        self._added = 0
+        self._written = 0
+        self._changed = Condition()
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+        self._writer = Thread(target=self._write_pending, daemon=True)
+        self._writer.start()
+
+    def _connection(self):
+        """
+        Connection of the calling thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def add(self, notification, timestamp=None):
+        """
+        Queue a notification to be stored. Never blocks.
+
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to store
+            timestamp(float): time of arrival, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time()
+        text = json.dumps(NotificationMessage(notification,
+                                              timestamp=timestamp).data)
+        with self._changed:
+            if self.closed:
+                return
+            self._pending.append((timestamp, notification.resource, text))
+            self._added += 1
+            self._changed.notify_all()
+
+    def _write_pending(self):
+        """
+        Writer thread: store queued notifications in batches
+        """
+        connection = self._connection()
+        while True:
+            with self._changed:
+                while not self._pending and not self.closed:
+                    self._changed.wait()
+                if not self._pending:
+                    break
+                # give the batch a chance to fill up
+                deadline = monotonic() + self.flush_interval
+                while len(self._pending) < self.batch_size and \
+                        not self.closed:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                batch = [self._pending.popleft() for _ in
+                         range(min(self.batch_size, len(self._pending)))]
+            try:
+                with connection:
+                    for timestamp, resource, text in batch:
+                        cursor = connection.execute(
+                            'INSERT INTO notifications (timestamp, resource, '
+                            'notification) VALUES (?, ?, ?)',
+                            (timestamp, resource, text))
+                        connection.executemany(
+                            'INSERT INTO resource_prefixes (prefix, '
+                            'timestamp, notification) VALUES (?, ?, ?)',
+                            [(prefix, timestamp, cursor.lastrowid)
+                             for prefix in resource_prefixes(resource)])
+            except sqlite3.Error as e:
+                logging.error("could not store notifications: %s" % str(e))
+            with self._changed:
+                self._written += len(batch)
+                self._changed.notify_all()
+        connection.close()
+
+    def flush(self):
+        """
+        Wait until everything added so far has been written
+        """
+        with self._changed:
+            target = self._added
+            self._changed.notify_all()
+            while self._written < target and self._writer.is_alive():
+                self._changed.wait(self.flush_interval)
+
+    def query(self, resource, since=None, until=None, limit=100,
+              cursor=None):
+        """
+        Stored notifications of `resource` and its subresources, oldest
+        first
+
+        Args:
+            resource(str): resource prefix
+            since(float): UNIX time of the oldest notification
+            until(float): UNIX time of the newest notification
+            limit(int): page size, at most `MAX_LIMIT`
+            cursor(list): cursor returned for the previous page
+
+        Returns:
+            tuple of a list of notification dicts and the cursor of the next
+            page, which is `None` on the last page
+        """
+        limit = max(1, min(limit, self.MAX_LIMIT))
+        conditions = ['p.prefix = ?']
+        params = ['/'.join(convert_to_path(resource))]
+        if since is not None:
+            conditions.append('p.timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('p.timestamp <= ?')
+            params.append(until)
+        if cursor is not None:
+            conditions.append('(p.timestamp, p.notification) > (?, ?)')
+            params.extend(cursor)
+        params.append(limit)
+
+        rows = self._connection().execute(
+            'SELECT p.timestamp, p.notification, n.notification '
+            'FROM resource_prefixes p '
+            'JOIN notifications n ON n.id = p.notification '
+            'WHERE ' + ' AND '.join(conditions) + ' '
+            'ORDER BY p.timestamp, p.notification LIMIT ?',
+            params).fetchall()
+
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = [rows[-1][0], rows[-1][1]]
+        return [json.loads(row[2]) for row in rows], next_cursor
+
+    def close(self):
+        """
+        Write everything that is still queued and stop the writer thread
+        """
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+        self._writer.join()
@@ -0,0 +1,512 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Durable, append-only log of notifications.
+
+The log is a directory of segment files. Each segment has a fixed size and
+is named after the sequence number of its first record. A record looks
+like this (all integers big-endian)::
+
+    length     uint32   size of the whole record
+    checksum   uint32   crc32 of resource and frame
+    sequence   uint64
+    timestamp  float64
+    res_len    uint16   length of the resource
+    resource   utf-8
+    frame      the notification exactly as it is sent over the wire
+
+Segments are read through `mmap`, so replaying hands out slices of the
+mapped files without copying or parsing them.
+
+The file `epoch` holds a random string that changes whenever the sequence
+numbers start over, that is whenever the log is opened without any
+segments.
+"""
+
+import os
+import logging
+from array import array
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from threading import RLock, Thread, Event
+from time import time
+from uuid import uuid4
+from zlib import crc32
+
+from notifyme.messages import NotificationMessage, WrappedProtocolMessage, \
+    FRAME_HEADER
+from notifyme.resources import ResourceMatcher
+
+
+RECORD_HEADER = Struct('>IIQdH')
+
+SEGMENT_SUFFIX = '.seg'
+
+EPOCH_FILE = 'epoch'
+
+
+#: seconds between two runs of the background thread if the log isn't
+#: synced on an interval
+EXPIRE_INTERVAL = 1.0
+
+
+def sync_file(fd):
+    """
+    Make sure the data written to file descriptor `fd` is on disk
+    """
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def sync_directory(path):
+    """
+    Make sure files created in or removed from directory `path` stay so
+    after a crash
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StoredNotification:
+    """
+    A notification read from the log. Behaves like an
+    :class:`notifyme.messages.EncodedMessage`, but `frame` is a slice of the
+    mapped segment and the message is only parsed when asked for.
+    """
+    __slots__ = ('sequence', 'timestamp', 'resource', 'frame')
+
+    def __init__(self, sequence, timestamp, resource, frame):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.resource = resource
+        self.frame = frame
+
+    @property
+    def message(self):
+        """
+        The stored :class:`notifyme.messages.NotificationMessage`
+        """
+        return WrappedProtocolMessage.parse(
+            bytes(self.frame[FRAME_HEADER.size:]))
+
+
+class Segment:
+    """
+    A single segment file and an index of the records in it
+    """
+    def __init__(self, path, first_sequence, capacity):
+        """
+        Open or create a segment
+
+        Args:
+            path(str): file name
+            first_sequence(int): sequence number of the first record
+            capacity(int): size of the file in bytes
+        """
+        self.path = path
+        self.first_sequence = first_sequence
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.capacity = max(capacity, os.fstat(self.fd).st_size)
+        os.ftruncate(self.fd, self.capacity)
+        self.map = mmap(self.fd, self.capacity, access=ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.offsets = array('Q')
+        self.timestamps = array('d')
+        self.size = 0
+        self._recover()
+
+    def _recover(self):
+        """
+        Index all complete records, everything after the first incomplete
+        or corrupt record is considered garbage from an interrupted write.
+        """
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.capacity:
+            length, checksum, sequence, timestamp, res_len = \
+                RECORD_HEADER.unpack_from(self.map, offset)
+            end = offset + length
+            if length <= RECORD_HEADER.size or end > self.capacity or \
+                    sequence != self.first_sequence + len(self.offsets) or \
+                    crc32(self.view[offset + RECORD_HEADER.size:end]) != \
+                    checksum:
+                break
+            self.offsets.append(offset)
+            self.timestamps.append(timestamp)
+            offset = end
+        self.size = offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def last_sequence(self):
+        return self.first_sequence + len(self.offsets) - 1
+
+    @property
+    def last_timestamp(self):
+        return self.timestamps[-1] if self.timestamps else 0.0
+
+    def fits(self, length):
+        return self.size + length <= self.capacity
+
+    def append(self, sequence, timestamp, resource, frame):
+        """
+        Write a record at the end of the segment
+        """
+        body = resource + frame
+        header = RECORD_HEADER.pack(RECORD_HEADER.size + len(body),
+                                    crc32(body), sequence, timestamp,
+                                    len(resource))
+        os.pwrite(self.fd, header + body, self.size)
+        self.offsets.append(self.size)
+        self.timestamps.append(timestamp)
+        self.size += len(header) + len(body)
+
+    def sync(self):
+        sync_file(self.fd)
+
+    def record(self, i):
+        """
+        The `i`-th record of this segment
+
+        Returns:
+            :class:`StoredNotification`
+        """
+        offset = self.offsets[i]
+        length, _, sequence, timestamp, res_len = \
+            RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        resource = str(self.view[start:start + res_len], 'utf-8')
+        return StoredNotification(sequence, timestamp, resource,
+                                  self.view[start + res_len:offset + length])
+
+    def first_after(self, sequence=None, timestamp=None):
+        """
+        Index of the first record after `sequence` and not older than
+        `timestamp`
+        """
+        first = 0
+        if sequence is not None:
+            first = max(first, sequence + 1 - self.first_sequence)
+        if timestamp is not None:
+            lo, hi = first, len(self.timestamps)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.timestamps[mid] < timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            first = lo
+        return first
+
+    def close(self):
+        """
+        Close the file. The mapping stays valid as long as slices of it are
+        in use.
+        """
+        self.view.release()
+        os.close(self.fd)
+
+    def delete(self):
+        self.close()
+        os.unlink(self.path)
+
+
+class NotificationLog:
+    """
+    Durable store of all notifications, can be used as the backlog of a
+    :class:`notifyme.publisher.PublisherDispatcher`.
+
+    Writes are synced to disk every `fsync_every` records or every
+    `fsync_interval` seconds, whichever comes first. The syncs run on a
+    background thread, so appending never waits for the disk, and the last
+    records are synced even if nothing is appended afterwards. Whole
+    segments are deleted once all of their records are older than
+    `max_age` seconds or the log grows beyond `max_bytes`, the background
+    thread checks that as well.
+    """
+    def __init__(self, path, segment_size=64 * 1024 * 1024, max_bytes=None,
+                 max_age=None, fsync_every=100, fsync_interval=1.0):
+        """
+        Open the log in directory `path`, creating it if necessary
+
+        Args:
+            path(str): directory holding the segment files
+            segment_size(int): size of a segment file in bytes
+            max_bytes(int): maximum size of all segments, `None` for no
+                limit
+            max_age(float): seconds after which notifications are deleted,
+                `None` to keep them
+            fsync_every(int): sync after this many records, 0 to leave it
+                to the operating system
+            fsync_interval(float): sync at least this often, in seconds
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = RLock()
+        self._unsynced = 0
+        self._sync_requested = Event()
+        self._closed = Event()
+
+        os.makedirs(path, exist_ok=True)
+        self._segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._segments.append(Segment(
+                    os.path.join(path, name),
+                    int(name[:-len(SEGMENT_SUFFIX)]), segment_size))
+        if self._segments:
+            self.sequence = self._segments[-1].last_sequence
+        else:
+            self.sequence = 0
+        self.epoch = self._load_epoch(renew=not self._segments)
+        logging.debug("opened notification log %s at sequence %d"
+                      % (path, self.sequence))
+        self.expire()
+        Thread(target=self._sync_periodically, daemon=True).start()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(s) for s in self._segments)
+
+    def _load_epoch(self, renew):
+        """
+        Read the epoch of the sequence numbers, or start a new one
+        """
+        path = os.path.join(self.path, EPOCH_FILE)
+        if not renew:
+            try:
+                with open(path) as f:
+                    epoch = f.read().strip()
+                if epoch:
+                    return epoch
+            except FileNotFoundError:
+                pass
+        epoch = uuid4().hex
+        with open(path + '.tmp', 'w') as f:
+            f.write(epoch)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        sync_directory(self.path)
+        return epoch
+
+    @property
+    def size(self):
+        """
+        Bytes used by records in all segments
+        """
+        with self.lock:
+            return sum(s.size for s in self._segments)
+
+    def _new_segment(self, first_sequence, length):
+        name = '%020d%s' % (first_sequence, SEGMENT_SUFFIX)
+        segment = Segment(os.path.join(self.path, name), first_sequence,
+                          max(self.segment_size, length))
+        sync_directory(self.path)
+        self._segments.append(segment)
+        return segment
+
+    def append(self, notification, timestamp=None):
+        """
+        Number, encode and store a notification
+
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to store
+            timestamp(float): time of arrival, defaults to now
+
+        Returns:
+            :class:`notifyme.messages.EncodedMessage` of the
+            :class:`notifyme.messages.NotificationMessage` carrying the
+            sequence number and timestamp
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self.lock:
+            encoded = self._append(notification, timestamp)
+            self._appended(1)
+            return encoded
+
+    def extend(self, notifications, timestamp=None):
+        """
+        Number, encode and store several notifications at once, e.g. the
+        content of a :class:`notifyme.messages.NotificationBatchMessage`
+
+        Args:
+            notifications(list): :class:`notifyme.notification.Notification`
+                objects to store
+            timestamp(float): time of arrival, defaults to now
+
+        Returns:
+            list of :class:`notifyme.messages.EncodedMessage`, one per
+            notification
+        """
+        if timestamp is None:
+            timestamp = time()
+        with self.lock:
+            encoded = [self._append(notification, timestamp)
+                       for notification in notifications]
+            self._appended(len(encoded))
+            return encoded
+
+    def _append(self, notification, timestamp):
+        """
+        Write a single record. Must be called with the lock held.
+        """
+        resource = notification.resource.encode('utf-8')
+        sequence = self.sequence + 1
+        encoded = NotificationMessage(notification, sequence=sequence,
+                                      timestamp=timestamp).encoded
+        length = RECORD_HEADER.size + len(resource) + len(encoded.frame)
+        if self._segments and self._segments[-1].fits(length):
+            segment = self._segments[-1]
+        else:
+            if self._segments:
+                self._segments[-1].sync()
+            segment = self._new_segment(sequence, length)
+            self.expire(timestamp)
+        segment.append(sequence, timestamp, resource, encoded.frame)
+        self.sequence = sequence
+        return encoded
+
+    def _appended(self, count):
+        """
+        Count `count` new records and have the background thread sync if
+        enough of them piled up. Must be called with the lock held.
+        """
+        self._unsynced += count
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self._sync_requested.set()
+
+    def sync(self):
+        """
+        Make sure everything appended so far is on disk. The lock is not
+        held while waiting for the disk, appending goes on in the meantime.
+        """
+        with self.lock:
+            if not self._segments or not self._unsynced:
+                return
+            self._unsynced = 0
+            # the segment may be closed while we wait for the disk
+            fd = os.dup(self._segments[-1].fd)
+        try:
+            sync_file(fd)
+        finally:
+            os.close(fd)
+
+    def _sync_periodically(self):
+        """
+        Background thread: sync whenever `fsync_every` records have been
+        appended and every `fsync_interval` seconds, and delete expired
+        segments
+        """
+        interval = self.fsync_interval or EXPIRE_INTERVAL
+        while True:
+            self._sync_requested.wait(interval)
+            self._sync_requested.clear()
+            if self._closed.is_set():
+                break
+            if self.fsync_every:
+                self.sync()
+            self.expire()
+
+    def expire(self, now=None):
+        """
+        Delete segments that are too old or exceed the size limit. The
+        segment currently written to is never deleted.
+        """
+        if now is None:
+            now = time()
+        with self.lock:
+            total = sum(s.size for s in self._segments)
+            while len(self._segments) > 1:
+                oldest = self._segments[0]
+                too_big = self.max_bytes is not None and \
+                    total > self.max_bytes
+                too_old = self.max_age is not None and \
+                    oldest.last_timestamp < now - self.max_age
+                if not (too_big or too_old):
+                    break
+                logging.debug("deleting log segment %s" % oldest.path)
+                total -= oldest.size
+                oldest.delete()
+                del self._segments[0]
+
+    def replay(self, resources, since_sequence=None, since_timestamp=None,
+               limit=None):
+        """
+        Stored notifications of `resources` and their subresources
+
+        Args:
+            resources(list): resources, each as a string
+            since_sequence(int): only notifications with a higher sequence
+                number
+            since_timestamp(float): only notifications that arrived at or
+                after this time
+            limit(int): only the oldest `limit` notifications, `None` for
+                all of them
+
+        Returns:
+            list of :class:`StoredNotification`, ordered by sequence number
+        """
+        matcher = ResourceMatcher(resources)
+        if self.max_age is not None:
+            oldest = time() - self.max_age
+            if since_timestamp is None or since_timestamp < oldest:
+                since_timestamp = oldest
+        result = []
+        with self.lock:
+            for segment in self._segments:
+                if since_sequence is not None and \
+                        segment.last_sequence <= since_sequence:
+                    continue
+                if since_timestamp is not None and \
+                        segment.last_timestamp < since_timestamp:
+                    continue
+                for i in range(segment.first_after(since_sequence,
+                                                   since_timestamp),
+                               len(segment)):
+                    record = segment.record(i)
+                    if matcher.matches(record.resource):
+                        result.append(record)
+                        if len(result) == limit:
+                            return result
+        return result
+
+    def close(self):
+        """
+        Sync and close all segments
+        """
+        self._closed.set()
+        self._sync_requested.set()
+        with self.lock:
+            self.sync()
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
@@ -17,8 +17,42 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+from struct import Struct
 
 from notifyme.notification import Notification
+from notifyme.tracing import Trace
+
+
+#: Every frame on the wire starts with its payload length as an unsigned
+#: 32 bit big-endian integer.
+FRAME_HEADER = Struct('>I')
+
+#: Frames larger than this are considered a protocol violation.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+#: Number of bytes requested from the connection per read.
+READ_SIZE = 64 * 1024
+
+
+class FrameError(ValueError):
+    """
+    Raised if the peer violates the framing, the connection can't be used
+    any longer afterwards.
+    """
+    pass
+
+
+def encode_frame(payload):
+    """
+    Prefix `payload` with its length so it can be sent over the wire.
+
+    Args:
+        payload(bytes): encoded message
+
+    Returns:
+        bytes
+    """
+    return FRAME_HEADER.pack(len(payload)) + payload
 
 
 class ProtocolMessage:
@@ -42,12 +76,22 @@ class ProtocolMessage:
     def wrapped(self):
         return WrappedProtocolMessage(self)
 
+    @property
+    def encoded(self):
+        return EncodedMessage(self)
+
 
 class PublishMessage(ProtocolMessage):
     """
     Announce published resources to the subscriber
     """
-    def __init__(self, published_resources):
+    def __init__(self, published_resources, epoch=None):
+        """
+        Args:
+            published_resources(list): resources, each as a string
+            epoch(str): identifies the publisher's sequence numbers, it
+                changes whenever the numbering starts over
+        """
         ProtocolMessage.__init__(self)
         if type(published_resources) is not list:
             raise ValueError('published_resources must be a list of str')
@@ -56,17 +100,40 @@ class PublishMessage(ProtocolMessage):
                 raise ValueError('published_resources must be a list of str')
 
         self.data['published_resources'] = published_resources
+        if epoch is not None:
+            if type(epoch) is not str:
+                raise ValueError('epoch must be a str')
+            self.data['epoch'] = epoch
 
     @classmethod
     def from_dict(cls, message_dict):
-        return cls(message_dict['published_resources'])
+        return cls(message_dict['published_resources'],
+                   epoch=message_dict.get('epoch'))
+
+    @property
+    def epoch(self):
+        """
+        Epoch of the publisher's sequence numbers, if it numbers them
+        """
+        return self.data.get('epoch')
 
 
 class SubscribeMessage(ProtocolMessage):
     """
     Subscribe to notifications from publisher
     """
-    def __init__(self, subscribed_resources):
+    def __init__(self, subscribed_resources, since_sequence=None,
+                 since_timestamp=None, filters=None):
+        """
+        Args:
+            subscribed_resources(list): resources, each as a string
+            since_sequence(int): ask the publisher to replay all backlogged
+                notifications with a higher sequence number first
+            since_timestamp(float): ask the publisher to replay all
+                backlogged notifications since this UNIX time first
+            filters(dict): only send notifications matching these
+                predicates, see :class:`notifyme.filters.NotificationFilter`
+        """
         ProtocolMessage.__init__(self)
         if type(subscribed_resources) is not list:
             raise ValueError('subscribed_resources must be a list of str')
@@ -75,10 +142,49 @@ class SubscribeMessage(ProtocolMessage):
                 raise ValueError('subscribed_resources must be a list of str')
 
         self.data['subscribed_resources'] = subscribed_resources
+        if since_sequence is not None:
+            self.data['since_sequence'] = int(since_sequence)
+        if since_timestamp is not None:
+            self.data['since_timestamp'] = float(since_timestamp)
+        if filters:
+            if type(filters) is not dict:
+                raise ValueError('filters must be a dict')
+            self.data['filters'] = filters
 
     @classmethod
     def from_dict(cls, message_dict):
-        return cls(message_dict['subscribed_resources'])
+        return cls(message_dict['subscribed_resources'],
+                   since_sequence=message_dict.get('since_sequence'),
+                   since_timestamp=message_dict.get('since_timestamp'),
+                   filters=message_dict.get('filters'))
+
+    @property
+    def wants_replay(self):
+        """
+        Whether the subscriber asked for backlogged notifications
+        """
+        return 'since_sequence' in self.data or \
+            'since_timestamp' in self.data
+
+
+class UnsubscribeMessage(ProtocolMessage):
+    """
+    Stop receiving notifications of some resources
+    """
+    def __init__(self, unsubscribed_resources):
+        ProtocolMessage.__init__(self)
+        if type(unsubscribed_resources) is not list:
+            raise ValueError('unsubscribed_resources must be a list of str')
+        for element in unsubscribed_resources:
+            if type(element) is not str:
+                raise ValueError(
+                    'unsubscribed_resources must be a list of str')
+
+        self.data['unsubscribed_resources'] = unsubscribed_resources
+
+    @classmethod
+    def from_dict(cls, message_dict):
+        return cls(message_dict['unsubscribed_resources'])
 
 
 class ConfirmationMessage(ProtocolMessage):
@@ -117,7 +223,20 @@ class NotificationMessage(ProtocolMessage):
     """
     Send notifications
     """
-    def __init__(self, notification, notification_dict=None):
+    def __init__(self, notification, notification_dict=None, sequence=None,
+                 timestamp=None, with_trace=False):
+        """
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to send
+            notification_dict(dict): already serialized notification, used
+                instead of `notification`
+            sequence(int): sequence number assigned by the publisher
+            timestamp(float): UNIX time the publisher received the
+                notification
+            with_trace(bool): include the notification's trace. Only push
+                clients send it, the daemon keeps traces to itself.
+        """
         ProtocolMessage.__init__(self)
         if notification is not None and notification_dict is None:
             self.data = {
@@ -126,8 +245,16 @@ class NotificationMessage(ProtocolMessage):
                 'data': notification.data,
                 'resource': notification.resource
             }
+            if with_trace and notification.trace is not None:
+                trace = notification.trace.to_dict()
+                if trace is not None:
+                    self.data['trace'] = trace
         else:
             self.data = notification_dict
+        if sequence is not None:
+            self.data['sequence'] = sequence
+        if timestamp is not None:
+            self.data['timestamp'] = timestamp
 
     @classmethod
     def from_dict(cls, message_dict):
@@ -135,10 +262,123 @@ class NotificationMessage(ProtocolMessage):
 
     @property
     def notification(self):
+        trace = self.data.get('trace')
+        if trace is not None:
+            trace = Trace.from_dict(trace)
         return Notification(data=self.data['data'],
                             urgency=self.data['urgency'],
                             subject=self.data['subject'],
-                            resource=self.data['resource'])
+                            resource=self.data['resource'],
+                            trace=trace)
+
+    @property
+    def sequence(self):
+        """
+        Sequence number assigned by the publisher, if any
+        """
+        return self.data.get('sequence')
+
+    @property
+    def timestamp(self):
+        """
+        Time the publisher received the notification, if known
+        """
+        return self.data.get('timestamp')
+
+
+class NotificationBatchMessage(ProtocolMessage):
+    """
+    Send several notifications at once
+    """
+    def __init__(self, notifications, notification_dicts=None):
+        ProtocolMessage.__init__(self)
+        if notification_dicts is None:
+            notification_dicts = [NotificationMessage(n, with_trace=True).data
+                                  for n in notifications]
+        if type(notification_dicts) is not list:
+            raise ValueError('notifications must be a list')
+
+        self.data['notifications'] = notification_dicts
+
+    def __len__(self):
+        return len(self.data['notifications'])
+
+    @classmethod
+    def from_dict(cls, message_dict):
+        return cls(None, notification_dicts=message_dict['notifications'])
+
+    @property
+    def notifications(self):
+        return [NotificationMessage.from_dict(d).notification
+                for d in self.data['notifications']]
+
+
+class HistoryQueryMessage(ProtocolMessage):
+    """
+    Ask the publisher for stored notifications of a resource and its
+    subresources
+    """
+    def __init__(self, resource, since=None, until=None, limit=100,
+                 cursor=None):
+        """
+        Args:
+            resource(str): resource prefix to query
+            since(float): UNIX time of the oldest notification
+            until(float): UNIX time of the newest notification
+            limit(int): maximum number of notifications in the result, the
+                publisher may return less
+            cursor(list): `cursor` of the previous result to get the next
+                page
+        """
+        ProtocolMessage.__init__(self)
+        if type(resource) is not str:
+            raise ValueError('resource must be a str')
+        if cursor is not None and (type(cursor) is not list or
+                                   len(cursor) != 2):
+            raise ValueError('invalid cursor')
+        self.data['resource'] = resource
+        self.data['since'] = since
+        self.data['until'] = until
+        self.data['limit'] = int(limit)
+        self.data['cursor'] = cursor
+
+    @classmethod
+    def from_dict(cls, message_dict):
+        return cls(message_dict['resource'], since=message_dict['since'],
+                   until=message_dict['until'], limit=message_dict['limit'],
+                   cursor=message_dict['cursor'])
+
+
+class HistoryResultMessage(ProtocolMessage):
+    """
+    One page of stored notifications, oldest first
+    """
+    def __init__(self, notification_dicts, cursor=None):
+        """
+        Args:
+            notification_dicts(list): notifications as dicts, like the data
+                of a :class:`NotificationMessage`
+            cursor(list): pass this to the next
+                :class:`HistoryQueryMessage` to continue, `None` if there
+                are no more results
+        """
+        ProtocolMessage.__init__(self)
+        if type(notification_dicts) is not list:
+            raise ValueError('notifications must be a list')
+        self.data['notifications'] = notification_dicts
+        self.data['cursor'] = cursor
+
+    def __len__(self):
+        return len(self.data['notifications'])
+
+    @classmethod
+    def from_dict(cls, message_dict):
+        return cls(message_dict['notifications'],
+                   cursor=message_dict['cursor'])
+
+    @property
+    def cursor(self):
+        return self.data['cursor']
 
 
 class WrappedProtocolMessage:
@@ -164,13 +404,21 @@ class WrappedProtocolMessage:
         """
         return json.dumps(self.data)
 
+    @property
+    def frame(self):
+        """
+        Length-prefixed representation of the message, ready to be sent over
+        the wire
+        """
+        return encode_frame(self.text.encode('utf-8'))
+
     @classmethod
     def parse(cls, received_bytes):
         """
         Parse received JSON Message
 
         Args:
-            received_bytes(str): Bytes to parse from the message
+            received_bytes(str or bytes): Bytes to parse from the message
 
         Returns:
             :class:`notifyme.messages.ProtocolMessage`
@@ -190,11 +438,212 @@ class WrappedProtocolMessage:
             return PublishMessage.from_dict(message_dict['message'])
         elif message_dict['message_type'] == 'SubscribeMessage':
             return SubscribeMessage.from_dict(message_dict['message'])
+        elif message_dict['message_type'] == 'UnsubscribeMessage':
+            return UnsubscribeMessage.from_dict(message_dict['message'])
         elif message_dict['message_type'] == 'ConfirmationMessage':
             return ConfirmationMessage.from_dict(message_dict['message'])
         elif message_dict['message_type'] == 'ErrorMessage':
             return ErrorMessage.from_dict(message_dict['message'])
         elif message_dict['message_type'] == 'NotificationMessage':
             return NotificationMessage.from_dict(message_dict['message'])
+        elif message_dict['message_type'] == 'NotificationBatchMessage':
+            return NotificationBatchMessage.from_dict(message_dict['message'])
+        elif message_dict['message_type'] == 'HistoryQueryMessage':
+            return HistoryQueryMessage.from_dict(message_dict['message'])
+        elif message_dict['message_type'] == 'HistoryResultMessage':
+            return HistoryResultMessage.from_dict(message_dict['message'])
         else:
             raise TypeError("Unsupported message type")
+
+
+class EncodedMessage:
+    """
+    Immutable, pre-encoded wire frame of a ProtocolMessage.
+
+    Serializing a message is done exactly once when this object is created,
+    afterwards the very same bytes can be handed to any number of
+    connections.
+    """
+    __slots__ = ('_message', '_frame')
+
+    def __init__(self, message):
+        """
+        Serialize `message` into a frame
+
+        Args:
+            message(:class:`notifyme.messages.ProtocolMessage`): message to
+                encode
+        """
+        object.__setattr__(self, '_message', message)
+        object.__setattr__(self, '_frame',
+                           WrappedProtocolMessage(message).frame)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EncodedMessage is immutable")
+
+    @property
+    def message(self):
+        """
+        The message that has been encoded
+        """
+        return self._message
+
+    @property
+    def frame(self):
+        """
+        Length-prefixed bytes, ready to be sent over the wire
+        """
+        return self._frame
+
+    @property
+    def resource(self):
+        """
+        Resource of the encoded notification, `None` for other messages
+        """
+        if type(self._message) is NotificationMessage:
+            return self._message.data['resource']
+        return None
+
+    @property
+    def sequence(self):
+        """
+        Sequence number of the encoded notification, `None` for other
+        messages and notifications that haven't been numbered
+        """
+        if type(self._message) is NotificationMessage:
+            return self._message.sequence
+        return None
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames.
+
+    Received data is collected in a single reusable buffer. One read from the
+    connection may complete several frames; they are handed out one by one
+    without touching the connection again.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, read_size=READ_SIZE):
+        """
+        Initialize an empty decoder
+
+        Args:
+            max_frame_size(int): largest accepted payload in bytes
+            read_size(int): number of bytes to request per read
+        """
+        self.max_frame_size = max_frame_size
+        self.read_size = read_size
+        self._buffer = bytearray(read_size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        """
+        Number of buffered bytes that have not been decoded yet
+        """
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """
+        Make sure there are at least `size` free bytes behind the buffered
+        data, moving it to the front of the buffer or growing the buffer
+        if necessary.
+        """
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start > 0:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        if len(self._buffer) - self._end < size:
+            self._buffer.extend(bytes(size - (len(self._buffer) - self._end)))
+
+    def feed(self, data):
+        """
+        Append received bytes to the buffer
+
+        Args:
+            data(bytes): data received from the peer
+        """
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def read_from(self, connection):
+        """
+        Read once from `connection` directly into the buffer. Blocks as long
+        as the connection doesn't deliver any data.
+
+        Args:
+            connection: socket-like object providing `recv_into`
+
+        Returns:
+            number of bytes read
+
+        Raises:
+            :class:`EOFError` if the peer closed the connection.
+        """
+        self._reserve(self.read_size)
+        with memoryview(self._buffer) as view:
+            received = connection.recv_into(
+                view[self._end:self._end + self.read_size], self.read_size)
+        if received == 0:
+            raise EOFError("Connection closed by peer")
+        self._end += received
+        return received
+
+    def next_frame(self):
+        """
+        Take the next complete frame out of the buffer
+
+        Returns:
+            payload of the frame as `bytes` or `None` if no complete frame
+            has been received yet.
+
+        Raises:
+            :class:`notifyme.messages.FrameError` if the announced frame
+            exceeds `max_frame_size`.
+        """
+        if self._end - self._start < FRAME_HEADER.size:
+            return None
+        length, = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        if length > self.max_frame_size:
+            raise FrameError("Frame exceeds maximum frame size")
+        payload_start = self._start + FRAME_HEADER.size
+        if self._end - payload_start < length:
+            return None
+        with memoryview(self._buffer) as view:
+            payload = bytes(view[payload_start:payload_start + length])
+        self._start = payload_start + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return payload
+
+    def frames(self):
+        """
+        Drain all complete frames from the buffer
+
+        Returns:
+            generator of frame payloads as `bytes`
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def receive_message(self, connection):
+        """
+        Return the next message, reading from `connection` only if no
+        complete frame is buffered.
+
+        Args:
+            connection: socket-like object providing `recv_into`
+
+        Returns:
+            :class:`notifyme.messages.ProtocolMessage`
+        """
+        frame = self.next_frame()
+        while frame is None:
+            self.read_from(connection)
+            frame = self.next_frame()
+        return WrappedProtocolMessage.parse(frame)
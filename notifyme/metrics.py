@@ -0,0 +1,497 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Metrics of a running daemon in the Prometheus text exposition format.
+
+A :class:`MetricsRegistry` holds counters, gauges and histograms with fixed
+buckets. Updating a metric takes a single uncontended lock of the labelled
+value, everything else (cumulating buckets, formatting, gauges computed by
+a function) happens when the metrics are scraped. :class:`ServerMetrics`
+defines the metrics of the collector and publisher dispatchers,
+:class:`MetricsServer` serves a registry over plain HTTP::
+
+    metrics = ServerMetrics()
+    pub = PublisherDispatcher(..., metrics=metrics)
+    col = CollectorDispatcher(..., metrics=metrics)
+    MetricsServer(metrics.registry, port=9100).start()
+"""
+
+import logging
+from bisect import bisect_left
+from math import inf
+from threading import Thread, Lock
+
+
+#: Content type of :meth:`MetricsRegistry.exposition`
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Buckets in seconds for network operations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+#: Buckets in seconds for CPU bound operations on a single message
+SERIALIZATION_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001,
+                         0.00025, 0.0005, 0.001, 0.0025, 0.01)
+#: Buckets for the number of subscribers a notification is sent to
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def _format_value(value):
+    if value == inf:
+        return '+Inf'
+    if value == -inf:
+        return '-Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape_label(value))
+                             for name, value in zip(names, values))
+
+
+class CounterValue:
+    """
+    Value of a counter for one set of label values
+    """
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        with self._lock:
+            self.value += amount
+
+
+class GaugeValue:
+    """
+    Value of a gauge for one set of label values. Either set directly or
+    computed by a function whenever it is scraped.
+    """
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """
+        Compute the value by calling `function` without arguments when
+        it is scraped
+        """
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class HistogramValue:
+    """
+    Observations of a histogram for one set of label values
+    """
+    __slots__ = ('upper_bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # not cumulated, the last one counts observations above all bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Cumulative bucket counts, sum and count
+
+        Returns:
+            tuple of a list of `(upper bound, count)` ending with `+Inf`,
+            the sum and the count of all observations
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds + (inf,), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets, total, cumulative
+
+
+class Metric:
+    """
+    A metric and its values, one per combination of label values
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Value for the given label values, created on first use. Keep it
+        around instead of looking it up on every update in hot paths.
+        """
+        value = self._values.get(values)
+        if value is not None:
+            return value
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s expects the labels %s"
+                             % (self.name, ', '.join(self.labelnames)))
+        with self._lock:
+            return self._values.setdefault(values, self._new_value())
+
+    def samples(self):
+        """
+        Current samples of all values
+
+        Returns:
+            list of `(name, label names, label values, value)` tuples
+        """
+        raise NotImplementedError
+
+    def exposition(self):
+        """
+        The metric in the text exposition format
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation
+                                   .replace('\\', r'\\')
+                                   .replace('\n', r'\n')),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for name, labelnames, labelvalues, value in self.samples():
+            lines.append('%s%s %s' % (name,
+                                      _format_labels(labelnames, labelvalues),
+                                      _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+    type = 'counter'
+
+    def _new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        return [(self.name, self.labelnames, labels, value.value)
+                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+    type = 'gauge'
+
+    def _new_value(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def samples(self):
+        return [(self.name, self.labelnames, labels, value.get())
+                for labels, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS,
+                 labelnames=()):
+        if 'le' in labelnames:
+            raise ValueError("'le' is reserved for the buckets")
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, documentation, labelnames)
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        samples = []
+        labelnames = self.labelnames + ('le',)
+        for labels, value in sorted(self._values.items()):
+            buckets, total, count = value.snapshot()
+            for bound, cumulative in buckets:
+                samples.append((self.name + '_bucket', labelnames,
+                                labels + (_format_value(bound),),
+                                cumulative))
+            samples.append((self.name + '_sum', self.labelnames, labels,
+                            total))
+            samples.append((self.name + '_count', self.labelnames, labels,
+                            count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics, each registered once under its name
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _register(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError("%s is already registered as a %s"
+                                 % (name, metric.type))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Register a :class:`Counter`, or return the one registered as `name`
+        """
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        Register a :class:`Gauge`, or return the one registered as `name`
+        """
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS,
+                  labelnames=()):
+        """
+        Register a :class:`Histogram`, or return the one registered as
+        `name`
+        """
+        return self._register(Histogram, name, documentation, buckets,
+                              labelnames)
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def exposition(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return ''.join(metric.exposition() for metric in metrics)
+
+
+def resource_root(resource):
+    """
+    First level of `resource`, e.g. `/foo` for `/foo/bar`
+    """
+    return '/' + resource.split('/', 2)[1] if resource.startswith('/') \
+        else resource
+
+
+class ServerMetrics:
+    """
+    Metrics of the collector and publisher dispatchers. One instance is
+    passed to both dispatchers, the publisher's connections and queues are
+    looked at only when the metrics are scraped.
+    """
+    def __init__(self, registry=None):
+        """
+        Register the metrics
+
+        Args:
+            registry(:class:`MetricsRegistry`): registry to register the
+                metrics with, a new one if omitted.
+        """
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.notifications = registry.counter(
+            'notifyme_notifications_received_total',
+            "Notifications accepted by the collector, by resource root",
+            ['root'])
+        self.fanout = registry.histogram(
+            'notifyme_notification_fanout',
+            "Subscribers a notification is sent to", FANOUT_BUCKETS)
+        self.serialization_seconds = registry.histogram(
+            'notifyme_serialization_seconds',
+            "Time spent encoding a notification for the subscribers",
+            SERIALIZATION_BUCKETS)
+        self.backlog_append_seconds = registry.histogram(
+            'notifyme_backlog_append_seconds',
+            "Time spent numbering, encoding and storing a notification in "
+            "the backlog", SERIALIZATION_BUCKETS)
+        self.send_seconds = registry.histogram(
+            'notifyme_send_seconds',
+            "Time spent writing queued messages to a subscriber")
+        self.handshake_seconds = registry.histogram(
+            'notifyme_handshake_seconds',
+            "Duration of successful TLS handshakes", LATENCY_BUCKETS,
+            ['dispatcher'])
+        self.handshake_failures = registry.counter(
+            'notifyme_handshake_failures_total',
+            "TLS handshakes that failed or were refused", ['dispatcher'])
+        self.connections = registry.gauge(
+            'notifyme_connections', "Open connections", ['dispatcher'])
+        self.queue_depth = registry.gauge(
+            'notifyme_queue_depth',
+            "Messages queued for all subscribers")
+        self.queue_depth_max = registry.gauge(
+            'notifyme_queue_depth_max',
+            "Messages queued for the subscriber with the longest queue")
+        self.queue_dropped = registry.gauge(
+            'notifyme_queue_dropped',
+            "Notifications dropped or coalesced by the queues of the "
+            "connected subscribers")
+        self.transitions = registry.counter(
+            'notifyme_protocol_transitions_total',
+            "Protocol state machine transitions",
+            ['source', 'message', 'target'])
+        self._roots = {}
+
+    def notification_received(self, resource):
+        """
+        Count a notification accepted by a collector
+        """
+        root = resource_root(resource)
+        value = self._roots.get(root)
+        if value is None:
+            value = self._roots[root] = self.notifications.labels(root)
+        value.inc()
+
+    def watch_publisher(self, dispatcher):
+        """
+        Report the connections and queues of a
+        :class:`notifyme.publisher.PublisherDispatcher`
+        """
+        self.connections.labels('publisher').set_function(
+            lambda: len(dispatcher.active_connections))
+        self.queue_depth.set_function(
+            lambda: sum(s['depth'] for s in dispatcher.queue_stats()))
+        self.queue_depth_max.set_function(
+            lambda: max([s['depth'] for s in dispatcher.queue_stats()],
+                        default=0))
+        self.queue_dropped.set_function(
+            lambda: sum(s['dropped'] + s['coalesced']
+                        for s in dispatcher.queue_stats()))
+
+    def transition(self, source, message_type, target, seconds):
+        """
+        Hook for :class:`notifyme.statemachine.ProtocolStateMachine`
+        counting transitions
+        """
+        self.transitions.labels(source, message_type.__name__, target).inc()
+
+
+def _http_server(address, port, registry):
+    # http.server is imported here, it takes longer to import than
+    # everything else the clients need
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics: " + format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    return server
+
+
+class MetricsServer(Thread):
+    """
+    Serves the metrics of a registry on `/metrics` over plain HTTP. Binds
+    to the loopback interface unless told otherwise, there is no
+    authentication.
+    """
+    def __init__(self, registry, address='127.0.0.1', port=9100):
+        Thread.__init__(self, daemon=True)
+        self._server = _http_server(address, port, registry)
+        self.address, self.port = self._server.server_address[:2]
+
+    def run(self):
+        logging.debug("serving metrics on %s:%d" % (self.address, self.port))
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -18,11 +18,13 @@
 
 
 class Notification:
-    def __init__(self, resource, urgency, subject, data=None):
+    def __init__(self, resource, urgency, subject, data=None, trace=None):
         self.resource = resource
         self.urgency = urgency
         self.subject = subject
         self.data = data
+        # optional :class:`notifyme.tracing.Trace`
+        self.trace = trace
 
     @property
     def to_dict(self):
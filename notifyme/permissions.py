@@ -0,0 +1,136 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+import logging
+
+from OpenSSL import crypto
+
+from notifyme.resources import ResourceMatcher
+
+
+class FingerprintCache:
+    """
+    Caches the fingerprints of certificates that have been seen before.
+
+    Fingerprints in the configuration are sha256 hashes of the PEM encoded
+    certificate. Computing them means dumping the certificate to PEM and
+    hashing it; the cache is keyed by OpenSSL's own digest of the DER
+    encoded certificate instead, which is cheap to obtain.
+    """
+    def __init__(self, maxsize=4096):
+        """
+        Initialize an empty cache
+
+        Args:
+            maxsize(int): number of fingerprints to keep
+        """
+        self.maxsize = maxsize
+        self._fingerprints = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def __call__(self, cert):
+        """
+        Get the fingerprint of `cert`
+
+        Args:
+            cert(:class:`OpenSSL.crypto.X509`): certificate
+
+        Returns:
+            hex representation of the sha256 hash of the PEM encoded
+            certificate as a string
+        """
+        key = cert.digest('sha256')
+        with self._lock:
+            fingerprint = self._fingerprints.get(key)
+            if fingerprint is not None:
+                self._fingerprints.move_to_end(key)
+                return fingerprint
+
+        cert_hash = sha256()
+        cert_hash.update(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        fingerprint = cert_hash.hexdigest()
+
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+            if len(self._fingerprints) > self.maxsize:
+                self._fingerprints.popitem(last=False)
+        return fingerprint
+
+
+class PermissionStore:
+    """
+    Permissions of client certificates, keyed by fingerprint.
+
+    Serves as verify_callback for OpenSSL: the permitted resources of a
+    known certificate are attached to the connection that is being
+    verified as a :class:`notifyme.resources.ResourceMatcher`, see
+    `OpenSSL.SSL.Connection.get_app_data()`. The store holds no
+    per-connection state, so any number of handshakes may use it at once.
+    """
+    def __init__(self, permissions, fingerprints=None):
+        """
+        Initialize the store
+
+        Args:
+            permissions: list of tuples, each consisting of the
+                hex representation of a sha256 hash as a string
+                and a list of allowed resources, each as a string.
+            fingerprints(:class:`FingerprintCache`): cache to use, may be
+                shared between several stores.
+        """
+        if fingerprints is None:
+            fingerprints = FingerprintCache()
+        self.fingerprints = fingerprints
+        self._permissions = {}
+        for cert_hash, resources in permissions:
+            self._permissions.setdefault(cert_hash.lower(),
+                                         ResourceMatcher(resources))
+
+    def __len__(self):
+        return len(self._permissions)
+
+    def lookup(self, cert):
+        """
+        Look up the resources the owner of `cert` is permitted to use
+
+        Args:
+            cert(:class:`OpenSSL.crypto.X509`): peer certificate
+
+        Returns:
+            :class:`notifyme.resources.ResourceMatcher` of the permitted
+            resources or `None` if the certificate is unknown.
+        """
+        return self._permissions.get(self.fingerprints(cert))
+
+    def __call__(self, conn, cert, errnum, depth, ok):
+        """
+        Actually perform the verification
+        """
+        permitted_resources = self.lookup(cert)
+        if permitted_resources is None:
+            logging.debug("found unknown cert hash")
+            return False
+        conn.set_app_data(permitted_resources)
+        logging.debug("found known cert hash")
+        return True
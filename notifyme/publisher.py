@@ -16,107 +16,486 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import logging
-from threading import Thread, Lock
-from socket import socket, AF_INET, SOCK_STREAM
-from hashlib import sha256
+from collections import deque
+from os import cpu_count
+from threading import Thread, Lock, Condition, get_ident
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR, SOMAXCONN
+from time import perf_counter
 
-from OpenSSL import SSL, crypto
+from OpenSSL import SSL
 
-from notifyme.statemachine import SendingProtocolState, \
-    ReceivingProtocolState, ProtocolStateMachine
+from notifyme.statemachine import ProtocolStateMachine, TransitionTable, \
+    Stay, SEND, ANY
 from notifyme.messages import PublishMessage, SubscribeMessage, \
-    ConfirmationMessage, ErrorMessage, WrappedProtocolMessage, \
-    NotificationMessage
-from notifyme.resources import is_subresource
+    ConfirmationMessage, ErrorMessage, NotificationMessage, \
+    UnsubscribeMessage, HistoryQueryMessage, HistoryResultMessage, \
+    EncodedMessage, FrameError
+from notifyme.resources import ResourceMatcher, SubscriptionIndex, \
+    convert_to_path
+from notifyme.permissions import PermissionStore
+from notifyme.backlog import Backlog
+from notifyme.filters import NotificationFilter
+from notifyme.aio import TLSStream
+from notifyme.handshake import HandshakePool, handshake_done, \
+    HANDSHAKE_TIMEOUT
+from notifyme.session import ProtocolSession
+from notifyme.tracing import TracedMessage
 
 
-class PublisherProtocol:
+#: Overflow policies of :class:`OutboundQueue`
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE_BY_RESOURCE = 'coalesce-by-resource'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE_BY_RESOURCE,
+                     DISCONNECT)
+
+#: Backlogged notifications read at once while replaying, the backlog's
+#: lock is released in between
+REPLAY_CHUNK_SIZE = 256
+
+
+class OutboundQueue:
     """
-    Protocol as speaken by a publisher
+    Bounded queue of encoded messages waiting to be written to a subscriber.
+
+    Only live notifications count towards the limit, protocol messages and
+    replayed notifications are always queued. If a notification arrives
+    while the queue is full, the overflow policy decides what happens:
+
+    * `drop-oldest`: drop the oldest queued notification
+    * `drop-newest`: drop the incoming notification
+    * `coalesce-by-resource`: replace a queued notification for the same
+      resource, drop the oldest one if there is none
+    * `disconnect`: refuse the notification, the connection should be closed
     """
-    def __init__(self, published_resources):
+    def __init__(self, maxsize=1000, overflow_policy=DROP_OLDEST,
+                 listener=None):
+        """
+        Initialize an empty queue
+
+        Args:
+            maxsize(int): maximum number of queued notifications
+            overflow_policy(str): one of `OVERFLOW_POLICIES`
+            listener(callable): optional, called without arguments after
+                something has been queued or the queue has been closed.
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow_policy)
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.listener = listener
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self._items = deque()
+        self._notifications = 0
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+
+    def __len__(self):
+        """
+        Number of queued messages
+        """
+        return len(self._items)
+
+    @property
+    def stats(self):
+        """
+        Queue depth and drop counters as a dict
+        """
+        return {'depth': len(self._items), 'dropped': self.dropped,
+                'coalesced': self.coalesced}
+
+    @staticmethod
+    def _resource(encoded_message):
+        return encoded_message.resource
+
+    def put(self, encoded_message, replayed=False):
+        """
+        Queue a message
+
+        Args:
+            encoded_message(:class:`notifyme.messages.EncodedMessage`):
+                message to queue
+            replayed(bool): the message is a notification replayed from
+                the backlog. The subscriber asked for all of them, so they
+                are queued regardless of the limit.
+
+        Returns:
+            `False` if the queue has been closed or if it overflowed and the
+            policy is `disconnect`, `True` otherwise.
+        """
+        resource = None if replayed else self._resource(encoded_message)
+        with self._lock:
+            if self.closed:
+                return False
+            if resource is not None and self._notifications >= self.maxsize:
+                if not self._overflow(encoded_message, resource):
+                    return self.overflow_policy != DISCONNECT
+            else:
+                self._items.append(encoded_message)
+                if resource is not None:
+                    self._notifications += 1
+            self._not_empty.notify()
+        if self.listener is not None:
+            self.listener()
+        return True
+
+    def _overflow(self, encoded_message, resource):
+        """
+        Apply the overflow policy. Must be called with the lock held.
+
+        Returns:
+            `True` if `encoded_message` has been queued
+        """
+        if self.overflow_policy in (DROP_NEWEST, DISCONNECT):
+            self.dropped += 1
+            return False
+
+        if self.overflow_policy == COALESCE_BY_RESOURCE:
+            for i in range(len(self._items) - 1, -1, -1):
+                if self._resource(self._items[i]) == resource:
+                    self._items[i] = encoded_message
+                    self.coalesced += 1
+                    return True
+
+        # drop the oldest notification, keep protocol messages
+        for i, item in enumerate(self._items):
+            if self._resource(item) is not None:
+                del self._items[i]
+                break
+        self._items.append(encoded_message)
+        self.dropped += 1
+        return True
+
+    def get_all(self, block=True):
+        """
+        Take all queued messages out of the queue
+
+        Args:
+            block(bool): wait until there is at least one message or the
+                queue has been closed
+
+        Returns:
+            list of :class:`notifyme.messages.EncodedMessage`, empty if
+            nothing is queued or the queue has been closed.
+        """
+        with self._lock:
+            while block and not self._items and not self.closed:
+                self._not_empty.wait()
+            if self.closed:
+                return []
+            items = list(self._items)
+            self._items.clear()
+            self._notifications = 0
+            return items
+
+    def close(self):
+        """
+        Stop accepting messages and wake up waiting writers
+        """
+        with self._lock:
+            self.closed = True
+            self._items.clear()
+            self._not_empty.notify_all()
+        if self.listener is not None:
+            self.listener()
+
+
+def replayed_already(connection, encoded_message):
+    """
+    Whether a numbered notification has been replayed to `connection`
+    before it could be sent live, see :meth:`PublisherProtocol.replay`
+    """
+    replayed_through = connection.replayed_through
+    return replayed_through is not None and \
+        encoded_message.sequence <= replayed_through[0] and \
+        replayed_through[1].matches(encoded_message.resource)
+
+
+def trace_sent(tracer, items):
+    """
+    Tell `tracer` that the traced messages among `items` have been written
+    """
+    now = perf_counter()
+    for item in items:
+        if type(item) is TracedMessage:
+            tracer.sent(item.trace, now)
+
+
+class PublisherProtocol(ProtocolStateMachine):
+    """
+    Protocol as speaken by a publisher. The handlers are called with the
+    connection as `context`, :class:`PublisherProtocol` itself is a
+    connection that isn't connected to anything.
+    """
+    def __init__(self, published_resources, subscription_index=None):
         """
         Initializes a PublisherProtocol
 
         Args:
             published_resources(list): List of resources this publisher
                 is going to publish.
+            subscription_index(:class:`notifyme.resources.SubscriptionIndex`):
+                Optional index that is updated with confirmed subscriptions.
         """
         self.published_resources = published_resources
+        self.resource_matcher = ResourceMatcher(published_resources)
         self.subscribed_resources = []
-        self._state = PublisherProtocol.SendPublishMessageState(self)
+        self.notification_filter = None
+        self.replayed_through = None
+        self.subscription_index = subscription_index
+        self.backlog = None
+        self.history = None
+        self.run_blocking = None
+        ProtocolStateMachine.__init__(self, PublisherProtocol.TRANSITIONS,
+                                      self)
 
-    def __call__(self, in_msg):
+    @staticmethod
+    def send_publish_message(context, in_msg):
         """
-        React appropriately to an incoming message.
+        Tell the subscriber what it may subscribe to
+        """
+        logging.debug("Sending PublishMessage")
+        epoch = None
+        if context.backlog is not None:
+            epoch = context.backlog.epoch
+        return PublishMessage(published_resources=context.published_resources,
+                              epoch=epoch)
 
-        Returns:
-            :class:`notifyme.messages.ProtocolMessage` or None
+    @staticmethod
+    def receive_initial_subscription(context, in_msg):
         """
-        if isinstance(self._state, ReceivingProtocolState):
-            self._state, out_msg = self._state(in_msg)
-        else:
-            self._state, out_msg = self._state()
+        Handle the initial SubscribeMessage, the session only moves on once
+        a subscription has been confirmed
+        """
+        logging.debug("Received SubscribeMessage")
+        confirmed, out_msg = PublisherProtocol.add_subscriptions(context,
+                                                                 in_msg)
+        if not confirmed:
+            return Stay(out_msg)
+        return out_msg
+
+    @staticmethod
+    def receive_subscription(context, in_msg):
+        """
+        Handle a SubscribeMessage of an established session
+        """
+        logging.debug("Received additional SubscribeMessage")
+        _, out_msg = PublisherProtocol.add_subscriptions(context, in_msg)
         return out_msg
 
-    class SendPublishMessageState(SendingProtocolState):
-        """
-        State that sends a PublishMessage
-        """
-        def __call__(self):
-            logging.debug("Sending PublishMessage")
-            return PublisherProtocol.ReceiveSubscriptionMessageState(
-                self.context), \
-                PublishMessage(published_resources=
-                               self.context.published_resources)
-
-    class ReceiveSubscriptionMessageState(ReceivingProtocolState):
-        """
-        State that expects SubscribeMessages.
-        """
-        def __call__(self, in_msg):
-            """
-            Handle incoming SubscribedMessage
-
-            Args:
-                in_msg (:class:`notifyme.messages.SubscribeMessage`): Message
-                    to handle
-            """
-            if type(in_msg) is not SubscribeMessage:
-                return ErrorMessage("Unexpected Message")
-            logging.debug("Received SubscribeMessage")
-            confirmed_resources = []
-            unavailable_resources = []
-            # check if subscribed resources are valid.
-            for resource in in_msg.data['subscribed_resources']:
-                found = False
-                for p in self.context.published_resources:
-                    if is_subresource(resource, p):
-                        confirmed_resources += [resource]
-                        found = True
-                        break
-                if not found:
-                    unavailable_resources += [resource]
-
-            if len(unavailable_resources) > 0:
-                logging.debug(
-                    "The Client requested some unavailable resources")
-                out_msg = ErrorMessage(error_message=
+    @staticmethod
+    def add_subscriptions(context, in_msg):
+        """
+        Subscribe to the resources of `in_msg` in addition to the
+        current subscriptions
+
+        Returns:
+            tuple of a bool telling whether the subscription has been
+            confirmed and the message to send. If the confirmation has
+            been queued already, the message is `None`.
+        """
+        unavailable_resources = []
+        # check if subscribed resources are valid.
+        for resource in in_msg.data['subscribed_resources']:
+            if not context.resource_matcher.matches(resource):
+                unavailable_resources += [resource]
+
+        try:
+            notification_filter = NotificationFilter.from_dict(
+                in_msg.data.get('filters'))
+        except ValueError as e:
+            return False, ErrorMessage(e.args[0])
+
+        if len(unavailable_resources) > 0:
+            logging.debug(
+                "The Client requested some unavailable resources")
+            return False, ErrorMessage(error_message=
                                        "Some resources were unavailable")
-            else:
-                out_msg = ConfirmationMessage(confirmed_resources=
-                                              confirmed_resources)
-                self.context.subscribed_resources = confirmed_resources
 
-            return (self, out_msg)
+        subscribed = set(tuple(convert_to_path(r)) for r in
+                         context.subscribed_resources)
+        new_resources = []
+        for resource in in_msg.data['subscribed_resources']:
+            path = tuple(convert_to_path(resource))
+            if path not in subscribed:
+                subscribed.add(path)
+                new_resources.append(resource)
+
+        # filters apply to the whole connection, they are only
+        # replaced if the subscriber sends new ones
+        if notification_filter is not None or \
+                not context.subscribed_resources:
+            context.notification_filter = notification_filter
+        context.subscribed_resources = \
+            context.subscribed_resources + new_resources
+        out_msg = ConfirmationMessage(
+            confirmed_resources=context.subscribed_resources)
+
+        if context.backlog is None:
+            PublisherProtocol.subscribe(context, new_resources)
+            return True, out_msg
+        context.send_message(out_msg)
+        if in_msg.wants_replay:
+            PublisherProtocol.replay(context, context.backlog, in_msg,
+                                     new_resources)
+        else:
+            PublisherProtocol.subscribe(context, new_resources)
+        return True, None
+
+    @staticmethod
+    def receive_unsubscription(context, in_msg):
+        """
+        Unsubscribe from the resources of an UnsubscribeMessage
+        """
+        logging.debug("Received UnsubscribeMessage")
+        resources = in_msg.data['unsubscribed_resources']
+        removed = set(tuple(convert_to_path(r)) for r in resources)
+        index = context.subscription_index
+        if index is not None:
+            index.unsubscribe(context, resources)
+        context.subscribed_resources = [
+            r for r in context.subscribed_resources
+            if tuple(convert_to_path(r)) not in removed]
+        return ConfirmationMessage(
+            confirmed_resources=context.subscribed_resources)
+
+    @staticmethod
+    def query_history(context, in_msg):
+        """
+        Answer a HistoryQueryMessage with one page of results. If the
+        connection has a `run_blocking` method, the query runs there and
+        the page is sent once it completes.
+        """
+        history = context.history
+        if history is None:
+            return ErrorMessage("History is not available")
+        resource = in_msg.data['resource']
+        if not context.resource_matcher.matches(resource):
+            return ErrorMessage("Resource is unavailable")
+
+        def answer():
+            notifications, cursor = history.query(
+                resource, since=in_msg.data['since'],
+                until=in_msg.data['until'], limit=in_msg.data['limit'],
+                cursor=in_msg.data['cursor'])
+            logging.debug("answering history query with %d notifications"
+                          % len(notifications))
+            return HistoryResultMessage(notifications, cursor=cursor)
+
+        if context.run_blocking is None:
+            return answer()
+        context.run_blocking(answer)
+        return None
+
+    @staticmethod
+    def receive_error(context, in_msg):
+        """
+        Log an ErrorMessage, errors are never answered with errors
+        """
+        logging.debug("Received ErrorMessage: %s"
+                      % in_msg.data['error_message'])
+        return None
+
+    @staticmethod
+    def unexpected_message(context, in_msg):
+        return ErrorMessage("Unexpected Message")
+
+    @staticmethod
+    def subscribe(context, resources):
+        index = context.subscription_index
+        if index is not None:
+            index.subscribe(context, resources)
+
+    @staticmethod
+    def replay(context, backlog, in_msg, resources):
+        """
+        Queue all backlogged notifications of `resources` the subscriber
+        asked for, then subscribe to `resources`.
+
+        The backlog is read `REPLAY_CHUNK_SIZE` notifications at a time
+        and its lock is released in between, so a long replay doesn't hold
+        up the other subscribers. The last chunk is queued and the
+        subscription made while holding the lock, which keeps new
+        notifications from slipping in between the replay and live
+        delivery. Notifications that were stored before but are routed
+        only afterwards have been replayed already, `replayed_through`
+        keeps the dispatcher from sending them again.
+        """
+        since_sequence = in_msg.data.get('since_sequence')
+        since_timestamp = in_msg.data.get('since_timestamp')
+        notification_filter = context.notification_filter
+        count = 0
+        while True:
+            with backlog.lock:
+                chunk = backlog.replay(resources,
+                                       since_sequence=since_sequence,
+                                       since_timestamp=since_timestamp,
+                                       limit=REPLAY_CHUNK_SIZE)
+                done = len(chunk) < REPLAY_CHUNK_SIZE
+                if done:
+                    count += PublisherProtocol.send_replayed(
+                        context, chunk, notification_filter)
+                    context.replayed_through = (backlog.sequence,
+                                                ResourceMatcher(resources))
+                    PublisherProtocol.subscribe(context, resources)
+                    break
+            count += PublisherProtocol.send_replayed(context, chunk,
+                                                     notification_filter)
+            since_sequence = chunk[-1].sequence
+        logging.debug("replayed %d notifications" % count)
+
+    @staticmethod
+    def send_replayed(context, replayed, notification_filter):
+        """
+        Queue replayed notifications that pass `notification_filter`
+
+        Returns:
+            number of notifications queued
+        """
+        if notification_filter is not None:
+            replayed = [encoded for encoded in replayed
+                        if notification_filter(
+                            encoded.message.notification)]
+        for encoded in replayed:
+            context.send_encoded(encoded, replayed=True)
+        return len(replayed)
+
+    # After the initial subscription has been confirmed, subscriptions can
+    # be added and removed without reconnecting. Every change is confirmed
+    # with the complete list of subscribed resources.
+    TRANSITIONS = TransitionTable('send_publish', [
+        ('send_publish', SEND, send_publish_message, 'receive_subscription'),
+        ('receive_subscription', SubscribeMessage,
+         receive_initial_subscription, 'subscribed'),
+        ('receive_subscription', HistoryQueryMessage, query_history,
+         'receive_subscription'),
+        ('receive_subscription', ANY, unexpected_message,
+         'receive_subscription'),
+        ('subscribed', SubscribeMessage, receive_subscription, 'subscribed'),
+        ('subscribed', UnsubscribeMessage, receive_unsubscription,
+         'subscribed'),
+        ('subscribed', HistoryQueryMessage, query_history, 'subscribed'),
+        ('subscribed', ErrorMessage, receive_error, 'subscribed'),
+        ('subscribed', ANY, unexpected_message, 'subscribed'),
+    ])
 
 
 class SimplePublisher(Thread):
     """
     Handles a connection from a subscriber
+
+    Each subscriber costs two threads: this one reads requests and a
+    writer drains the :class:`OutboundQueue`, so a slow subscriber never
+    blocks the protocol. Use the "asyncio" mode of
+    :class:`AsyncPublisherDispatcher` when serving many subscribers.
     """
-    def __init__(self, connection, published_resources, dispatcher):
+    def __init__(self, connection, published_resources, dispatcher,
+                 resource_matcher=None):
         """
         Initialize connection and protocol
 
@@ -127,16 +506,34 @@ class SimplePublisher(Thread):
                 List of resources the client may subscribe to.
             dispatcher (:class:`notifyme.publisher.PublisherDispatcher`):
                 dispatcher that spawned this publisher.
+            resource_matcher (:class:`notifyme.resources.ResourceMatcher`):
+                compiled `published_resources`, compiled on demand if
+                omitted.
         """
         Thread.__init__(self)
         self.running = True
         self.lock = Lock()
         self.connection = connection
         self.published_resources = published_resources
+        if resource_matcher is None:
+            resource_matcher = ResourceMatcher(published_resources)
+        self.resource_matcher = resource_matcher
         self.subscribed_resources = []
+        self.notification_filter = None
+        self.replayed_through = None
         self.dispatcher = dispatcher
-        self._protocol = ProtocolStateMachine(initial_state=PublisherProtocol
-                                              .SendPublishMessageState(self))
+        self.subscription_index = dispatcher.subscriptions
+        self.backlog = dispatcher.backlog
+        self.history = dispatcher.history
+        self.run_blocking = None
+        self.queue = OutboundQueue(maxsize=dispatcher.queue_size,
+                                   overflow_policy=dispatcher.overflow_policy)
+        self._writer = Thread(target=self._write_queued, daemon=True)
+        self._protocol = ProtocolStateMachine(
+            PublisherProtocol.TRANSITIONS, self,
+            hooks=dispatcher.protocol_hooks)
+        self._protocol_session = ProtocolSession(self._protocol,
+                                                 output=self.send_encoded)
 
     def send_message(self, message):
         """
@@ -146,10 +543,57 @@ class SimplePublisher(Thread):
             message(:class:`notifyme.messages.ProtocolMessage`):
                 message to be sent.
         """
-        wrapped_message = WrappedProtocolMessage(message)
-        self.lock.acquire()
-        self.connection.send(wrapped_message.text.encode('utf-8'))
-        self.lock.release()
+        self.send_encoded(message.encoded)
+
+    def send_encoded(self, encoded_message, replayed=False):
+        """
+        Queue an already encoded message for the connected peer. Never
+        blocks, the message is written by the writer thread.
+
+        Args:
+            encoded_message(:class:`notifyme.messages.EncodedMessage`):
+                message to be sent.
+            replayed(bool): a notification replayed from the backlog,
+                exempt from the queue's limit
+        """
+        if not self.queue.put(encoded_message, replayed) and self.running:
+            logging.debug("outbound queue overflowed, disconnecting")
+            self.disconnect()
+
+    def _write_queued(self):
+        """
+        Writer thread: send everything that piles up in the queue with as
+        few writes as possible.
+        """
+        metrics = self.dispatcher.metrics
+        tracer = self.dispatcher.tracer
+        while True:
+            items = self.queue.get_all()
+            if not items:
+                break
+            started = perf_counter()
+            try:
+                with self.lock:
+                    self.connection.sendall(
+                        b''.join([item.frame for item in items]))
+            except Exception:
+                self.disconnect()
+                break
+            if metrics is not None:
+                metrics.send_seconds.observe(perf_counter() - started)
+            if tracer is not None:
+                trace_sent(tracer, items)
+
+    def disconnect(self):
+        """
+        Close the connection, stops both the reading and the writing thread
+        """
+        self.running = False
+        self.queue.close()
+        try:
+            self.connection.sock_shutdown(SHUT_RDWR)
+        except Exception:
+            pass
 
     def receive_message(self):
         """
@@ -159,37 +603,207 @@ class SimplePublisher(Thread):
         Returns:
             :class:`notifyme.messages.ProtocolMessage`
         """
-        received_bytes = self.connection.recv(1024)
-        received_string = received_bytes.decode('utf-8')
-        in_msg = WrappedProtocolMessage.parse(received_string)
-        return in_msg
+        decoder = self._protocol_session.decoder
+        return decoder.receive_message(self.connection)
 
     def run(self):
         """
         Handle the communication with a peer.
         """
+        self._writer.start()
+        session = self._protocol_session
+        session.start()
         while self.running:
             try:
-                if self._protocol.wait_for_input:
-                    in_msg = self.receive_message()
-                else:
-                    in_msg = None
-                out_msg = self._protocol(in_msg)
-            except Exception as e:
-                out_msg = ErrorMessage(e.args[0])
-            if out_msg is not None:
-                try:
-                    self.send_message(out_msg)
-                except Exception as e:
-                    self.running = False
+                session.decoder.read_from(self.connection)
+                session.receive_data()
+            except (EOFError, FrameError, SSL.Error, OSError):
+                break
         self.dispatcher.active_connections.remove(self)
+        self.subscription_index.unsubscribe(self)
+        self.disconnect()
+
+    def send_notification(self, notification):
+        """
+        Send out a notification message to the peer.
+
+        Args:
+            notification: :class:`notifyme.notification.Notification` or
+                an :class:`notifyme.messages.EncodedMessage` of a
+                :class:`notifyme.messages.NotificationMessage`.
+        """
+        if not isinstance(notification, EncodedMessage):
+            notification = NotificationMessage(notification).encoded
+        self.send_encoded(notification)
+
+
+class AsyncPublisher:
+    """
+    Handles a connection from a subscriber on an asyncio event loop
+    """
+    def __init__(self, stream, published_resources, dispatcher,
+                 resource_matcher=None):
+        """
+        Initialize connection and protocol. Has to be called from within
+        the event loop.
+
+        Args:
+            stream (:class:`notifyme.aio.TLSStream`):
+                Stream through which to send and receive data
+            published_resources (list):
+                List of resources the client may subscribe to.
+            dispatcher (:class:`notifyme.publisher.AsyncPublisherDispatcher`):
+                dispatcher that spawned this publisher.
+            resource_matcher (:class:`notifyme.resources.ResourceMatcher`):
+                compiled `published_resources`, compiled on demand if
+                omitted.
+        """
+        self.running = True
+        self.stream = stream
+        self.published_resources = published_resources
+        if resource_matcher is None:
+            resource_matcher = ResourceMatcher(published_resources)
+        self.resource_matcher = resource_matcher
+        self.subscribed_resources = []
+        self.notification_filter = None
+        self.replayed_through = None
+        self.dispatcher = dispatcher
+        self.subscription_index = dispatcher.subscriptions
+        self.backlog = dispatcher.backlog
+        self.history = dispatcher.history
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = get_ident()
+        self._queued = asyncio.Event()
+        self.queue = OutboundQueue(maxsize=dispatcher.queue_size,
+                                   overflow_policy=dispatcher.overflow_policy,
+                                   listener=self._wake_writer)
+        self._protocol = ProtocolStateMachine(
+            PublisherProtocol.TRANSITIONS, self,
+            hooks=dispatcher.protocol_hooks)
+        self._protocol_session = ProtocolSession(self._protocol,
+                                                 output=self.send_encoded)
+
+    def send_message(self, message):
+        """
+        Send a message to the connected peer
+
+        Args:
+            message(:class:`notifyme.messages.ProtocolMessage`):
+                message to be sent.
+        """
+        self.send_encoded(message.encoded)
+
+    def send_encoded(self, encoded_message, replayed=False):
+        """
+        Queue an already encoded message for the connected peer without
+        blocking. May be called from other threads.
+
+        Args:
+            encoded_message(:class:`notifyme.messages.EncodedMessage`):
+                message to be sent.
+            replayed(bool): a notification replayed from the backlog,
+                exempt from the queue's limit
+        """
+        if not self.queue.put(encoded_message, replayed) and self.running:
+            logging.debug("outbound queue overflowed, disconnecting")
+            self.disconnect()
+
+    def run_blocking(self, function):
+        """
+        Run `function` on the event loop's default executor, so it doesn't
+        hold up the other connections, and send the message it returns
+
+        Args:
+            function(callable): called without arguments, returns a
+                :class:`notifyme.messages.ProtocolMessage`
+        """
+        future = self._loop.run_in_executor(None, function)
+        future.add_done_callback(self._send_result)
+
+    def _send_result(self, future):
+        if future.cancelled():
+            return
+        try:
+            message = future.result()
+        except Exception as e:
+            logging.warning("blocking call failed: %s" % e)
+            message = ErrorMessage("Internal error")
+        self.send_message(message)
+
+    def _wake_writer(self):
+        if get_ident() == self._loop_thread:
+            self._queued.set()
+        else:
+            self._loop.call_soon_threadsafe(self._queued.set)
+
+    async def _write_queued(self):
+        """
+        Writer task: send everything that piles up in the queue and wait
+        for the transport to drain in between.
+        """
+        metrics = self.dispatcher.metrics
+        tracer = self.dispatcher.tracer
+        while not self.queue.closed:
+            await self._queued.wait()
+            self._queued.clear()
+            items = self.queue.get_all(block=False)
+            if not items:
+                continue
+            started = perf_counter()
+            try:
+                self.stream.write(b''.join([item.frame for item in items]))
+                await self.stream.drain()
+            except (SSL.Error, OSError):
+                self.disconnect()
+                continue
+            if metrics is not None:
+                metrics.send_seconds.observe(perf_counter() - started)
+            if tracer is not None:
+                trace_sent(tracer, items)
+
+    def disconnect(self):
+        """
+        Close the connection. May be called from other threads.
+        """
+        self.running = False
+        self.queue.close()
+        if get_ident() == self._loop_thread:
+            self.stream.close()
+        else:
+            self._loop.call_soon_threadsafe(self.stream.close)
 
     def send_notification(self, notification):
         """
         Send out a notification message to the peer.
+
+        Args:
+            notification: :class:`notifyme.notification.Notification` or
+                an :class:`notifyme.messages.EncodedMessage` of a
+                :class:`notifyme.messages.NotificationMessage`.
+        """
+        if not isinstance(notification, EncodedMessage):
+            notification = NotificationMessage(notification).encoded
+        self.send_encoded(notification)
+
+    async def run(self):
         """
-        notification_message = NotificationMessage(notification)
-        self.send_message(message=notification_message)
+        Handle the communication with a peer.
+        """
+        writer = asyncio.ensure_future(self._write_queued())
+        session = self._protocol_session
+        session.start()
+        try:
+            while self.running:
+                try:
+                    await self.stream.read_into(session.decoder)
+                    session.receive_data()
+                except (EOFError, FrameError, SSL.Error, OSError):
+                    break
+        finally:
+            self.dispatcher.active_connections.remove(self)
+            self.subscription_index.unsubscribe(self)
+            self.disconnect()
+            await writer
 
 
 class PublisherDispatcher(Thread):
@@ -198,52 +812,12 @@ class PublisherDispatcher(Thread):
     Client with a valid client certificate connects.
     """
 
-    class VerificationHelper:
-        """
-        Helper that serves as verify_callback for OpenSSL
-        """
-        def __init__(self, permissions):
-            """
-            Initialize Helper and set permissions. Saves the permitted
-            resources of the incoming certificate in `permitted_resources`.
-            call `reset()` before you re-use it!
-
-            Args:
-                permissions: list of tuples, each consisting of the
-                    hex representation of a sha256 hash as a string
-                    and a list of allowed resources, each as a string.
-            """
-            self.permissions = permissions
-            self.permitted_resources = []
-            self.in_use = Lock()
-
-        def reset(self):
-            """
-            Resets the object, call before reuse!
-            """
-            self.permitted_resources = []
-
-        def __call__(self, conn, cert, a, b, c):
-            """
-            Actually perform the verification
-            """
-            cert_hash = sha256()
-            cert_hash.update(crypto.dump_certificate(1, cert))
-            cert_hashdigest = cert_hash.hexdigest()
-
-            # check against permissions table
-            res = list(filter(lambda x: x[0] == cert_hashdigest,
-                              self.permissions))
-            if len(res) < 1:
-                return False
-                logging.debug("found unknown cert hash")
-            else:
-                self.permitted_resources = res[0][1]
-                logging.debug("found known cert hash")
-                return True
-
-
-    def __init__(self, address, port, keyfile, certfile, permissions_table):
+    def __init__(self, address, port, keyfile, certfile, permissions_table,
+                 queue_size=1000, overflow_policy=DROP_OLDEST,
+                 handshake_workers=None, backlog_size=0,
+                 backlog_max_age=None, backlog=None, history=None,
+                 protocol_hooks=None, metrics=None, tracer=None,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
         """
         Initialize server dispatcher for publishers
 
@@ -254,16 +828,65 @@ class PublisherDispatcher(Thread):
             certfile (string): path to certfile
             permissions_table (list): list of tuples with sha256 hashes of the
                 client's certificate and the list of the resorces the client
-                may subscribe to.
+                may subscribe to, or a
+                :class:`notifyme.permissions.PermissionStore`.
+            queue_size (int): maximum number of notifications queued per
+                subscriber
+            overflow_policy (string): what to do if a subscriber's queue is
+                full, one of `OVERFLOW_POLICIES`
+            handshake_workers (int): number of TLS handshakes performed in
+                parallel, defaults to the number of CPUs
+            backlog_size (int): notifications kept per resource for
+                subscribers that ask for a replay, 0 disables the backlog.
+                Every notification is numbered and encoded for the backlog,
+                even if nobody is subscribed to it.
+            backlog_max_age (float): seconds after which backlogged
+                notifications are evicted, `None` for no limit
+            backlog: store for notifications to replay instead of the
+                in-memory :class:`notifyme.backlog.Backlog`, e.g. a
+                :class:`notifyme.log.NotificationLog`
+            history (:class:`notifyme.history.NotificationHistory`):
+                history subscribers may query
+            protocol_hooks (list): hooks called after every protocol
+                transition of every connection, e.g. a
+                :class:`notifyme.statemachine.TransitionStats`
+            metrics (:class:`notifyme.metrics.ServerMetrics`): metrics to
+                update, optional
+            tracer (:class:`notifyme.tracing.Tracer`): tracer of traced
+                notifications, optional
+            handshake_timeout (float): seconds a subscriber gets to complete
+                the TLS handshake, `None` for no limit
         """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow_policy)
         Thread.__init__(self)
         self.running = True
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
         self.permissions = permissions_table
-        self._verifier = PublisherDispatcher.VerificationHelper(
-            permissions=permissions_table)
+        if isinstance(permissions_table, PermissionStore):
+            self._verifier = permissions_table
+        else:
+            self._verifier = PermissionStore(permissions_table)
         self.active_connections = []
+        self.subscriptions = SubscriptionIndex()
+        self.history = history
+        self.protocol_hooks = protocol_hooks
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.watch_publisher(self)
+        self.tracer = tracer
+        if backlog is not None:
+            self.backlog = backlog
+        elif backlog_size:
+            self.backlog = Backlog(max_notifications=backlog_size,
+                                   max_age=backlog_max_age)
+        else:
+            self.backlog = None
         self.address = address
         self.port = port
+        self.handshake_workers = handshake_workers or cpu_count() or 1
+        self.handshake_timeout = handshake_timeout
 
         # initialize SSL Context
         self._ssl_context = SSL.Context(SSL.TLSv1_METHOD)
@@ -276,39 +899,239 @@ class PublisherDispatcher(Thread):
         self._server = SSL.Connection(self._ssl_context,
                                       socket(AF_INET, SOCK_STREAM))
         self._server.bind((self.address, self.port))
-        self._server.listen(5)
+        self._server.listen(SOMAXCONN)
         logging.debug("starting publisherDispatcher")
+        pool = HandshakePool(self.handshake_workers, self._connected,
+                             timeout=self.handshake_timeout,
+                             metrics=self.metrics, role='publisher')
+        pool.accept_from(self._server, lambda: self.running)
 
-        while self.running:
-            try:
-                conn, addr = self._server.accept()
-                logging.debug("incoming connection from %s" % str(addr))
-                self._verifier.in_use.acquire()
-                conn.do_handshake()
-                permitted_resources = self._verifier.permitted_resources
-                self._verifier.reset()
-                self._verifier.in_use.release()
-                # start Publisher Thread
-                pub = SimplePublisher(connection=conn,
-                                      published_resources=permitted_resources,
-                                      dispatcher=self)
-                self.active_connections.append(pub)
-                pub.start()
-            except SSL.Error:
-                self._verifier.reset()
-                self._verifier.in_use.release()
+    def _connected(self, conn, resource_matcher):
+        """
+        Start a `SimplePublisher` for a connection that completed the
+        handshake. Runs on the handshake pool.
+        """
+        pub = SimplePublisher(
+            connection=conn,
+            published_resources=resource_matcher.resources,
+            resource_matcher=resource_matcher,
+            dispatcher=self)
+        self.active_connections.append(pub)
+        pub.start()
+
+    def queue_stats(self):
+        """
+        Outbound queue depth and drop counters of all connected subscribers
+
+        Returns:
+            list of dicts as returned by :attr:`OutboundQueue.stats`
+        """
+        return [p.queue.stats for p in list(self.active_connections)]
 
     def send_notification(self, notification):
         """
         Send notifications to connected nodes that have subscribed to matching
-        resources
+        resources. The notification is serialized only once, no matter how
+        many nodes receive it.
+
+        If the backlog is enabled, the notification is numbered and kept
+        there as well. The backlog's lock is only held while storing it,
+        the subscribers are looked up and served outside of it.
+
+        Args:
+            notification: :class:`notifyme.notification.Notification` to
+                send or an :class:`notifyme.messages.EncodedMessage` of a
+                :class:`notifyme.messages.NotificationMessage`.
+        """
+        encoded = None
+        if isinstance(notification, EncodedMessage):
+            encoded = notification
+            notification = encoded.message.notification
+        trace = self._routing(notification)
+        if self.backlog is not None:
+            encoded = self._store(notification)
+        self._fan_out(notification, encoded, trace)
+
+    def _fan_out(self, notification, encoded, trace, subscribers=None):
+        """
+        Queue `notification` for the subscribers it passes the filter of
 
         Args:
             notification(:class:`notifyme.notification.Notification`):
-                Notification to send.
+                notification to send
+            encoded(:class:`notifyme.messages.EncodedMessage`): the
+                notification, numbered if it has been stored in the
+                backlog. `None` if it hasn't been encoded yet.
+            trace(:class:`notifyme.tracing.Trace`): its trace, if traced
+            subscribers(set): subscribers of the notification's resource if
+                already looked up
+        """
+        targets = self._targets(notification, subscribers)
+        if targets and self.backlog is not None:
+            targets = [p for p in targets
+                       if not replayed_already(p, encoded)]
+        if self.metrics is not None:
+            self.metrics.fanout.observe(len(targets))
+        if not targets:
+            if trace is not None:
+                self.tracer.routed(trace)
+            return
+
+        if encoded is None:
+            encoded = self._encode(notification)
+        if trace is not None:
+            encoded = self._routed(encoded, trace)
+        for p in targets:
+            p.send_encoded(encoded)
+
+    def _routing(self, notification):
+        """
+        Start routing `notification`
+
+        Returns:
+            its :class:`notifyme.tracing.Trace` if it is traced
+        """
+        if self.tracer is None or notification.trace is None:
+            return None
+        self.tracer.routing(notification.trace)
+        return notification.trace
+
+    def _routed(self, encoded, trace):
+        """
+        Finish routing a traced notification
+
+        Returns:
+            the message to queue for the subscribers, so they can stamp
+            the trace once it has been written
+        """
+        self.tracer.routed(trace)
+        return TracedMessage(encoded, trace)
+
+    def _encode(self, notification):
+        """
+        Serialize `notification` once for all of its subscribers
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return NotificationMessage(notification).encoded
+        started = perf_counter()
+        encoded = NotificationMessage(notification).encoded
+        metrics.serialization_seconds.observe(perf_counter() - started)
+        return encoded
+
+    def _store(self, notification):
         """
+        Number, serialize and keep `notification` in the backlog
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.backlog.append(notification)
+        started = perf_counter()
+        encoded = self.backlog.append(notification)
+        metrics.backlog_append_seconds.observe(perf_counter() - started)
+        return encoded
+
+    def _store_all(self, notifications):
+        """
+        Number, serialize and keep `notifications` in the backlog in one go
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.backlog.extend(notifications)
+        started = perf_counter()
+        encoded = self.backlog.extend(notifications)
+        metrics.backlog_append_seconds.observe(perf_counter() - started)
+        return encoded
+
+    def _targets(self, notification, subscribers=None):
+        """
+        Subscribers that receive `notification`, i.e. have subscribed to
+        its resource and whose filter it passes
+
+        Args:
+            notification(:class:`notifyme.notification.Notification`):
+                notification to send
+            subscribers(set): subscribers of the notification's resource if
+                already looked up
+
+        Returns:
+            list of subscribers
+        """
+        if subscribers is None:
+            subscribers = self.subscriptions.lookup(notification.resource)
+        return [p for p in subscribers if p.notification_filter is None or
+                p.notification_filter(notification)]
+
+    def send_notifications(self, notifications):
+        """
+        Send several notifications, e.g. the content of a
+        :class:`notifyme.messages.NotificationBatchMessage`. Subscribers are
+        looked up only once per distinct resource.
+
+        Args:
+            notifications(list): :class:`notifyme.notification.Notification`
+                objects to send.
+        """
+        traces = [self._routing(notification)
+                  for notification in notifications]
+        if self.backlog is not None:
+            stored = self._store_all(notifications)
+        else:
+            stored = [None] * len(notifications)
+
+        targets_by_resource = {}
+        for notification, encoded, trace in zip(notifications, stored,
+                                                traces):
+            subscribers = targets_by_resource.get(notification.resource)
+            if subscribers is None:
+                subscribers = targets_by_resource[notification.resource] = \
+                    self.subscriptions.lookup(notification.resource)
+            self._fan_out(notification, encoded, trace, subscribers)
+
+
+class AsyncPublisherDispatcher(PublisherDispatcher):
+    """
+    Serves all subscribers on a single asyncio event loop instead of
+    spawning a thread per connection.
+
+    `serve()` can be run on an existing event loop; `start()` runs it on a
+    new event loop in a separate thread.
+    """
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """
+        Accept connections until cancelled
+        """
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self.address, self.port)
+        logging.debug("starting AsyncPublisherDispatcher")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        logging.debug("incoming connection from %s" %
+                      str(writer.get_extra_info('peername')))
+        stream = TLSStream(self._ssl_context, reader, writer)
+        started = perf_counter()
+        try:
+            await asyncio.wait_for(stream.do_handshake(),
+                                   self.handshake_timeout)
+        except (SSL.Error, EOFError, OSError, asyncio.TimeoutError):
+            handshake_done(self.metrics, 'publisher', started, False)
+            stream.close()
+            return
+        resource_matcher = stream.connection.get_app_data()
+        handshake_done(self.metrics, 'publisher', started,
+                       resource_matcher is not None)
+        if resource_matcher is None:
+            stream.close()
+            return
 
-        for p in self.active_connections:
-            if notification.resource in p.subscribed_resources:
-                logging.debug("sending message...")
-                p.send_notification(notification)
+        pub = AsyncPublisher(stream=stream,
+                             published_resources=resource_matcher.resources,
+                             resource_matcher=resource_matcher,
+                             dispatcher=self)
+        self.active_connections.append(pub)
+        await pub.run()
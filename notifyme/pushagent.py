@@ -0,0 +1,218 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local push agent: accepts notifications on a UNIX domain socket and
+forwards them to a collector over a single persistent connection.
+
+This module is imported by the push client CLI as well, so it must not
+import pyOpenSSL or anything else that is expensive to load.
+"""
+
+import os
+import logging
+from errno import EADDRINUSE
+from queue import Queue, Empty, Full
+from socket import socket, AF_UNIX, SOCK_STREAM
+from threading import Thread
+from time import sleep
+
+from notifyme.messages import NotificationMessage, NotificationBatchMessage, \
+    FrameDecoder, WrappedProtocolMessage
+
+
+def default_socket_path():
+    """
+    Location of the agent's socket if none is given explicitly
+
+    Returns:
+        path as a string
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'notifyme-pushd.sock')
+    return '/tmp/notifyme-pushd-%d.sock' % os.getuid()
+
+
+def send_to_agent(notifications, socket_path=None):
+    """
+    Hand notifications to a running push agent
+
+    Args:
+        notifications(list): :class:`notifyme.notification.Notification`
+            objects to send
+        socket_path(str): path of the agent's socket, see
+            :func:`default_socket_path`
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    if len(notifications) == 1:
+        message = NotificationMessage(notifications[0], with_trace=True)
+    else:
+        message = NotificationBatchMessage(notifications)
+    with socket(AF_UNIX, SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(message.wrapped.frame)
+
+
+class PushAgent:
+    """
+    Accepts notifications on a UNIX domain socket and forwards them through
+    a push client. Notifications that pile up while forwarding are sent as
+    one batch.
+    """
+    def __init__(self, client, socket_path=None, queue_size=10000,
+                 max_batch_size=100, retry_interval=1):
+        """
+        Initialize the agent
+
+        Args:
+            client(:class:`notifyme.pushclient.SSLPushClient`): client that
+                talks to the collector
+            socket_path(str): where to listen, see
+                :func:`default_socket_path`
+            queue_size(int): maximum number of notifications waiting to be
+                forwarded, further notifications are dropped
+            max_batch_size(int): maximum number of notifications per batch
+            retry_interval(float): seconds to wait before retrying after
+                the collector could not be reached
+        """
+        self.client = client
+        self.socket_path = socket_path or default_socket_path()
+        self.max_batch_size = max_batch_size
+        self.retry_interval = retry_interval
+        self.running = True
+        self.dropped = 0
+        self._queue = Queue(maxsize=queue_size)
+        self._forwarder = Thread(target=self._forward, daemon=True)
+
+    def _remove_stale_socket(self):
+        """
+        Remove the socket a previous agent left behind
+
+        Raises:
+            :class:`OSError` if another agent is still listening on it
+        """
+        if not os.path.exists(self.socket_path):
+            return
+        with socket(AF_UNIX, SOCK_STREAM) as s:
+            try:
+                s.connect(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)
+                return
+        raise OSError(EADDRINUSE, "another push agent is listening on %s"
+                      % self.socket_path)
+
+    def serve_forever(self):
+        """
+        Listen on the UNIX socket and forward everything received to the
+        collector until `shutdown()` is called.
+
+        Raises:
+            :class:`OSError` if another agent is listening on the socket
+        """
+        self._remove_stale_socket()
+        self._server = socket(AF_UNIX, SOCK_STREAM)
+        # only our own user may push through us, the socket must not be
+        # accessible by anyone else for even a moment
+        umask = os.umask(0o177)
+        try:
+            self._server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self._server.listen(128)
+        self._forwarder.start()
+        logging.debug("push agent listening on %s" % self.socket_path)
+
+        while self.running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                continue
+            Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def shutdown(self):
+        """
+        Stop accepting notifications and remove the socket
+        """
+        self.running = False
+        try:
+            self._server.close()
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _handle(self, conn):
+        """
+        Read notifications from a local client until it disconnects
+        """
+        decoder = FrameDecoder()
+        with conn:
+            while True:
+                try:
+                    decoder.read_from(conn)
+                except (EOFError, OSError):
+                    break
+                try:
+                    for frame in decoder.frames():
+                        self._enqueue(WrappedProtocolMessage.parse(frame))
+                except Exception as e:
+                    logging.warning("invalid message from local client: %s"
+                                    % e)
+                    break
+
+    def _enqueue(self, message):
+        if type(message) is NotificationMessage:
+            notifications = [message.notification]
+        elif type(message) is NotificationBatchMessage:
+            notifications = message.notifications
+        else:
+            logging.debug("ignoring %s" % type(message).__name__)
+            return
+        for notification in notifications:
+            try:
+                self._queue.put_nowait(notification)
+            except Full:
+                self.dropped += 1
+                logging.warning("push agent queue full, dropping notification")
+
+    def _forward(self):
+        """
+        Forwarder thread: send whatever is queued, as a batch if there is
+        more than one notification.
+        """
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if len(batch) == 1:
+                message = NotificationMessage(batch[0], with_trace=True)
+            else:
+                message = NotificationBatchMessage(batch)
+
+            while True:
+                try:
+                    self.client.send_message(message)
+                    break
+                except Exception as e:
+                    logging.warning("could not reach collector: %s" % str(e))
+                    sleep(self.retry_interval)
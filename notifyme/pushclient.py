@@ -17,27 +17,139 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from socket import socket, AF_INET, SOCK_STREAM
+from select import select
 from hashlib import sha256
+from queue import Queue, Empty, Full
+from threading import Lock, Thread, Event
+from time import monotonic
 import logging
 
 from OpenSSL import SSL, crypto
 
-from notifyme.messages import NotificationMessage, WrappedProtocolMessage
+from notifyme.messages import NotificationMessage, WrappedProtocolMessage, \
+    ErrorMessage, NotificationBatchMessage, FrameDecoder
+from notifyme.tracing import stamp
+
+
+def batched(notifications, max_batch_size=100, max_delay=0.05):
+    """
+    Split `notifications` into batches. A batch is complete when it holds
+    `max_batch_size` notifications or when `max_delay` seconds passed since
+    its first notification, even if no other notification arrives.
+
+    `notifications` is consumed by a separate thread, so waiting for the
+    next notification doesn't hold back a batch that is due. Exceptions
+    raised while iterating it are raised by the generator. The thread
+    ends once the generator is closed, even if `notifications` isn't
+    exhausted yet.
+
+    Args:
+        notifications: iterable of :class:`notifyme.notification.Notification`
+        max_batch_size(int): maximum number of notifications per batch
+        max_delay(float): maximum time in seconds to hold back a batch
+
+    Returns:
+        generator of lists of notifications
+    """
+    queue = Queue(maxsize=max_batch_size)
+    end = object()
+    errors = []
+    stopped = Event()
+
+    def put(item):
+        # give up once nobody is consuming anymore
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for notification in notifications:
+                if not put(notification):
+                    return
+        except Exception as e:
+            errors.append(e)
+        put(end)
+
+    Thread(target=read, daemon=True).start()
+    try:
+        batch = []
+        deadline = 0
+        while True:
+            timeout = None
+            if batch:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    yield batch
+                    batch = []
+                    continue
+            try:
+                notification = queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if notification is end:
+                break
+            if not batch:
+                deadline = monotonic() + max_delay
+            batch.append(notification)
+            if len(batch) >= max_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        if errors:
+            raise errors[0]
+    finally:
+        stopped.set()
 
 
 class SimplePushClient:
-    def __init__(self, connection):
+    def __init__(self, connection, trace_sample_rate=0):
+        """
+        Args:
+            connection: connection to the collector
+            trace_sample_rate(float): fraction of the notifications to
+                stamp for tracing, see :mod:`notifyme.tracing`
+        """
         self.connection = connection
+        self.trace_sample_rate = trace_sample_rate
 
-    def send_notification(self, notification):
-        message = NotificationMessage(notification)
+    def send_message(self, message):
         wrapped_message = WrappedProtocolMessage(message)
-        logging.debug("Sending NotificationMessage")
-        self.connection.sendall(wrapped_message.text.encode('utf-8'))
+        logging.debug("Sending %s" % type(message).__name__)
+        self.connection.sendall(wrapped_message.frame)
+
+    def send_notification(self, notification):
+        if self.trace_sample_rate:
+            stamp([notification], self.trace_sample_rate)
+        self.send_message(NotificationMessage(notification,
+                                              with_trace=True))
+
+    def send_batch(self, notifications):
+        """
+        Send a list of notifications as a single NotificationBatchMessage.
+        """
+        if self.trace_sample_rate:
+            stamp(notifications, self.trace_sample_rate)
+        self.send_message(NotificationBatchMessage(notifications))
+
+    def send_notifications(self, notifications, max_batch_size=100,
+                           max_delay=0.05):
+        """
+        Send notifications from an iterable, batched by size and time.
+        See :func:`batched`.
+        """
+        for batch in batched(notifications, max_batch_size, max_delay):
+            self.send_batch(batch)
 
 
 class SSLPushClient:
-    def __init__(self, hostname, port, keyfile, certfile, serverhash=None):
+    def __init__(self, hostname, port, keyfile, certfile, serverhash=None,
+                 trace_sample_rate=0):
         """
         Initialize a SSL Connection to a remote server
 
@@ -47,6 +159,8 @@ class SSLPushClient:
             keyfile: path to the file with the SSL key
             certfile: path to the file with the SSL cert
             serverhash: hex digest of the server's SSL cert as String.
+            trace_sample_rate: fraction of the notifications to stamp for
+                tracing, see :mod:`notifyme.tracing`
         """
         class VerificationHelper:
             def __init__(self, server_hash):
@@ -65,6 +179,9 @@ class SSLPushClient:
         self._verification_helper = VerificationHelper(server_hash=serverhash)
         self.host = hostname
         self.port = port
+        self._conn = None
+        self._lock = Lock()
+        self.trace_sample_rate = trace_sample_rate
 
         # initialize SSL context
         self._ssl_context = SSL.Context(SSL.TLSv1_METHOD)
@@ -73,21 +190,105 @@ class SSLPushClient:
         self._ssl_context.set_verify(SSL.VERIFY_NONE,
                                      self._verification_helper)
 
-    def send_notification(self, notification):
+    def connect(self):
         """
-        Send a notification.
+        Open the connection to the collector and perform the handshake.
+        Called automatically by `send_notification()`.
         """
-        self._conn = SSL.Connection(self._ssl_context,
-                                    socket(AF_INET, SOCK_STREAM))
-        self._conn.connect((self.host, self.port))
+        self.close()
+        conn = SSL.Connection(self._ssl_context, socket(AF_INET, SOCK_STREAM))
+        conn.connect((self.host, self.port))
         try:
             logging.debug("trying SSL handshake")
-            self._conn.do_handshake()
+            conn.do_handshake()
         except SSL.Error:
             pass
+        self._conn = conn
+        self._decoder = FrameDecoder()
+        self._client = SimplePushClient(conn, self.trace_sample_rate)
+
+    def _connection_alive(self):
+        """
+        Check whether the collector is still there without blocking. Reads
+        and logs everything the collector sent in the meantime.
+
+        Returns:
+            `False` if the collector closed the connection
+        """
+        if self._conn is None:
+            return False
+        readable, _, _ = select([self._conn], [], [], 0)
+        if not readable and not self._conn.pending():
+            return True
+        self._conn.setblocking(False)
+        try:
+            self._decoder.read_from(self._conn)
+            for frame in self._decoder.frames():
+                message = WrappedProtocolMessage.parse(frame)
+                if isinstance(message, ErrorMessage):
+                    logging.warning("collector reported an error: %s" %
+                                    message.data['error_message'])
+        except SSL.WantReadError:
+            pass
+        except (EOFError, SSL.Error, OSError):
+            return False
+        except Exception as e:
+            # a garbled or oversized frame, nothing after it can be trusted
+            logging.warning("invalid message from collector: %s" % e)
+            return False
+        finally:
+            if self._conn is not None:
+                self._conn.setblocking(True)
+        return True
+
+    def send_message(self, message):
+        """
+        Send a message. The connection to the collector is opened on first
+        use and kept open for further messages; if the collector went away
+        in the meantime, we transparently reconnect.
+        """
+        with self._lock:
+            if not self._connection_alive():
+                self.connect()
+            try:
+                self._client.send_message(message)
+            except (SSL.Error, OSError):
+                logging.debug("connection lost, reconnecting")
+                self.connect()
+                self._client.send_message(message)
+
+    def send_notification(self, notification):
+        """
+        Send a notification.
+        """
+        if self.trace_sample_rate:
+            stamp([notification], self.trace_sample_rate)
+        self.send_message(NotificationMessage(notification,
+                                              with_trace=True))
 
-        client = SimplePushClient(self._conn)
-        client.send_notification(notification)
+    def send_notifications(self, notifications, max_batch_size=100,
+                           max_delay=0.05):
+        """
+        Send notifications from an iterable, batched by size and time.
+        See :func:`batched`.
+        """
+        for batch in batched(notifications, max_batch_size, max_delay):
+            if self.trace_sample_rate:
+                stamp(batch, self.trace_sample_rate)
+            self.send_message(NotificationBatchMessage(batch))
+
+    def close(self):
+        """
+        Close the connection to the collector, if any.
+        """
+        if self._conn is None:
+            return
+        try:
+            self._conn.shutdown()
+        except (SSL.Error, OSError):
+            pass
+        self._conn.close()
+        self._conn = None
 
     def shutdown(self):
-        self._conn.shutdown()
+        self.close()
@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from threading import Lock
+
+
 def convert_to_path(resource):
     """
     converts `resource` to it's path array, i.e. a list of strings.
@@ -86,3 +89,169 @@ def is_subresource(child, parent):
             return False
 
     return True
+
+
+class ResourceMatcher:
+    """
+    Precompiled set of resources that answers whether a resource is one of
+    them or a subresource of one of them.
+    """
+    def __init__(self, resources):
+        """
+        Compile `resources`
+
+        Args:
+            resources(list): resources, each as a string
+        """
+        self.resources = list(resources)
+        self._paths = frozenset(tuple(convert_to_path(r)) for r in resources)
+        self._depths = sorted(set(len(path) for path in self._paths))
+
+    def matches(self, resource):
+        """
+        Checks if `resource` is covered by the compiled resources
+
+        Args:
+            resource(str): resource to check
+
+        Returns:
+            `True` if `resource` is one of the resources or a subresource
+            of one of them, `False` otherwise.
+        """
+        path = tuple(convert_to_path(resource))
+        for depth in self._depths:
+            if depth > len(path):
+                break
+            if path[:depth] in self._paths:
+                return True
+        return False
+
+
+class SubscriptionIndex:
+    """
+    Index of subscriptions, organized as a trie of resource path segments.
+
+    A subscription to a resource matches the resource itself and all of its
+    subresources, so looking up the subscribers of a resource only has to
+    walk the path of that resource once.
+    """
+    class Node:
+        """
+        A single path segment in the trie
+        """
+        __slots__ = ('children', 'subscribers')
+
+        def __init__(self):
+            self.children = {}
+            self.subscribers = set()
+
+    def __init__(self):
+        """
+        Initialize an empty index
+        """
+        self._root = SubscriptionIndex.Node()
+        self._subscriptions = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        """
+        Number of subscribers in the index
+        """
+        return len(self._subscriptions)
+
+    def subscribe(self, subscriber, resources):
+        """
+        Add subscriptions for `subscriber`
+
+        Args:
+            subscriber: hashable object that receives the notifications,
+                usually a :class:`notifyme.publisher.SimplePublisher`.
+            resources(list): resources to subscribe to, each as a string
+        """
+        with self._lock:
+            subscribed = self._subscriptions.setdefault(subscriber, set())
+            for resource in resources:
+                path = tuple(convert_to_path(resource))
+                if path in subscribed:
+                    continue
+                node = self._root
+                for segment in path:
+                    child = node.children.get(segment)
+                    if child is None:
+                        child = node.children[segment] = \
+                            SubscriptionIndex.Node()
+                    node = child
+                node.subscribers.add(subscriber)
+                subscribed.add(path)
+
+    def unsubscribe(self, subscriber, resources=None):
+        """
+        Remove subscriptions of `subscriber`
+
+        Args:
+            subscriber: object previously passed to `subscribe()`
+            resources(list): resources to unsubscribe from. If `None`, all
+                subscriptions of `subscriber` are removed.
+        """
+        with self._lock:
+            subscribed = self._subscriptions.get(subscriber)
+            if subscribed is None:
+                return
+            if resources is None:
+                paths = list(subscribed)
+            else:
+                paths = [tuple(convert_to_path(r)) for r in resources]
+            for path in paths:
+                if path not in subscribed:
+                    continue
+                subscribed.discard(path)
+                self._remove_path(subscriber, path)
+            if not subscribed:
+                del self._subscriptions[subscriber]
+
+    def _remove_path(self, subscriber, path):
+        """
+        Remove `subscriber` from the node at `path` and prune nodes that
+        became empty. Must be called with the lock held.
+        """
+        trail = [self._root]
+        for segment in path:
+            trail.append(trail[-1].children[segment])
+        trail[-1].subscribers.discard(subscriber)
+        for depth in range(len(path), 0, -1):
+            node = trail[depth]
+            if node.subscribers or node.children:
+                break
+            del trail[depth - 1].children[path[depth - 1]]
+
+    def subscriptions(self, subscriber):
+        """
+        Resources `subscriber` is currently subscribed to
+
+        Returns:
+            list of resources, each as a string
+        """
+        with self._lock:
+            paths = self._subscriptions.get(subscriber, ())
+            return ['/' + '/'.join(path) for path in paths]
+
+    def lookup(self, resource):
+        """
+        Find all subscribers of `resource`
+
+        Args:
+            resource(str): resource of a notification
+
+        Returns:
+            set of subscribers that subscribed to `resource` or to one of
+            its parents.
+        """
+        with self._lock:
+            node = self._root
+            targets = set(node.subscribers)
+            for segment in convert_to_path(resource):
+                node = node.children.get(segment)
+                if node is None:
+                    break
+                targets.update(node.subscribers)
+            return targets
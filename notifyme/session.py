@@ -0,0 +1,166 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Protocol sessions that don't do any I/O.
+
+A :class:`ProtocolSession` is fed the bytes received from the peer and
+hands out the bytes to send back, everything in between (framing, parsing,
+running the state machine) happens here. Drivers only move bytes between a
+session and a socket, TLS stream or anything else, so the threaded and the
+asyncio components share the protocol code and it can be run without a
+network at all::
+
+    session = ProtocolSession(protocol)
+    session.start()
+    while True:
+        events = session.receive_data(sock.recv(4096))
+        sock.sendall(session.data_to_send())
+"""
+
+import logging
+
+from notifyme.messages import ErrorMessage, EncodedMessage, \
+    WrappedProtocolMessage, FrameDecoder
+
+
+class ProtocolError:
+    """
+    Event: a received message could not be parsed or handled
+    """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+    def __repr__(self):
+        return '<ProtocolError %r>' % self.error
+
+
+class ProtocolSession:
+    """
+    Runs a :class:`notifyme.statemachine.ProtocolStateMachine` on a stream
+    of bytes
+    """
+    def __init__(self, protocol, answer_errors=True, decoder=None,
+                 output=None):
+        """
+        Initialize a session
+
+        Args:
+            protocol(:class:`notifyme.statemachine.ProtocolStateMachine`):
+                protocol to speak
+            answer_errors(bool): answer messages that can't be parsed or
+                handled with an :class:`notifyme.messages.ErrorMessage`,
+                otherwise the exception is raised
+            decoder(:class:`notifyme.messages.FrameDecoder`): decoder for
+                the received bytes
+            output(:class:`types.FunctionType`): called with every
+                :class:`notifyme.messages.EncodedMessage` to send instead of
+                collecting it for `data_to_send()`, for drivers that have
+                their own outbound queue
+        """
+        self.protocol = protocol
+        self.answer_errors = answer_errors
+        self.decoder = decoder if decoder is not None else FrameDecoder()
+        self._outgoing = []
+        self._output = self._outgoing.append if output is None else output
+
+    def start(self):
+        """
+        Run the states that send without waiting for input, e.g. the
+        publisher's greeting. Call once before anything is received.
+        """
+        self._advance()
+
+    def _advance(self):
+        protocol = self.protocol
+        while not protocol.wait_for_input:
+            out_msg = protocol(None)
+            if out_msg is not None:
+                self.send_message(out_msg)
+
+    def receive_data(self, data=None):
+        """
+        Handle bytes received from the peer
+
+        Args:
+            data(bytes): received bytes, `None` if they have been read
+                into `decoder` directly
+
+        Returns:
+            list of events: the received
+            :class:`notifyme.messages.ProtocolMessage` objects in order and
+            a :class:`ProtocolError` for every message that failed
+
+        Raises:
+            :class:`notifyme.messages.FrameError` if the peer sent a frame
+            that is too large. The session can't be continued.
+        """
+        if data:
+            self.decoder.feed(data)
+        events = []
+        protocol = self.protocol
+        for frame in self.decoder.frames():
+            try:
+                in_msg = WrappedProtocolMessage.parse(frame)
+                events.append(in_msg)
+                out_msg = protocol(in_msg)
+            except Exception as e:
+                if not self.answer_errors:
+                    raise
+                logging.debug("could not handle message: %r" % e)
+                events.append(ProtocolError(e))
+                out_msg = ErrorMessage(e.args[0] if e.args else repr(e))
+            if out_msg is not None:
+                self._output(EncodedMessage(out_msg))
+            if not protocol.wait_for_input:
+                self._advance()
+        return events
+
+    def send_message(self, message):
+        """
+        Queue a message for the peer, e.g. a request of the application
+
+        Args:
+            message(:class:`notifyme.messages.ProtocolMessage`): message
+        """
+        self._output(EncodedMessage(message))
+
+    def send_encoded(self, encoded_message):
+        """
+        Queue an already encoded message for the peer
+
+        Args:
+            encoded_message(:class:`notifyme.messages.EncodedMessage`):
+                message
+        """
+        self._output(encoded_message)
+
+    def data_to_send(self):
+        """
+        Take the bytes to send to the peer
+
+        Returns:
+            bytes, empty if there is nothing to send
+        """
+        if not self._outgoing:
+            return b''
+        data = b''.join([encoded.frame for encoded in self._outgoing])
+        self._outgoing.clear()
+        return data
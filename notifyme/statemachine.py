@@ -17,67 +17,199 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+"""
+Table driven state machines for the protocols.
+
+A protocol is described once by a :class:`TransitionTable`. Its states are
+created when the table is built and shared by every connection speaking
+the protocol, everything specific to a connection lives in the context the
+handlers are called with. Dispatching a message is a single dictionary
+lookup on the type of the message.
+"""
+
+from threading import Lock
+from time import perf_counter
+
+
+#: message type of the transition of a state that sends without waiting
+#: for input
+SEND = type(None)
+
+#: message type matching every message that has no transition of its own
+ANY = object
+
+
 class ProtocolState:
     """
-    This is the Base class for a state machine. It's mainly there so that we
-    don't have to write the constructor and it's documentation over and over
-    again.
+    A state of a protocol
+    """
+    __slots__ = ('name', 'transitions', 'default', 'wait_for_input')
+
+    def __init__(self, name):
+        self.name = name
+        self.transitions = {}
+        self.default = None
+        self.wait_for_input = True
+
+    def __repr__(self):
+        return '<ProtocolState %s>' % self.name
 
+
+class Transition:
     """
-    def __init__(self, context):
-        """
-        Initialize the state with a context it keeps and passes on to
-        follownig states.
+    Edge of a :class:`TransitionTable`
+    """
+    __slots__ = ('source', 'message_type', 'handler', 'target')
 
-        Args:
-            context(object): state of the machine and conection to the outside
-                world.
-        """
-        self.context = context
+    def __init__(self, source, message_type, handler, target):
+        self.source = source
+        self.message_type = message_type
+        self.handler = handler
+        self.target = target
 
 
-class ReceivingProtocolState(ProtocolState):
+class Stay:
     """
-    This class exists only to make it clear semantically that this state is
-    waiting for an incoming message.
+    Returned by a handler to send `message` but stay in the current state
+    instead of taking the transition, e.g. because a request was refused.
     """
-    pass
+    __slots__ = ('message',)
+
+    def __init__(self, message=None):
+        self.message = message
 
 
-class SendingProtocolState(ProtocolState):
+class TransitionTable:
     """
-    This class semantically defines that this state immediately sends out
-    messages without waiting for messages to come in.
+    Declarative description of a protocol.
+
+    In state `source`, a message of exactly `message_type` is handed to
+    `handler(context, message)`. What the handler returns is sent to the
+    peer unless it is `None`, and the machine moves on to `target`. A state
+    whose transition has the message type `SEND` doesn't wait for input. In
+    a state without an `ANY` transition, unexpected messages are ignored.
     """
-    pass
+    def __init__(self, initial, transitions):
+        """
+        Build the states of a protocol
+
+        Args:
+            initial(str): name of the initial state
+            transitions(list): tuples of `(source, message_type, handler,
+                target)`, states are referred to by name
+
+        Raises:
+            :class:`ValueError` if the table is inconsistent
+        """
+        self.states = {}
+        for source, _, _, target in transitions:
+            for name in (source, target):
+                if name not in self.states:
+                    self.states[name] = ProtocolState(name)
+        if initial not in self.states:
+            raise ValueError('unknown initial state %s' % initial)
+        self.initial = self.states[initial]
+
+        for source, message_type, handler, target in transitions:
+            state = self.states[source]
+            # staticmethods are only callable themselves since Python 3.10
+            handler = getattr(handler, '__func__', handler)
+            transition = Transition(state, message_type, handler,
+                                    self.states[target])
+            if message_type in state.transitions or \
+                    (message_type is ANY and state.default is not None):
+                raise ValueError('duplicate transition from %s on %s'
+                                 % (source, message_type.__name__))
+            if message_type is ANY:
+                state.default = transition
+            else:
+                state.transitions[message_type] = transition
+            if message_type is SEND:
+                state.wait_for_input = False
+
+        for state in self.states.values():
+            if not state.wait_for_input and (
+                    len(state.transitions) > 1 or state.default is not None):
+                raise ValueError('sending state %s has other transitions'
+                                 % state.name)
+
+    @property
+    def transitions(self):
+        """
+        All transitions as a list
+        """
+        result = []
+        for state in self.states.values():
+            result.extend(state.transitions.values())
+            if state.default is not None:
+                result.append(state.default)
+        return result
 
 
 class ProtocolStateMachine:
     """
     State Machine Implementation
     """
-    def __init__(self, initial_state):
+    def __init__(self, table, context, hooks=None):
         """
         Initialize State Machine
 
         Args:
-            initial_state(:class:`ProtocolState`): Initial State of the
-                machine
+            table(:class:`TransitionTable`): protocol to speak
+            context(object): state of the connection and connection to the
+                outside world, handed to every handler
+            hooks(list): callables that are called after every transition,
+                see `add_hook()`
+        """
+        self.table = table
+        self.context = context
+        self.hooks = list(hooks) if hooks else []
+        self._state = table.initial
+
+    def add_hook(self, hook):
+        """
+        Call `hook(source, message_type, target, seconds)` after every
+        transition, with the names of the states, the type of the handled
+        message and the time spent in the handler. Hooks slow down every
+        transition, the machine only measures time if there are any.
         """
-        self._state = initial_state
+        self.hooks.append(hook)
+
+    @property
+    def state(self):
+        """
+        Name of the current state
+        """
+        return self._state.name
 
     def __call__(self, in_msg=None):
         """
         Advance to the next State, if any.
 
         Args:
-            in_msg(:class:`notifyme.messages.ProtocolMessage`)
-        """
-        if isinstance(self._state, ReceivingProtocolState):
-            self._state, out_msg = self._state(in_msg)
-        elif isinstance(self._state, SendingProtocolState):
-            self._state, out_msg = self._state()
+            in_msg(:class:`notifyme.messages.ProtocolMessage`): received
+                message, `None` in a state that doesn't wait for input
 
+        Returns:
+            :class:`notifyme.messages.ProtocolMessage` to send or `None`
+        """
+        state = self._state
+        transition = state.transitions.get(type(in_msg), state.default)
+        if transition is None:
+            return None
+        if self.hooks:
+            start = perf_counter()
+            out_msg = transition.handler(self.context, in_msg)
+            seconds = perf_counter() - start
+        else:
+            out_msg = transition.handler(self.context, in_msg)
+        target = transition.target
+        if type(out_msg) is Stay:
+            out_msg = out_msg.message
+            target = state
+        self._state = target
+        for hook in self.hooks:
+            hook(state.name, type(in_msg), target.name, seconds)
         return out_msg
 
     @property
@@ -88,7 +220,38 @@ class ProtocolStateMachine:
         Returns:
             Boolean
         """
-        if isinstance(self._state, ReceivingProtocolState):
-            return True
-        elif isinstance(self._state, SendingProtocolState):
-            return False
+        return self._state.wait_for_input
+
+
+class TransitionStats:
+    """
+    Hook for :class:`ProtocolStateMachine` that counts transitions and the
+    time spent in their handlers. One instance can be shared by any number
+    of machines and threads.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self._counts = {}
+
+    def __call__(self, source, message_type, target, seconds):
+        key = (source, message_type.__name__, target)
+        with self.lock:
+            entry = self._counts.get(key)
+            if entry is None:
+                self._counts[key] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    @property
+    def stats(self):
+        """
+        Count and total handler time of every transition taken so far
+
+        Returns:
+            dict mapping `(source, message type name, target)` to a dict
+            with `count` and `seconds`
+        """
+        with self.lock:
+            return {key: {'count': count, 'seconds': seconds}
+                    for key, (count, seconds) in self._counts.items()}
@@ -16,16 +16,156 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 from hashlib import sha256
 from OpenSSL import SSL, crypto
-from socket import socket, AF_INET, SOCK_STREAM
-from threading import Thread, Lock
+from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR
+from collections import deque
+from threading import Thread, Lock, Condition, Event
 import logging
 
 from notifyme.messages import SubscribeMessage, ConfirmationMessage, \
-    ErrorMessage, NotificationMessage, PublishMessage, WrappedProtocolMessage
-from notifyme.statemachine import ReceivingProtocolState
-from notifyme.statemachine import ProtocolStateMachine
+    ErrorMessage, NotificationMessage, PublishMessage, UnsubscribeMessage, \
+    HistoryQueryMessage, HistoryResultMessage, WrappedProtocolMessage, \
+    FrameError
+from notifyme.backoff import ExponentialBackoff
+from notifyme.aio import TLSStream
+from notifyme.session import ProtocolSession
+from notifyme.statemachine import ProtocolStateMachine, TransitionTable, \
+    ANY
+
+
+#: wait until the executor's queue has room again
+BLOCK = 'block'
+#: throw away the oldest notification queued for the same worker
+DROP_OLDEST = 'drop-oldest'
+#: throw away the notification that doesn't fit
+DROP_NEWEST = 'drop-newest'
+
+FULL_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+#: handshake errors caused by the connection rather than the publisher
+#: refusing us, they are retried like any other connection error
+TRANSIENT_SSL_ERRORS = (SSL.SysCallError, SSL.ZeroReturnError)
+
+
+class SubscriptionError(Exception):
+    """
+    Raised if the publisher rejects the subscription made when connecting
+    """
+    pass
+
+
+class CallbackExecutor:
+    """
+    Runs notification callbacks on a pool of worker threads so a slow
+    callback doesn't stop the subscriber from reading.
+
+    Every resource is always handled by the same worker, so notifications
+    of one resource are passed to the callback in the order they arrived.
+    """
+    def __init__(self, callback, workers=4, maxsize=1000,
+                 full_policy=BLOCK):
+        """
+        Start the workers
+
+        Args:
+            callback(:class:`types.FunctionType`): called with every
+                notification
+            workers(int): number of worker threads
+            maxsize(int): maximum number of notifications waiting for a
+                worker
+            full_policy(str): what to do when `maxsize` is reached, one of
+                `FULL_POLICIES`
+        """
+        if full_policy not in FULL_POLICIES:
+            raise ValueError("Unknown full policy: %s" % full_policy)
+        self.callback = callback
+        self.maxsize = maxsize
+        self.full_policy = full_policy
+        self.closed = False
+        self.dropped = 0
+        self._size = 0
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self._queues = [deque() for _ in range(workers)]
+        self._not_empty = [Condition(self._lock) for _ in range(workers)]
+        self._workers = [Thread(target=self._work, args=(i,), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def stats(self):
+        """
+        Queue depth and drop counter as a dict
+        """
+        return {'depth': self._size, 'dropped': self.dropped}
+
+    def submit(self, notification):
+        """
+        Queue a notification for the callback
+
+        Args:
+            notification(dict): notification as received
+
+        Returns:
+            `False` if the notification has been dropped
+        """
+        i = hash(notification['resource']) % len(self._queues)
+        queue = self._queues[i]
+        with self._lock:
+            while self._size >= self.maxsize and not self.closed:
+                if self.full_policy == BLOCK:
+                    self._not_full.wait()
+                elif self.full_policy == DROP_OLDEST and queue:
+                    queue.popleft()
+                    self._size -= 1
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+            if self.closed:
+                return False
+            queue.append(notification)
+            self._size += 1
+            self._not_empty[i].notify()
+        return True
+
+    def _work(self, i):
+        queue = self._queues[i]
+        while True:
+            with self._lock:
+                while not queue and not self.closed:
+                    self._not_empty[i].wait()
+                if not queue:
+                    return
+                notification = queue.popleft()
+                self._size -= 1
+                self._not_full.notify()
+            try:
+                self.callback(notification)
+            except Exception:
+                logging.exception("notification callback failed")
+
+    def close(self, wait=True):
+        """
+        Stop accepting notifications. The workers finish what is queued.
+
+        Args:
+            wait(bool): wait until all queued notifications are handled
+        """
+        with self._lock:
+            self.closed = True
+            self._not_full.notify_all()
+            for condition in self._not_empty:
+                condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
 
 
 class SubscriberProtocol(ProtocolStateMachine):
@@ -33,7 +173,10 @@ class SubscriberProtocol(ProtocolStateMachine):
     Represents the state machine that handles all the interaction
     with a Publisher from a Subscriber's point of view
     """
-    def __init__(self, notification_callback, subscribed_resources):
+    def __init__(self, notification_callback, subscribed_resources,
+                 since_sequence=None, since_timestamp=None,
+                 history_callback=None, filters=None, hooks=None,
+                 epoch=None, last_timestamp=None):
         """
         Initialize a Subscriber
 
@@ -44,76 +187,191 @@ class SubscriberProtocol(ProtocolStateMachine):
                 argument.
             subscribed_resources(list): list of resource identifiers
                 (str)
+            since_sequence(int): have the publisher replay its backlog
+                after this sequence number first
+            since_timestamp(float): have the publisher replay its backlog
+                since this UNIX time first
+            history_callback(:class:`types.FunctionType`): called with
+                every :class:`notifyme.messages.HistoryResultMessage`
+            filters(dict): have the publisher send only notifications that
+                match, see :class:`notifyme.filters.NotificationFilter`
+            hooks(list): transition hooks, see
+                :meth:`notifyme.statemachine.ProtocolStateMachine.add_hook`
+            epoch(str): epoch of the publisher `since_sequence` refers to.
+                If the publisher announces another epoch, its numbering
+                started over and the replay starts at `last_timestamp`
+                instead, or at the beginning of the backlog if that is
+                `None` as well.
+            last_timestamp(float): UNIX time the publisher received the
+                last notification delivered so far
         """
-        self.context = {
+        context = {
             'subscribed_resources': subscribed_resources,
-            'notification_callback': notification_callback
+            'confirmations': 0,
+            'notification_callback': notification_callback,
+            'since_sequence': since_sequence,
+            'since_timestamp': since_timestamp,
+            'last_sequence': None,
+            'last_timestamp': last_timestamp,
+            'epoch': epoch,
+            'history_callback': history_callback,
+            'filters': filters
         }
-        init_state = SubscriberProtocol.ReceivePublishMessageState(
-            self.context)
-        ProtocolStateMachine.__init__(self, init_state)
+        ProtocolStateMachine.__init__(self, SubscriberProtocol.TRANSITIONS,
+                                      context, hooks=hooks)
 
-    class ReceivePublishMessageState(ReceivingProtocolState):
+    @staticmethod
+    def receive_publish_message(context, in_msg):
         """
-        Wait for a `notifyme.messages.PublishMessage` and return a
-        `notifyme.messages.SubscribeMessage`.
+        Answer the PublishMessage with a SubscribeMessage
         """
-        def __call__(self, in_msg):
-            if not isinstance(in_msg, PublishMessage):
-                return self, None
-            self.context['published_resources'] = \
-                in_msg.data['published_resources']
-            sub_msg = SubscribeMessage(subscribed_resources=
-                                       self.context['subscribed_resources'])
-            logging.debug("received PublishMessage")
-            return SubscriberProtocol.ReceiveConfirmMessageState(
-                self.context), sub_msg
+        logging.debug("received PublishMessage")
+        context['published_resources'] = in_msg.data['published_resources']
+        since_sequence = context['since_sequence']
+        since_timestamp = context['since_timestamp']
+        if since_sequence is not None and context['epoch'] is not None and \
+                in_msg.epoch != context['epoch']:
+            # the publisher restarted, our sequence number means nothing
+            # to it anymore
+            logging.info("publisher restarted, resuming by timestamp")
+            since_sequence = None
+            since_timestamp = context['last_timestamp']
+            if since_timestamp is None:
+                since_sequence = 0
+            # nothing of the new numbering has been delivered yet
+            context['last_sequence'] = 0
+        context['epoch'] = in_msg.epoch
+        return SubscribeMessage(
+            subscribed_resources=context['subscribed_resources'],
+            since_sequence=since_sequence,
+            since_timestamp=since_timestamp,
+            filters=context['filters'])
 
-    class ReceiveConfirmMessageState(ReceivingProtocolState):
-        """
-        Wait for a `notifyme.messages.ConfirmationMessage`
-        """
-        def __call__(self, in_msg):
-            if isinstance(in_msg, ErrorMessage):
-                logging.critical('Some resources were not available')
-                raise Exception('Some subscribed resources were not available!')
-            elif not isinstance(in_msg, ConfirmationMessage):
-                return self, None
-            logging.debug("received ConfirmationMessage")
-            return SubscriberProtocol.ReceiveNotificationState(
-                self.context), None
+    @staticmethod
+    def receive_confirmation(context, in_msg):
+        logging.debug("received ConfirmationMessage")
+        context['subscribed_resources'] = in_msg.data['confirmed_resources']
+        context['confirmations'] += 1
 
-    class ReceiveNotificationState(ReceivingProtocolState):
-        """
-        Receive and Handle a `notifyme.messages.NotificationMessage`
-        """
-        def __call__(self, in_msg):
-            if not isinstance(in_msg, NotificationMessage):
-                return self, ErrorMessage(error_message=
-                                          "Unexpected ProtocolMessage")
-            logging.debug("received NotificationMessage")
-            self.context['notification_callback'](in_msg.data)
+    @staticmethod
+    def subscription_failed(context, in_msg):
+        logging.critical('Some resources were not available')
+        raise SubscriptionError(
+            'Some subscribed resources were not available!')
+
+    @staticmethod
+    def receive_notification(context, in_msg):
+        logging.debug("received NotificationMessage")
+        if in_msg.sequence is not None:
+            context['last_sequence'] = in_msg.sequence
+        if in_msg.timestamp is not None:
+            context['last_timestamp'] = in_msg.timestamp
+        context['notification_callback'](in_msg.data)
 
-            return self, None
+    @staticmethod
+    def receive_history_result(context, in_msg):
+        logging.debug("received HistoryResultMessage")
+        if context['history_callback'] is not None:
+            context['history_callback'](in_msg)
+
+    @staticmethod
+    def subscriptions_changed(context, in_msg):
+        logging.debug("subscriptions changed")
+        context['subscribed_resources'] = in_msg.data['confirmed_resources']
+        context['confirmations'] += 1
+
+    @staticmethod
+    def receive_error(context, in_msg):
+        # never answer errors with errors
+        logging.error("publisher reported an error: %s"
+                      % in_msg.data['error_message'])
+
+    @staticmethod
+    def unexpected_message(context, in_msg):
+        return ErrorMessage(error_message="Unexpected ProtocolMessage")
+
+    @staticmethod
+    def ignore(context, in_msg):
+        return None
+
+    # Once subscribed, confirmations and errors answer subscription changes
+    # and history queries made during the session.
+    TRANSITIONS = TransitionTable('receive_publish', [
+        ('receive_publish', PublishMessage, receive_publish_message,
+         'receive_confirmation'),
+        ('receive_publish', ANY, ignore, 'receive_publish'),
+        ('receive_confirmation', ConfirmationMessage, receive_confirmation,
+         'subscribed'),
+        ('receive_confirmation', ErrorMessage, subscription_failed,
+         'receive_confirmation'),
+        ('receive_confirmation', ANY, ignore, 'receive_confirmation'),
+        ('subscribed', NotificationMessage, receive_notification,
+         'subscribed'),
+        ('subscribed', HistoryResultMessage, receive_history_result,
+         'subscribed'),
+        ('subscribed', ConfirmationMessage, subscriptions_changed,
+         'subscribed'),
+        ('subscribed', ErrorMessage, receive_error, 'subscribed'),
+        ('subscribed', ANY, unexpected_message, 'subscribed'),
+    ])
+
+
+class VerificationHelper:
+    """
+    Verify callback that accepts the publisher's certificate if its sha256
+    hash is `server_hash`, or any certificate if `server_hash` is `None`.
+    """
+    def __init__(self, server_hash):
+        self.server_hash = server_hash
+
+    def __call__(self, conn, cert, a, b, c):
+        if self.server_hash is not None:
+            cert_hash = sha256()
+            cert_hash.update(crypto.dump_certificate(1, cert))
+            if cert_hash.hexdigest() == self.server_hash:
+                return True
+        else:
+            return True
 
 
 class SimpleSubscriber(Thread):
     def __init__(self, hostname, port, certfile, keyfile,
                  subscribed_resources, notification_callback,
-                 serverhash=None):
-        class VerificationHelper:
-            def __init__(self, server_hash):
-                self.server_hash = server_hash
-
-            def __call__(self, conn, cert, a, b, c):
-                if self.server_hash is not None:
-                    cert_hash = sha256()
-                    cert_hash.update(crypto.dump_certificate(1, cert))
-                    if cert_hash.hexdigest() == self.server_hash:
-                        return True
-                else:
-                    return True
+                 serverhash=None, since_sequence=None, since_timestamp=None,
+                 history_callback=None, reconnect=True, backoff=None,
+                 callback_workers=None, callback_queue_size=1000,
+                 callback_full_policy=BLOCK, filters=None):
+        """
+        Initialize a subscriber
 
+        Args:
+            hostname(str): publisher to connect to
+            port(int): port of the publisher
+            certfile(str): path to certfile
+            keyfile(str): path to keyfile
+            subscribed_resources(list): resources to subscribe to
+            notification_callback(:class:`types.FunctionType`): called with
+                every notification
+            serverhash(str): sha256 hash of the publisher's certificate
+            since_sequence(int): replay the publisher's backlog after this
+                sequence number first
+            since_timestamp(float): replay the publisher's backlog since
+                this UNIX time first
+            history_callback(:class:`types.FunctionType`): called with every
+                :class:`notifyme.messages.HistoryResultMessage`
+            reconnect(bool): reconnect if the connection is lost, resuming
+                after the last notification received
+            backoff(:class:`notifyme.backoff.ExponentialBackoff`): delays
+                between reconnection attempts
+            callback_workers(int): run `notification_callback` on this many
+                worker threads instead of the receiving thread, see
+                :class:`CallbackExecutor`
+            callback_queue_size(int): notifications waiting for a worker
+            callback_full_policy(str): what to do if too many notifications
+                are waiting, one of `FULL_POLICIES`
+            filters(dict): have the publisher send only notifications that
+                match, see :class:`notifyme.filters.NotificationFilter`
+        """
         self.running = True
         Thread.__init__(self)
         self.hostname = hostname
@@ -123,15 +381,99 @@ class SimpleSubscriber(Thread):
         self.serverhash = serverhash
         self.verification_helper = VerificationHelper(serverhash)
         self.lock = Lock()
+        self.notification_callback = notification_callback
+        self.executor = None
+        if callback_workers:
+            self.executor = CallbackExecutor(
+                notification_callback, workers=callback_workers,
+                maxsize=callback_queue_size,
+                full_policy=callback_full_policy)
+        self.subscribed_resources = subscribed_resources
+        self.since_sequence = since_sequence
+        self.since_timestamp = since_timestamp
+        self.history_callback = history_callback
+        self.filters = filters
+
+        # reconnection state
+        self.reconnect = reconnect
+        self.backoff = backoff or ExponentialBackoff()
+        self.connected = False
+        self.connections = 0
+        self.disconnects = 0
+        self.last_error = None
+        self._stopped = Event()
 
         self._ssl_context = SSL.Context(SSL.TLSv1_METHOD)
         self._ssl_context.use_privatekey_file(keyfile)
         self._ssl_context.use_certificate_file(certfile)
         self._ssl_context.set_verify(SSL.VERIFY_NONE, self.verification_helper)
 
-        self._protocol = SubscriberProtocol(
+        self._sock = None
+        self._protocol = None
+        self._protocol_session = None
+        self._resume_sequence = since_sequence
+        self._resume_timestamp = None
+        self._epoch = None
+        self._protocol = self._new_protocol()
+
+    def _new_protocol(self):
+        """
+        Protocol for a new connection, resuming after the last notification
+        received so far
+        """
+        self._resume_sequence = self.last_sequence
+        if self._protocol is not None:
+            context = self._protocol.context
+            self._epoch = context['epoch']
+            if context['last_timestamp'] is not None:
+                self._resume_timestamp = context['last_timestamp']
+        since_sequence = self.since_sequence
+        since_timestamp = self.since_timestamp
+        if self._resume_sequence is not None:
+            since_sequence = self._resume_sequence
+            since_timestamp = None
+        if self.executor is not None:
+            notification_callback = self.executor.submit
+        else:
+            notification_callback = self.notification_callback
+        return SubscriberProtocol(
             notification_callback=notification_callback,
-            subscribed_resources=subscribed_resources)
+            subscribed_resources=self.subscribed_resources,
+            since_sequence=since_sequence,
+            since_timestamp=since_timestamp,
+            history_callback=self.history_callback,
+            filters=self.filters,
+            epoch=self._epoch,
+            last_timestamp=self._resume_timestamp)
+
+    @property
+    def last_sequence(self):
+        """
+        Sequence number of the last notification delivered, `None` if none
+        has been delivered or the publisher doesn't number them
+        """
+        if self._protocol is None or \
+                self._protocol.context['last_sequence'] is None:
+            return self._resume_sequence
+        return self._protocol.context['last_sequence']
+
+    @property
+    def stats(self):
+        """
+        Connection and reconnection counters as a dict
+        """
+        stats = {
+            'connected': self.connected,
+            'connections': self.connections,
+            'disconnects': self.disconnects,
+            'last_error': self.last_error,
+            'last_sequence': self.last_sequence,
+            'backoff_attempts': self.backoff.attempts,
+            'backoff_delay': self.backoff.last_delay
+        }
+        if self.executor is not None:
+            stats['callback_queue'] = self.executor.stats
+        return stats
 
     def send_message(self, message):
         """
@@ -143,9 +485,61 @@ class SimpleSubscriber(Thread):
         """
         wrapped_message = WrappedProtocolMessage(message)
         self.lock.acquire()
-        self._sock.send(wrapped_message.text.encode('utf-8'))
+        self._sock.sendall(wrapped_message.frame)
         self.lock.release()
 
+    def subscribe(self, resources, filters=None):
+        """
+        Subscribe to more resources without reconnecting. Once the
+        publisher confirmed them, the subscriptions are kept when
+        reconnecting. If not connected, they are made when connecting.
+
+        Args:
+            resources(list): resources to subscribe to in addition
+            filters(dict): replace the filters of this subscriber
+        """
+        if filters is not None:
+            self.filters = filters
+        with self.lock:
+            if self.connected:
+                self._sock.sendall(SubscribeMessage(
+                    subscribed_resources=resources,
+                    filters=filters).wrapped.frame)
+                return
+            self.subscribed_resources = self.subscribed_resources + \
+                [r for r in resources if r not in self.subscribed_resources]
+
+    def unsubscribe(self, resources):
+        """
+        Stop receiving notifications of `resources` without reconnecting
+
+        Args:
+            resources(list): resources to unsubscribe from
+        """
+        with self.lock:
+            self.subscribed_resources = [r for r in self.subscribed_resources
+                                         if r not in resources]
+            if self.connected:
+                self._sock.sendall(UnsubscribeMessage(
+                    unsubscribed_resources=resources).wrapped.frame)
+
+    def query_history(self, resource, since=None, until=None, limit=100,
+                      cursor=None):
+        """
+        Ask the publisher for stored notifications, the result is passed to
+        `history_callback`.
+
+        Args:
+            resource(str): resource prefix to query
+            since(float): UNIX time of the oldest notification
+            until(float): UNIX time of the newest notification
+            limit(int): page size
+            cursor(list): cursor of the previous result to get the next page
+        """
+        self.send_message(HistoryQueryMessage(resource, since=since,
+                                              until=until, limit=limit,
+                                              cursor=cursor))
+
     def receive_message(self):
         """
         Receives a message from the connected Peer, blocks as long
@@ -154,33 +548,410 @@ class SimpleSubscriber(Thread):
         Returns:
             :class:`notifyme.messages.ProtocolMessage`
         """
-        try:
-            received_bytes = self._sock.recv(1024)
-            received_string = received_bytes.decode('utf-8')
-            in_msg = WrappedProtocolMessage.parse(received_string)
-            return in_msg
-        except SSL.WantReadError:
-            self.running = False
+        decoder = self._protocol_session.decoder
+        return decoder.receive_message(self._sock)
 
-    def run(self):
-        logging.debug("starting subscriber")
-        # set up network connection
+    def _connect(self):
+        """
+        Connect and perform the TLS handshake
+
+        Raises:
+            :class:`OSError` if the publisher can't be reached,
+            :class:`OpenSSL.SSL.Error` if the handshake failed. Unless the
+            connection broke during the handshake, the subscriber stops.
+        """
         self._sock = SSL.Connection(self._ssl_context,
                                     socket(AF_INET, SOCK_STREAM))
         self._sock.connect((self.hostname, self.port))
+        logging.debug("trying SSL Handshake")
         try:
-            logging.debug("trying SSL Handshake")
             self._sock.do_handshake()
-        except SSL.Error as e:
+        except TRANSIENT_SSL_ERRORS:
+            raise
+        except SSL.Error:
             logging.critical("Server rejected your certificate")
             self.running = False
+            raise
+
+    def _session(self):
+        """
+        Talk to the publisher until the connection breaks
+        """
+        session = self._protocol_session
+        context = self._protocol.context
+        confirmations = 0
+        session.start()
+        while self.running:
+            session.decoder.read_from(self._sock)
+            session.receive_data()
+            if context['confirmations'] != confirmations:
+                # resubscribe to what the publisher confirmed
+                confirmations = context['confirmations']
+                with self.lock:
+                    self.subscribed_resources = \
+                        context['subscribed_resources']
+            data = session.data_to_send()
+            if data:
+                with self.lock:
+                    self._sock.sendall(data)
+
+    def stop(self):
+        """
+        Disconnect and don't reconnect. May be called from other threads.
+        """
+        self.running = False
+        self._stopped.set()
+        if self._sock is not None:
+            try:
+                self._sock.sock_shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        logging.debug("starting subscriber")
+        while self.running:
+            try:
+                self._connect()
+                with self.lock:
+                    # subscriptions made from now on are sent right away
+                    self._protocol = self._new_protocol()
+                    self._protocol_session = ProtocolSession(
+                        self._protocol, answer_errors=False)
+                    self.connected = True
+                self.connections += 1
+                self.backoff.reset()
+                self._session()
+            except (EOFError, FrameError, SSL.Error, OSError) as e:
+                self.last_error = repr(e)
+                if self.running:
+                    logging.warning("connection to publisher lost: %r" % e)
+            except SubscriptionError as e:
+                self.last_error = repr(e)
+                self.running = False
+            finally:
+                with self.lock:
+                    if self.connected:
+                        self.disconnects += 1
+                    self.connected = False
+                if self._sock is not None:
+                    self._sock.close()
+
+            if not (self.running and self.reconnect):
+                break
+            delay = self.backoff.next_delay()
+            logging.debug("reconnecting in %.1f seconds" % delay)
+            self._stopped.wait(delay)
+        self.running = False
+        if self.executor is not None:
+            self.executor.close()
+
+
+class AsyncSubscriber:
+    """
+    Subscriber for asyncio applications. Notifications of any number of
+    publishers are delivered through a single async iterator::
+
+        subscriber = AsyncSubscriber(certfile, keyfile)
+        subscriber.add_publisher('example.org', 10023, ['/irc'])
+        async with subscriber:
+            async for notification in subscriber:
+                ...
+
+    At most `max_pending` notifications are buffered. If the consumer falls
+    behind, the connections stop reading until there is room again.
+    """
+    #: marks the end of the iteration
+    _CLOSED = object()
+
+    class Publisher:
+        """
+        State and counters of the connection to a single publisher
+        """
+        def __init__(self, hostname, port, subscribed_resources, serverhash,
+                     since_sequence, since_timestamp, backoff, filters):
+            self.hostname = hostname
+            self.filters = filters
+            self.stream = None
+            self.port = port
+            self.subscribed_resources = subscribed_resources
+            self.serverhash = serverhash
+            self.since_sequence = since_sequence
+            self.since_timestamp = since_timestamp
+            self.backoff = backoff or ExponentialBackoff()
+            self.last_sequence = since_sequence
+            self.last_timestamp = None
+            self.epoch = None
+            self.connected = False
+            self.connections = 0
+            self.disconnects = 0
+            self.last_error = None
+
+        @property
+        def stats(self):
+            """
+            Connection and reconnection counters as a dict
+            """
+            return {
+                'connected': self.connected,
+                'connections': self.connections,
+                'disconnects': self.disconnects,
+                'last_error': self.last_error,
+                'last_sequence': self.last_sequence,
+                'backoff_attempts': self.backoff.attempts,
+                'backoff_delay': self.backoff.last_delay
+            }
+
+    def __init__(self, certfile, keyfile, max_pending=100, reconnect=True):
+        """
+        Initialize a subscriber without any publishers
+
+        Args:
+            certfile(str): path to certfile
+            keyfile(str): path to keyfile
+            max_pending(int): notifications buffered for the consumer
+            reconnect(bool): reconnect to publishers if the connection is
+                lost, resuming after the last notification received
+        """
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.max_pending = max_pending
+        self.reconnect = reconnect
+        self.running = False
+        self.publishers = []
+        self._queue = None
+        self._tasks = []
+
+    def add_publisher(self, hostname, port, subscribed_resources,
+                      serverhash=None, since_sequence=None,
+                      since_timestamp=None, backoff=None, filters=None):
+        """
+        Subscribe to `subscribed_resources` at another publisher. Can be
+        called while the subscriber is running.
+
+        Args:
+            hostname(str): publisher to connect to
+            port(int): port of the publisher
+            subscribed_resources(list): resources to subscribe to
+            serverhash(str): sha256 hash of the publisher's certificate
+            since_sequence(int): replay the publisher's backlog after this
+                sequence number first
+            since_timestamp(float): replay the publisher's backlog since
+                this UNIX time first
+            backoff(:class:`notifyme.backoff.ExponentialBackoff`): delays
+                between reconnection attempts
+            filters(dict): have the publisher send only notifications that
+                match, see :class:`notifyme.filters.NotificationFilter`
+
+        Returns:
+            :class:`AsyncSubscriber.Publisher`
+        """
+        publisher = AsyncSubscriber.Publisher(
+            hostname, port, subscribed_resources, serverhash,
+            since_sequence, since_timestamp, backoff, filters)
+        self.publishers.append(publisher)
+        if self.running:
+            self._tasks.append(asyncio.ensure_future(self._run(publisher)))
+        return publisher
+
+    def start(self):
+        """
+        Connect to all publishers. Has to be called from within the event
+        loop, iterating or entering the subscriber does it implicitly.
+        """
+        if self.running:
+            return
+        self.running = True
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [asyncio.ensure_future(self._run(publisher))
+                       for publisher in self.publishers]
+
+    async def close(self):
+        """
+        Disconnect from all publishers and end the iteration
+        """
+        self.running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._end_iteration()
+
+    async def subscribe(self, publisher, resources, filters=None):
+        """
+        Subscribe to more resources of `publisher` without reconnecting.
+        Once the publisher confirmed them, the subscriptions are kept when
+        reconnecting.
+
+        Args:
+            publisher(:class:`AsyncSubscriber.Publisher`): as returned by
+                `add_publisher()`
+            resources(list): resources to subscribe to in addition
+            filters(dict): replace the filters for this publisher
+        """
+        if filters is not None:
+            publisher.filters = filters
+        if publisher.stream is None:
+            publisher.subscribed_resources = \
+                publisher.subscribed_resources + \
+                [r for r in resources
+                 if r not in publisher.subscribed_resources]
+            return
+        await self._send(publisher, SubscribeMessage(
+            subscribed_resources=resources, filters=filters))
+
+    async def unsubscribe(self, publisher, resources):
+        """
+        Stop receiving notifications of `resources` from `publisher`
+
+        Args:
+            publisher(:class:`AsyncSubscriber.Publisher`): as returned by
+                `add_publisher()`
+            resources(list): resources to unsubscribe from
+        """
+        publisher.subscribed_resources = [
+            r for r in publisher.subscribed_resources if r not in resources]
+        await self._send(publisher, UnsubscribeMessage(
+            unsubscribed_resources=resources))
+
+    async def _send(self, publisher, message):
+        """
+        Send `message` if connected, otherwise the change is made when
+        connecting
+        """
+        if publisher.stream is not None:
+            publisher.stream.write(message.wrapped.frame)
+            await publisher.stream.drain()
+
+    def _end_iteration(self):
+        while True:
+            try:
+                self._queue.put_nowait(AsyncSubscriber._CLOSED)
+                return
+            except asyncio.QueueFull:
+                self._queue.get_nowait()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        notification = await self._queue.get()
+        if notification is AsyncSubscriber._CLOSED:
+            # let other consumers see the end as well
+            self._queue.put_nowait(notification)
+            raise StopAsyncIteration
+        return notification
+
+    def _ssl_context(self, serverhash):
+        ssl_context = SSL.Context(SSL.TLSv1_METHOD)
+        ssl_context.use_privatekey_file(self.keyfile)
+        ssl_context.use_certificate_file(self.certfile)
+        ssl_context.set_verify(SSL.VERIFY_NONE, VerificationHelper(serverhash))
+        return ssl_context
+
+    async def _run(self, publisher):
+        """
+        Keep a connection to `publisher` until the subscriber is closed or
+        the publisher rejects us.
+        """
+        ssl_context = self._ssl_context(publisher.serverhash)
+        try:
+            while self.running:
+                stream = None
+                try:
+                    reader, writer = await asyncio.open_connection(
+                        publisher.hostname, publisher.port)
+                    stream = TLSStream(ssl_context, reader, writer,
+                                       server_side=False)
+                    await stream.do_handshake()
+                    publisher.connected = True
+                    publisher.connections += 1
+                    publisher.backoff.reset()
+                    await self._session(publisher, stream)
+                except SSL.Error as e:
+                    publisher.last_error = repr(e)
+                    if not publisher.connected and \
+                            not isinstance(e, TRANSIENT_SSL_ERRORS):
+                        logging.critical("%s rejected your certificate"
+                                         % publisher.hostname)
+                        break
+                    logging.warning("connection to %s lost: %r"
+                                    % (publisher.hostname, e))
+                except (EOFError, FrameError, OSError) as e:
+                    publisher.last_error = repr(e)
+                    logging.warning("connection to %s lost: %r"
+                                    % (publisher.hostname, e))
+                except Exception as e:
+                    publisher.last_error = repr(e)
+                    logging.critical("giving up on %s: %s"
+                                     % (publisher.hostname, e))
+                    break
+                finally:
+                    if publisher.connected:
+                        publisher.disconnects += 1
+                    publisher.connected = False
+                    publisher.stream = None
+                    if stream is not None:
+                        stream.close()
+
+                if not (self.running and self.reconnect):
+                    break
+                await asyncio.sleep(publisher.backoff.next_delay())
+        finally:
+            if self.running and all(t.done() for t in self._tasks
+                                    if t is not asyncio.current_task()):
+                self._end_iteration()
+
+    async def _session(self, publisher, stream):
+        """
+        Talk to the publisher until the connection breaks. Received
+        notifications are put into the queue, waiting if it is full.
+        """
+        since_sequence = publisher.last_sequence
+        since_timestamp = None
+        if since_sequence is None:
+            since_timestamp = publisher.since_timestamp
+        received = []
+        publisher.stream = stream
+        protocol = SubscriberProtocol(
+            notification_callback=received.append,
+            subscribed_resources=publisher.subscribed_resources,
+            since_sequence=since_sequence,
+            since_timestamp=since_timestamp,
+            filters=publisher.filters,
+            epoch=publisher.epoch,
+            last_timestamp=publisher.last_timestamp)
+        session = ProtocolSession(protocol, answer_errors=False)
+        session.start()
+        confirmations = 0
 
         while self.running:
-            if self._protocol.wait_for_input:
-                in_msg = self.receive_message()
-            else:
-                in_msg = None
-
-            out_msg = self._protocol(in_msg)
-            if out_msg is not None:
-                self.send_message(out_msg)
+            await stream.read_into(session.decoder)
+            session.receive_data()
+            if protocol.context['confirmations'] != confirmations:
+                # resubscribe to what the publisher confirmed
+                confirmations = protocol.context['confirmations']
+                publisher.subscribed_resources = \
+                    protocol.context['subscribed_resources']
+            if protocol.context['epoch'] != publisher.epoch:
+                if publisher.epoch is not None:
+                    publisher.last_sequence = \
+                        protocol.context['last_sequence']
+                publisher.epoch = protocol.context['epoch']
+            data = session.data_to_send()
+            if data:
+                stream.write(data)
+                await stream.drain()
+            for notification in received:
+                await self._queue.put(notification)
+                if 'sequence' in notification:
+                    publisher.last_sequence = notification['sequence']
+                if 'timestamp' in notification:
+                    publisher.last_timestamp = notification['timestamp']
+            received.clear()
@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+# This file is part of notifyme.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Latency tracing of single notifications through the daemon.
+
+A traced notification carries a :class:`Trace`. A push client stamps it
+with the time it was pushed, the daemon stamps it when the collector
+receives it, when the publisher starts and finishes routing it and every
+time it has been written to a subscriber. A :class:`Tracer` turns the
+stamps into a latency histogram per stage:
+
+* `push`: from the push client to the collector
+* `collect`: from the collector to the publisher
+* `route`: looking up the subscribers, storing and encoding
+* `send`: waiting in a subscriber's queue and being written to its socket,
+  once per subscriber
+* `total`: from the collector to a subscriber's socket, once per subscriber
+
+Only the push time is sent over the wire. It is taken from the wall clock,
+as it is compared to the clock of another host, the daemon's stamps are
+taken from the monotonic `time.perf_counter()`.
+
+Notifications are traced if the push client stamped them or if the
+tracer samples them; untraced notifications cost the daemon a single
+`None` check per stage.
+"""
+
+import random
+from time import time, perf_counter
+
+from notifyme.metrics import MetricsRegistry, LATENCY_BUCKETS
+
+
+#: Stages of :class:`Tracer`
+STAGES = ('push', 'collect', 'route', 'send', 'total')
+
+
+class Trace:
+    """
+    Stamps of a single notification
+    """
+    __slots__ = ('pushed', 'received', 'route_start', 'route_end')
+
+    def __init__(self, pushed=None):
+        """
+        Args:
+            pushed(float): UNIX time the notification was pushed, if known
+        """
+        self.pushed = pushed
+        self.received = None
+        self.route_start = None
+        self.route_end = None
+
+    def to_dict(self):
+        """
+        The part of the trace that is sent over the wire
+
+        Returns:
+            dict, or `None` if there is nothing to send
+        """
+        if self.pushed is None:
+            return None
+        return {'pushed': self.pushed}
+
+    @classmethod
+    def from_dict(cls, trace_dict):
+        """
+        Trace received over the wire, `None` if it is malformed
+        """
+        if not isinstance(trace_dict, dict):
+            return None
+        pushed = trace_dict.get('pushed')
+        if type(pushed) not in (int, float):
+            return None
+        return cls(pushed=pushed)
+
+
+def stamp(notifications, sample_rate=1.0):
+    """
+    Trace a random sample of notifications that are about to be pushed
+
+    Args:
+        notifications(list): :class:`notifyme.notification.Notification`
+            objects, stamped in place
+        sample_rate(float): fraction of the notifications to trace
+    """
+    now = time()
+    for notification in notifications:
+        if sample_rate >= 1 or random.random() < sample_rate:
+            notification.trace = Trace(pushed=now)
+
+
+class TracedMessage:
+    """
+    Encoded notification and its trace. Behaves like an
+    :class:`notifyme.messages.EncodedMessage`, so it can be queued for a
+    subscriber in its place.
+    """
+    __slots__ = ('message', 'frame', 'resource', 'trace')
+
+    def __init__(self, encoded_message, trace):
+        self.message = encoded_message.message
+        self.frame = encoded_message.frame
+        self.resource = encoded_message.resource
+        self.trace = trace
+
+
+class Tracer:
+    """
+    Aggregates the traces of all notifications into one histogram per
+    stage. One instance is shared by the collector and publisher
+    dispatchers.
+    """
+    def __init__(self, registry=None, sample_rate=0.0,
+                 buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            registry(:class:`notifyme.metrics.MetricsRegistry`): registry
+                the histograms are registered with, a new one if omitted.
+            sample_rate(float): fraction of the notifications the push
+                clients didn't stamp to trace anyway
+            buckets(tuple): upper bounds of the histogram buckets in seconds
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate has to be between 0 and 1")
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.sample_rate = sample_rate
+        self.histogram = registry.histogram(
+            'notifyme_trace_stage_seconds',
+            "Latency of traced notifications per stage", buckets, ['stage'])
+        self._stages = {stage: self.histogram.labels(stage)
+                        for stage in STAGES}
+
+    def received(self, notification):
+        """
+        Start the trace of a notification the collector received, if it
+        has been stamped by the push client or is sampled now. Sets
+        `notification.trace` to `None` otherwise.
+        """
+        trace = notification.trace
+        if trace is None:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return
+            trace = notification.trace = Trace()
+        elif trace.pushed is not None:
+            self._stages['push'].observe(max(0.0, time() - trace.pushed))
+        trace.received = perf_counter()
+
+    def routing(self, trace):
+        """
+        The publisher started routing the notification of `trace`
+        """
+        trace.route_start = now = perf_counter()
+        if trace.received is not None:
+            self._stages['collect'].observe(now - trace.received)
+
+    def routed(self, trace):
+        """
+        The notification of `trace` has been queued for all subscribers
+        """
+        trace.route_end = now = perf_counter()
+        self._stages['route'].observe(now - trace.route_start)
+
+    def sent(self, trace, now):
+        """
+        The notification of `trace` has been written to a subscriber at
+        `now`, as returned by `time.perf_counter()`
+        """
+        self._stages['send'].observe(now - trace.route_end)
+        if trace.received is not None:
+            self._stages['total'].observe(now - trace.received)
@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from unittest import TestCase
+
+from notifyme.backlog import Backlog, RingBuffer
+from notifyme.notification import Notification
+
+
+class TestRingBuffer(TestCase):
+    def test_evict_by_count(self):
+        b = RingBuffer(3)
+        for i in range(1, 6):
+            b.append(i, float(i), str(i))
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b.since(), [(3, '3'), (4, '4'), (5, '5')])
+        self.assertEqual(b.since(sequence=4), [(5, '5')])
+        self.assertEqual(b.since(timestamp=4.0), [(4, '4'), (5, '5')])
+
+    def test_evict_by_age(self):
+        b = RingBuffer(10)
+        for i in range(1, 6):
+            b.append(i, float(i), str(i))
+        b.expire(3.5)
+        self.assertEqual(b.since(), [(4, '4'), (5, '5')])
+
+
+class TestBacklog(TestCase):
+    @staticmethod
+    def notification(resource, subject):
+        return Notification(resource=resource, urgency=50, subject=subject)
+
+    def test_replay(self):
+        b = Backlog(max_notifications=2)
+        for i, resource in enumerate(['/a', '/a/b', '/c', '/a', '/a']):
+            b.append(self.notification(resource, str(i)),
+                     timestamp=1000.0 + i)
+        replayed = [m.message for m in b.replay(['/a'])]
+        self.assertEqual([m.data['subject'] for m in replayed],
+                         ['1', '3', '4'])
+        self.assertEqual([m.sequence for m in replayed], [2, 4, 5])
+        self.assertEqual([m.message.data['subject']
+                          for m in b.replay(['/a'], since_sequence=3)],
+                         ['3', '4'])
+        self.assertEqual([m.message.data['subject']
+                          for m in b.replay(['/'], since_timestamp=1002.0)],
+                         ['2', '3', '4'])
+        self.assertEqual([m.sequence for m in b.replay(['/'], limit=2)],
+                         [2, 3])
+
+    def test_max_age(self):
+        b = Backlog(max_notifications=10, max_age=10)
+        b.append(self.notification('/a', 'old'), timestamp=0.0)
+        b.append(self.notification('/b', 'new'))
+        self.assertEqual([m.message.data['subject']
+                          for m in b.replay(['/'])], ['new'])
+        b.expire()
+        self.assertEqual(len(b), 1)
+
+    def test_extend(self):
+        b = Backlog(max_notifications=10)
+        b.append(self.notification('/a', '0'))
+        stored = b.extend([self.notification('/a', '1'),
+                           self.notification('/b', '2')])
+        self.assertEqual([m.sequence for m in stored], [2, 3])
+        self.assertEqual([m.sequence for m in b.replay(['/'])], [1, 2, 3])
@@ -0,0 +1,27 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from unittest import TestCase
+
+from notifyme.backoff import ExponentialBackoff
+
+
+class TestExponentialBackoff(TestCase):
+    def test_growth(self):
+        b = ExponentialBackoff(initial=1, maximum=10, jitter=0)
+        self.assertEqual([b.next_delay() for _ in range(6)],
+                         [1, 2, 4, 8, 10, 10])
+        self.assertEqual(b.stats, {'attempts': 6, 'last_delay': 10})
+        b.reset()
+        self.assertEqual(b.next_delay(), 1)
+
+    def test_jitter(self):
+        b = ExponentialBackoff(initial=8, maximum=8, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(4 <= b.next_delay() <= 8)
+
+    def test_no_overflow(self):
+        b = ExponentialBackoff(initial=1, maximum=60)
+        b.attempts = 10000
+        self.assertLessEqual(b.next_delay(), 60)
@@ -28,3 +28,33 @@ class TestCollectorProtocol(TestCase):
         r = c(ErrorMessage("this should get me an error"))
         self.assertIs(type(r), ErrorMessage)
         self.assertTrue(test_callback.called)
+
+    def test_session_accepts_many_notifications(self):
+        received = []
+        c = CollectorProtocol(notification_callback=received.append,
+                              allowed_resources=['/lel'])
+        for i in range(10):
+            n = Notification(subject=str(i), resource='/lel', urgency=88)
+            self.assertIsNone(c(NotificationMessage(n)))
+        self.assertEqual([n.subject for n in received],
+                         [str(i) for i in range(10)])
+
+    def test_batch(self):
+        from notifyme.messages import NotificationBatchMessage
+        batches = []
+        c = CollectorProtocol(notification_callback=lambda n: None,
+                              allowed_resources=['/lel'],
+                              batch_callback=batches.append)
+        b = NotificationBatchMessage([
+            Notification(subject='1', resource='/lel', urgency=88),
+            Notification(subject='2', resource='/nope', urgency=88),
+            Notification(subject='3', resource='/lel/foo', urgency=88)])
+        self.assertIsNone(c(b))
+        self.assertEqual([[n.subject for n in b] for b in batches],
+                         [['1', '3']])
+
+        received = []
+        c = CollectorProtocol(notification_callback=received.append,
+                              allowed_resources=['/lel'])
+        c(b)
+        self.assertEqual([n.subject for n in received], ['1', '3'])
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from unittest import TestCase
+
+from notifyme.filters import NotificationFilter
+from notifyme.notification import Notification
+
+
+class TestNotificationFilter(TestCase):
+    @staticmethod
+    def notification(urgency=50, subject='lel', data=None):
+        return Notification(resource='/a', urgency=urgency, subject=subject,
+                            data=data)
+
+    def test_urgency(self):
+        f = NotificationFilter.from_dict({'min_urgency': 80,
+                                          'max_urgency': 90})
+        self.assertFalse(f(self.notification(urgency=79)))
+        self.assertTrue(f(self.notification(urgency=80)))
+        self.assertFalse(f(self.notification(urgency=91)))
+        self.assertFalse(f(self.notification(urgency='high')))
+
+    def test_subject(self):
+        f = NotificationFilter(subject_prefix='[irc]')
+        self.assertTrue(f(self.notification(subject='[irc] ping')))
+        self.assertFalse(f(self.notification(subject='[mail] ping')))
+        f = NotificationFilter(subject_regex=r'\[(irc|mail)\]')
+        self.assertTrue(f(self.notification(subject='[mail] ping')))
+        self.assertFalse(f(self.notification(subject='ping [mail]')))
+        # only the beginning of long subjects is matched
+        f = NotificationFilter(subject_regex=r'.*\]$')
+        self.assertTrue(f(self.notification(subject='x' * 10 + ']')))
+        self.assertFalse(f(self.notification(subject='x' * 300 + ']')))
+
+    def test_data_keys(self):
+        f = NotificationFilter(data_keys=['url'])
+        self.assertTrue(f(self.notification(data={'url': 'x'})))
+        self.assertFalse(f(self.notification(data={})))
+        self.assertFalse(f(self.notification(data=None)))
+
+    def test_invalid(self):
+        self.assertIsNone(NotificationFilter.from_dict(None))
+        self.assertRaises(ValueError, NotificationFilter.from_dict,
+                          {'lel': 1})
+        self.assertRaises(ValueError, NotificationFilter.from_dict,
+                          {'subject_regex': '('})
+        for regex in ('(a+)+$', '(a|ab)*c', '(?:x(a*b?)*)+', r'\d+\d+\d+$',
+                      r'(\w+\s?){1,3}x', 'a' * 300, 1):
+            self.assertRaises(ValueError, NotificationFilter,
+                              subject_regex=regex)
+        # nesting is fine as long as one of the repetitions is bounded
+        NotificationFilter(subject_regex=r'(\w\s?){1,3}\[(irc|mail)\]')
+        NotificationFilter(subject_regex=r'.*\[(irc|mail)\].*$')
+        self.assertRaises(ValueError, NotificationFilter.from_dict,
+                          {'min_urgency': '80'})
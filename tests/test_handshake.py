@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from errno import EMFILE
+from socket import socketpair
+from time import monotonic
+from unittest import TestCase
+
+from OpenSSL import SSL
+
+from notifyme.handshake import handshake, HandshakePool, ACCEPT_BACKOFF
+
+
+class TestHandshake(TestCase):
+    def test_timeout(self):
+        server, client = socketpair()
+        conn = SSL.Connection(SSL.Context(SSL.TLS_METHOD), server)
+        conn.set_accept_state()
+        started = monotonic()
+        # the client never says anything
+        self.assertRaises(TimeoutError, handshake, conn, 0.1)
+        self.assertLess(monotonic() - started, 1)
+        self.assertIsNone(server.gettimeout())
+        client.close()
+        self.assertRaises(SSL.Error, handshake, conn, 0.1)
+        server.close()
+
+    def test_accept_backoff(self):
+        class Server:
+            calls = 0
+
+            def accept(self):
+                self.calls += 1
+                raise OSError(EMFILE, "Too many open files")
+
+        server = Server()
+        pool = HandshakePool(1, connected=None)
+        started = monotonic()
+        with self.assertLogs(level='WARNING'):
+            pool.accept_from(server, lambda: server.calls < 3)
+        self.assertGreaterEqual(monotonic() - started, 3 * ACCEPT_BACKOFF)
@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from notifyme.history import NotificationHistory, resource_prefixes
+from notifyme.notification import Notification
+
+
+class TestNotificationHistory(TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.history = NotificationHistory(join(self.path, 'history.db'),
+                                           flush_interval=0.01)
+
+    def tearDown(self):
+        self.history.close()
+        rmtree(self.path)
+
+    def test_resource_prefixes(self):
+        self.assertEqual(resource_prefixes('/irc/highlights'),
+                         ['', 'irc', 'irc/highlights'])
+
+    def test_query(self):
+        for i, resource in enumerate(['/irc/highlights', '/irc', '/mail',
+                                      '/irc/highlights/foo']):
+            self.history.add(Notification(resource=resource, urgency=50,
+                                          subject=str(i)),
+                             timestamp=1000.0 + i)
+        self.history.flush()
+
+        notifications, cursor = self.history.query('/irc/highlights')
+        self.assertEqual([n['subject'] for n in notifications], ['0', '3'])
+        self.assertIsNone(cursor)
+        notifications, _ = self.history.query('/', since=1001.0,
+                                              until=1002.0)
+        self.assertEqual([n['subject'] for n in notifications], ['1', '2'])
+        self.assertEqual(notifications[0]['timestamp'], 1001.0)
+
+    def test_paging(self):
+        for i in range(7):
+            self.history.add(Notification(resource='/a', urgency=50,
+                                          subject=str(i)),
+                             timestamp=1000.0)
+        self.history.flush()
+
+        pages, cursor = [], None
+        while True:
+            notifications, cursor = self.history.query('/a', limit=3,
+                                                       cursor=cursor)
+            pages.append([n['subject'] for n in notifications])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['0', '1', '2'], ['3', '4', '5'], ['6']])
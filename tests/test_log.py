@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from unittest import TestCase
+
+from notifyme.log import NotificationLog, SEGMENT_SUFFIX
+from notifyme.messages import WrappedProtocolMessage, FRAME_HEADER
+from notifyme.notification import Notification
+
+
+class TestNotificationLog(TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    @staticmethod
+    def notification(resource, subject):
+        return Notification(resource=resource, urgency=50, subject=subject)
+
+    def test_replay(self):
+        log = NotificationLog(self.path, segment_size=256)
+        for i, resource in enumerate(['/a', '/a/b', '/c', '/a', '/a']):
+            encoded = log.append(self.notification(resource, str(i)),
+                                 timestamp=1000.0 + i)
+            self.assertEqual(encoded.message.sequence, i + 1)
+        self.assertGreater(len(os.listdir(self.path)), 1)
+
+        replayed = log.replay(['/a'], since_sequence=1)
+        self.assertEqual([r.sequence for r in replayed], [2, 4, 5])
+        self.assertEqual([r.message.data['subject'] for r in replayed],
+                         ['1', '3', '4'])
+        self.assertEqual([r.sequence for r in
+                          log.replay(['/'], since_timestamp=1003.0)], [4, 5])
+        self.assertEqual([r.sequence for r in
+                          log.replay(['/a'], since_sequence=1, limit=2)],
+                         [2, 4])
+        # the frame can be sent as is
+        frame = bytes(replayed[0].frame)
+        self.assertEqual(FRAME_HEADER.unpack_from(frame)[0],
+                         len(frame) - FRAME_HEADER.size)
+        stored = log.extend([self.notification('/a', '5'),
+                             self.notification('/c', '6')])
+        self.assertEqual([e.sequence for e in stored], [6, 7])
+        self.assertEqual([r.sequence for r in log.replay(['/a'],
+                                                         since_sequence=4)],
+                         [5, 6])
+        log.close()
+
+    def test_reopen(self):
+        log = NotificationLog(self.path)
+        for i in range(3):
+            log.append(self.notification('/a', str(i)))
+        log.close()
+        # garbage from an interrupted write is ignored
+        segment = os.path.join(self.path, [
+            name for name in os.listdir(self.path)
+            if name.endswith(SEGMENT_SUFFIX)][0])
+        with open(segment, 'r+b') as f:
+            f.seek(log_size(self.path))
+            f.write(b'\x00\x00\x00\xff' + b'lel' * 10)
+
+        epoch = log.epoch
+        log = NotificationLog(self.path)
+        self.assertEqual(log.sequence, 3)
+        self.assertEqual(log.epoch, epoch)
+        self.assertEqual(len(log), 3)
+        encoded = log.append(self.notification('/a', '3'))
+        self.assertEqual(encoded.message.sequence, 4)
+        self.assertEqual([r.message.data['subject']
+                          for r in log.replay(['/a'], since_sequence=2)],
+                         ['2', '3'])
+        log.close()
+
+    def test_sync_when_idle(self):
+        log = NotificationLog(self.path, fsync_every=1000,
+                              fsync_interval=0.01)
+        log.append(self.notification('/a', '0'))
+        for _ in range(100):
+            if not log._unsynced:
+                break
+            sleep(0.01)
+        self.assertEqual(log._unsynced, 0)
+        log.close()
+
+    def test_sync_in_background(self):
+        log = NotificationLog(self.path, fsync_every=2, fsync_interval=60)
+        # synced by the background thread, long before the interval
+        log.append(self.notification('/a', '0'))
+        log.append(self.notification('/a', '1'))
+        for _ in range(100):
+            if not log._unsynced:
+                break
+            sleep(0.01)
+        self.assertEqual(log._unsynced, 0)
+        log.close()
+
+    def test_expire_when_idle(self):
+        log = NotificationLog(self.path, segment_size=256, max_age=0.2,
+                              fsync_interval=0.01)
+        for i in range(5):
+            log.append(self.notification('/a', str(i)))
+        self.assertGreater(len(log._segments), 1)
+        for _ in range(100):
+            if len(log._segments) == 1:
+                break
+            sleep(0.01)
+        self.assertEqual(len(log._segments), 1)
+        log.close()
+
+    def test_retention(self):
+        log = NotificationLog(self.path, segment_size=256, max_bytes=600)
+        for i in range(20):
+            log.append(self.notification('/a', str(i)))
+        self.assertLessEqual(log.size, 600 + 256)
+        replayed = log.replay(['/a'])
+        self.assertEqual(replayed[-1].sequence, 20)
+        self.assertGreater(replayed[0].sequence, 1)
+        log.close()
+
+        epoch = log.epoch
+        rmtree(self.path)
+        log = NotificationLog(self.path, segment_size=256, max_age=60)
+        # the numbering starts over
+        self.assertNotEqual(log.epoch, epoch)
+        for i in range(5):
+            log.append(self.notification('/a', 'old'), timestamp=0.0)
+        log.append(self.notification('/a', 'new'))
+        log.expire()
+        self.assertEqual([r.message.data['subject']
+                          for r in log.replay(['/a'])], ['new'])
+        log.close()
+
+
+def log_size(path):
+    log = NotificationLog(path)
+    size = log.size
+    log.close()
+    return size
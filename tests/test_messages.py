@@ -55,12 +55,26 @@ class TestMessageParsing(TestCase):
         w = WrappedProtocolMessage(message=p)
         p_new = WrappedProtocolMessage.parse(w.text)
         self.assertDictEqual(p.data, p_new.data)
+        self.assertIsNone(p_new.epoch)
+        p = PublishMessage(published_resources=['/test'], epoch='lel')
+        p_new = WrappedProtocolMessage.parse(
+            WrappedProtocolMessage(message=p).text)
+        self.assertEqual(p_new.epoch, 'lel')
+        self.assertRaises(ValueError, PublishMessage, ['/test'], epoch=1)
 
     def test_subscribe_message(self):
         s = SubscribeMessage(subscribed_resources=['/test'])
         w = WrappedProtocolMessage(message=s)
         s_new = WrappedProtocolMessage.parse(w.text)
         self.assertDictEqual(s.data, s_new.data)
+        self.assertFalse(s_new.wants_replay)
+
+    def test_subscribe_message_replay(self):
+        s = SubscribeMessage(subscribed_resources=['/test'],
+                             since_sequence=23)
+        s_new = WrappedProtocolMessage.parse(s.wrapped.text)
+        self.assertDictEqual(s.data, s_new.data)
+        self.assertTrue(s_new.wants_replay)
 
     def test_confirmation_message(self):
         c = ConfirmationMessage(confirmed_resources=['/test'])
@@ -81,3 +95,106 @@ class TestMessageParsing(TestCase):
         w = WrappedProtocolMessage(message=n)
         n_new = WrappedProtocolMessage.parse(w.text)
         self.assertDictEqual(n.data, n_new.data)
+        self.assertIsNone(n_new.sequence)
+
+    def test_sequenced_notification_message(self):
+        notification = Notification(resource='test', urgency=88, subject='lel')
+        n = NotificationMessage(notification, sequence=5, timestamp=1.5)
+        n_new = WrappedProtocolMessage.parse(n.wrapped.text)
+        self.assertEqual((n_new.sequence, n_new.timestamp), (5, 1.5))
+
+    def test_notification_batch_message(self):
+        notifications = [Notification(resource='/test', urgency=i,
+                                      subject='lel', data={})
+                         for i in range(3)]
+        b = NotificationBatchMessage(notifications)
+        b_new = WrappedProtocolMessage.parse(b.wrapped.text)
+        self.assertIsInstance(b_new, NotificationBatchMessage)
+        self.assertDictEqual(b.data, b_new.data)
+        self.assertEqual(len(b_new), 3)
+        self.assertEqual([n.urgency for n in b_new.notifications],
+                         [0, 1, 2])
+
+    def test_history_messages(self):
+        q = HistoryQueryMessage('/irc', since=1.0, limit=10, cursor=[2.0, 3])
+        q_new = WrappedProtocolMessage.parse(q.wrapped.text)
+        self.assertIsInstance(q_new, HistoryQueryMessage)
+        self.assertDictEqual(q.data, q_new.data)
+        r = HistoryResultMessage([{'subject': 'lel'}], cursor=None)
+        r_new = WrappedProtocolMessage.parse(r.wrapped.text)
+        self.assertIsInstance(r_new, HistoryResultMessage)
+        self.assertDictEqual(r.data, r_new.data)
+
+    def test_unsubscribe_message(self):
+        u = UnsubscribeMessage(unsubscribed_resources=['/lel'])
+        u_new = WrappedProtocolMessage.parse(u.wrapped.text)
+        self.assertIsInstance(u_new, UnsubscribeMessage)
+        self.assertDictEqual(u.data, u_new.data)
+
+
+class TestFrameDecoder(TestCase):
+    class FakeConnection:
+        def __init__(self, chunks):
+            self.chunks = list(chunks)
+
+        def recv_into(self, buffer, nbytes):
+            if not self.chunks:
+                return 0
+            chunk = self.chunks.pop(0)
+            buffer[:len(chunk)] = chunk
+            return len(chunk)
+
+    def test_split_frame(self):
+        frame = ErrorMessage(error_message="lel").wrapped.frame
+        d = FrameDecoder()
+        d.feed(frame[:3])
+        self.assertIsNone(d.next_frame())
+        d.feed(frame[3:10])
+        self.assertIsNone(d.next_frame())
+        d.feed(frame[10:])
+        self.assertEqual(d.next_frame(), frame[4:])
+        self.assertEqual(len(d), 0)
+
+    def test_several_frames_per_read(self):
+        frames = [ErrorMessage(error_message=str(i)).wrapped.frame
+                  for i in range(3)]
+        conn = self.FakeConnection([b''.join(frames)])
+        d = FrameDecoder()
+        for i in range(3):
+            m = d.receive_message(conn)
+            self.assertEqual(m.data['error_message'], str(i))
+        self.assertRaises(EOFError, d.receive_message, conn)
+
+    def test_large_frame(self):
+        n = Notification(resource='/test', urgency=88, subject='lel',
+                         data={'payload': 'x' * 100000})
+        frame = NotificationMessage(n).wrapped.frame
+        chunks = [frame[i:i + 1000] for i in range(0, len(frame), 1000)]
+        d = FrameDecoder(read_size=1000)
+        m = d.receive_message(self.FakeConnection(chunks))
+        self.assertEqual(m.data['data']['payload'], 'x' * 100000)
+
+    def test_max_frame_size(self):
+        d = FrameDecoder(max_frame_size=10)
+        d.feed(ErrorMessage(error_message="too long").wrapped.frame)
+        self.assertRaises(ValueError, d.next_frame)
+
+
+class TestEncodedMessage(TestCase):
+    def test_encoded_message(self):
+        n = NotificationMessage(Notification(resource='/test', urgency=88,
+                                             subject='lel', data={}))
+        e = n.encoded
+        self.assertIs(e.message, n)
+        self.assertEqual(e.frame, n.wrapped.frame)
+        d = FrameDecoder()
+        d.feed(e.frame)
+        self.assertDictEqual(
+            WrappedProtocolMessage.parse(d.next_frame()).data, n.data)
+
+    def test_immutable(self):
+        e = ErrorMessage(error_message="lel").encoded
+        with self.assertRaises(AttributeError):
+            e.frame = b''
+        with self.assertRaises(AttributeError):
+            e.foo = 1
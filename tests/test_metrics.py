@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+import subprocess
+import sys
+from unittest import TestCase
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from notifyme.metrics import MetricsRegistry, ServerMetrics, MetricsServer, \
+    resource_root, CONTENT_TYPE
+from notifyme.collector import CollectorProtocol
+from notifyme.messages import NotificationMessage, NotificationBatchMessage, \
+    SubscribeMessage
+from notifyme.notification import Notification
+
+
+class TestMetrics(TestCase):
+    def test_counter(self):
+        r = MetricsRegistry()
+        c = r.counter('requests_total', "Requests", ['path'])
+        c.labels('/a').inc()
+        c.labels('/a').inc(2)
+        c.labels('/b"\n').inc()
+        self.assertRaises(ValueError, c.labels('/a').inc, -1)
+        self.assertRaises(ValueError, c.labels, '/a', 'extra')
+        self.assertEqual(r.exposition(),
+                         '# HELP requests_total Requests\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{path="/a"} 3\n'
+                         'requests_total{path="/b\\"\\n"} 1\n')
+
+    def test_registration(self):
+        r = MetricsRegistry()
+        c = r.counter('x', "X")
+        self.assertIs(r.counter('x', "X"), c)
+        self.assertIs(r['x'], c)
+        self.assertRaises(ValueError, r.gauge, 'x', "X")
+
+    def test_gauge(self):
+        r = MetricsRegistry()
+        g = r.gauge('depth', "Depth")
+        g.inc(5)
+        g.dec()
+        self.assertIn('depth 4\n', r.exposition())
+        g.set(1.5)
+        self.assertIn('depth 1.5\n', r.exposition())
+        values = [7]
+        g.set_function(lambda: values[0])
+        values[0] = 8
+        self.assertIn('depth 8\n', r.exposition())
+
+    def test_histogram(self):
+        r = MetricsRegistry()
+        h = r.histogram('latency_seconds', "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            h.observe(value)
+        self.assertEqual(r.exposition(),
+                         '# HELP latency_seconds Latency\n'
+                         '# TYPE latency_seconds histogram\n'
+                         'latency_seconds_bucket{le="0.1"} 2\n'
+                         'latency_seconds_bucket{le="1"} 3\n'
+                         'latency_seconds_bucket{le="+Inf"} 4\n'
+                         'latency_seconds_sum 2.65\n'
+                         'latency_seconds_count 4\n')
+        self.assertRaises(ValueError, r.histogram, 'y', "Y",
+                          labelnames=['le'])
+
+    def test_resource_root(self):
+        self.assertEqual(resource_root('/foo/bar/baz'), '/foo')
+        self.assertEqual(resource_root('/foo'), '/foo')
+        self.assertEqual(resource_root('/'), '/')
+
+    def test_collector_counts(self):
+        metrics = ServerMetrics()
+        received = []
+        p = CollectorProtocol(['/foo', '/bar'], received.append)
+        p.metrics = metrics
+        p(NotificationMessage(Notification('/foo/a', 1, "a")))
+        p(NotificationMessage(Notification('/baz', 1, "denied")))
+        p(NotificationBatchMessage([Notification('/foo/b', 1, "b"),
+                                    Notification('/bar', 1, "c")]))
+        self.assertEqual(len(received), 3)
+        text = metrics.registry.exposition()
+        self.assertIn('notifyme_notifications_received_total{root="/foo"} 2',
+                      text)
+        self.assertIn('notifyme_notifications_received_total{root="/bar"} 1',
+                      text)
+        self.assertNotIn('root="/baz"', text)
+
+    def test_transition_hook(self):
+        metrics = ServerMetrics()
+        metrics.transition('receive_subscription', SubscribeMessage,
+                           'subscribed', 0.001)
+        self.assertIn('notifyme_protocol_transitions_total{'
+                      'source="receive_subscription",'
+                      'message="SubscribeMessage",target="subscribed"} 1',
+                      metrics.registry.exposition())
+
+    def test_server(self):
+        metrics = ServerMetrics()
+        metrics.notification_received('/foo')
+        server = MetricsServer(metrics.registry, port=0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.port
+            with urlopen(url + '/metrics') as response:
+                self.assertEqual(response.headers['Content-Type'],
+                                 CONTENT_TYPE)
+                body = response.read().decode('utf-8')
+            self.assertIn('notifyme_notifications_received_total'
+                          '{root="/foo"} 1', body)
+            with self.assertRaises(HTTPError):
+                urlopen(url + '/nope')
+        finally:
+            server.stop()
+
+    def test_clients_skip_http_server(self):
+        # messages depend on metrics through tracing, the clients
+        # shouldn't pay for importing http.server
+        subprocess.check_call([
+            sys.executable, '-c',
+            "import sys, notifyme.pushagent, notifyme.subscriber; "
+            "assert 'http.server' not in sys.modules"])
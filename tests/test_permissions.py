@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from hashlib import sha256
+from unittest import TestCase
+
+from OpenSSL import crypto
+
+from notifyme.permissions import PermissionStore, FingerprintCache
+
+
+def make_cert():
+    k = crypto.PKey()
+    k.generate_key(crypto.TYPE_RSA, 2048)
+    c = crypto.X509()
+    c.get_subject().CN = "test"
+    c.set_serial_number(1000)
+    c.gmtime_adj_notBefore(0)
+    c.gmtime_adj_notAfter(60)
+    c.set_issuer(c.get_subject())
+    c.set_pubkey(k)
+    c.sign(k, 'sha256')
+    return c
+
+
+class TestPermissionStore(TestCase):
+    def setUp(self):
+        self.cert = make_cert()
+        self.cert_hash = sha256(crypto.dump_certificate(1, self.cert)) \
+            .hexdigest()
+
+    def test_lookup(self):
+        store = PermissionStore([(self.cert_hash, ['/foo'])])
+        matcher = store.lookup(self.cert)
+        self.assertEqual(matcher.resources, ['/foo'])
+        self.assertTrue(matcher.matches('/foo/bar'))
+        self.assertIsNone(PermissionStore([]).lookup(self.cert))
+
+    def test_verify_callback(self):
+        class Connection:
+            app_data = None
+
+            def set_app_data(self, data):
+                self.app_data = data
+
+        store = PermissionStore([(self.cert_hash, ['/foo'])])
+        conn = Connection()
+        self.assertTrue(store(conn, self.cert, 0, 0, 1))
+        self.assertEqual(conn.app_data.resources, ['/foo'])
+        self.assertFalse(PermissionStore([])(Connection(), self.cert,
+                                             0, 0, 1))
+
+    def test_fingerprint_cache(self):
+        fingerprints = FingerprintCache(maxsize=1)
+        self.assertEqual(fingerprints(self.cert), self.cert_hash)
+        self.assertEqual(fingerprints(self.cert), self.cert_hash)
+        self.assertEqual(len(fingerprints), 1)
+        fingerprints(make_cert())
+        self.assertEqual(len(fingerprints), 1)
@@ -2,9 +2,35 @@
 # (c) Johannes Fürmann <johannes@weltraumpflege.org>
 # http://weltraumpflege.org/~johannes
 
+import os
 from unittest import TestCase
 from notifyme.messages import *
-from notifyme.publisher import PublisherProtocol
+from notifyme.notification import Notification
+from notifyme.publisher import PublisherProtocol, PublisherDispatcher, \
+    OutboundQueue, DROP_OLDEST, DROP_NEWEST, COALESCE_BY_RESOURCE, \
+    DISCONNECT, REPLAY_CHUNK_SIZE
+from notifyme.resources import SubscriptionIndex, ResourceMatcher
+from notifyme.backlog import Backlog
+from notifyme.statemachine import ProtocolStateMachine
+from tests.test_subscriber import make_pem
+
+class ReplayConnection:
+    def __init__(self, backlog=None):
+        self.sent = []
+        self.subscription_index = SubscriptionIndex()
+        self.backlog = Backlog() if backlog is None else backlog
+        self.published_resources = ['/test']
+        self.resource_matcher = ResourceMatcher(['/test'])
+        self.subscribed_resources = []
+        self.notification_filter = None
+        self.replayed_through = None
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+    def send_encoded(self, encoded, replayed=False):
+        self.sent.append(encoded.message)
+
 
 class TestPublisher(TestCase):
     def test_publisher_protocol(self):
@@ -19,3 +45,176 @@ class TestPublisher(TestCase):
         self.assertIsInstance(m, PublishMessage)
         n = p(SubscribeMessage(subscribed_resources=['/wrong/']))
         self.assertIsInstance(n, ErrorMessage)
+
+    def test_subscription_index(self):
+        i = SubscriptionIndex()
+        p = PublisherProtocol(published_resources=['/test/'],
+                              subscription_index=i)
+        p(None)
+        p(SubscribeMessage(subscribed_resources=['/test/foo']))
+        self.assertEqual(i.lookup('/test/foo/bar'), {p})
+        self.assertEqual(i.lookup('/test'), set())
+
+    def test_replay_before_live_delivery(self):
+        c = ReplayConnection()
+        for subject in ['1', '2', '3']:
+            c.backlog.append(Notification(resource='/test/a', urgency=50,
+                                          subject=subject))
+        p = ProtocolStateMachine(PublisherProtocol.TRANSITIONS, c)
+        p(None)
+        r = p(SubscribeMessage(subscribed_resources=['/test'],
+                               since_sequence=1))
+        self.assertIsNone(r)
+        self.assertIsInstance(c.sent[0], ConfirmationMessage)
+        self.assertEqual([m.data['subject'] for m in c.sent[1:]], ['2', '3'])
+        self.assertEqual(c.subscription_index.lookup('/test/a'), {c})
+
+    def test_replay_in_chunks(self):
+        c = ReplayConnection(Backlog(max_notifications=2000))
+        for i in range(REPLAY_CHUNK_SIZE * 2 + 10):
+            c.backlog.append(Notification(resource='/test/a', urgency=50,
+                                          subject=str(i)))
+        p = ProtocolStateMachine(PublisherProtocol.TRANSITIONS, c)
+        p(None)
+        p(SubscribeMessage(subscribed_resources=['/test'],
+                           since_sequence=5))
+        sequences = [m.sequence for m in c.sent[1:]]
+        self.assertEqual(sequences,
+                         list(range(6, REPLAY_CHUNK_SIZE * 2 + 11)))
+        self.assertEqual(c.subscription_index.lookup('/test/a'), {c})
+
+    def test_dispatcher_backlog(self):
+        pem = make_pem()
+        self.addCleanup(os.unlink, pem)
+        d = PublisherDispatcher('127.0.0.1', 0, pem, pem, [],
+                                backlog_size=10)
+        c = ReplayConnection(d.backlog)
+        c.subscription_index = d.subscriptions
+        # stored before the subscriber caught up, routed afterwards
+        early = d.backlog.append(Notification(resource='/test/a', urgency=50,
+                                              subject='early'))
+        p = ProtocolStateMachine(PublisherProtocol.TRANSITIONS, c)
+        p(None)
+        p(SubscribeMessage(subscribed_resources=['/test'], since_sequence=0))
+        d._fan_out(early.message.notification, early, None)
+        d.send_notifications([
+            Notification(resource='/test/a', urgency=50, subject='1'),
+            Notification(resource='/other', urgency=50, subject='2')])
+        d.send_notification(Notification(resource='/test/b', urgency=50,
+                                         subject='3'))
+        self.assertEqual([m.data['subject'] for m in c.sent[1:]],
+                         ['early', '1', '3'])
+        self.assertEqual([m.sequence for m in c.sent[1:]], [1, 2, 4])
+        self.assertEqual(len(d.backlog), 4)
+
+    def test_change_subscriptions(self):
+        i = SubscriptionIndex()
+        p = PublisherProtocol(published_resources=['/test'],
+                              subscription_index=i)
+        p(None)
+        p(SubscribeMessage(subscribed_resources=['/test/a']))
+        r = p(SubscribeMessage(subscribed_resources=['/test/b', '/test/a/']))
+        self.assertEqual(r.data['confirmed_resources'],
+                         ['/test/a', '/test/b'])
+        self.assertEqual(i.lookup('/test/b/c'), {p})
+        r = p(UnsubscribeMessage(unsubscribed_resources=['/test/a']))
+        self.assertEqual(r.data['confirmed_resources'], ['/test/b'])
+        self.assertEqual(i.lookup('/test/a'), set())
+        self.assertEqual(i.lookup('/test/b'), {p})
+        r = p(SubscribeMessage(subscribed_resources=['/other']))
+        self.assertIsInstance(r, ErrorMessage)
+        self.assertIsNone(p(ErrorMessage("lel")))
+
+    def test_filters(self):
+        p = PublisherProtocol(published_resources=['/test'])
+        p(None)
+        r = p(SubscribeMessage(subscribed_resources=['/test'],
+                               filters={'subject_regex': '('}))
+        self.assertIsInstance(r, ErrorMessage)
+        r = p(SubscribeMessage(subscribed_resources=['/test'],
+                               filters={'min_urgency': 80}))
+        self.assertIsInstance(r, ConfirmationMessage)
+        self.assertFalse(p.notification_filter(
+            Notification(resource='/test', urgency=50, subject='lel')))
+
+    def test_history_query(self):
+        class TestHistory:
+            def query(self, resource, since, until, limit, cursor):
+                return [{'resource': resource}], None
+
+        p = PublisherProtocol(published_resources=['/test'])
+        p(None)
+        r = p(HistoryQueryMessage('/test/foo'))
+        self.assertIsInstance(r, ErrorMessage)
+        p.history = TestHistory()
+        r = p(HistoryQueryMessage('/test/foo'))
+        self.assertIsInstance(r, HistoryResultMessage)
+        self.assertEqual(r.data['notifications'], [{'resource': '/test/foo'}])
+        r = p(HistoryQueryMessage('/other'))
+        self.assertIsInstance(r, ErrorMessage)
+
+        # answered once the query has run elsewhere
+        deferred = []
+        p.run_blocking = deferred.append
+        self.assertIsNone(p(HistoryQueryMessage('/test/foo')))
+        self.assertIsInstance(deferred[0](), HistoryResultMessage)
+
+
+class TestOutboundQueue(TestCase):
+    @staticmethod
+    def notification(resource, subject='lel'):
+        n = Notification(resource=resource, urgency=50, subject=subject)
+        return NotificationMessage(n).encoded
+
+    def test_drop_oldest(self):
+        q = OutboundQueue(maxsize=2, overflow_policy=DROP_OLDEST)
+        confirm = ConfirmationMessage(confirmed_resources=['/a']).encoded
+        q.put(confirm)
+        for subject in ['1', '2', '3']:
+            self.assertTrue(q.put(self.notification('/a', subject)))
+        items = q.get_all()
+        self.assertIs(items[0], confirm)
+        self.assertEqual([i.message.data['subject'] for i in items[1:]],
+                         ['2', '3'])
+        self.assertEqual(q.stats, {'depth': 0, 'dropped': 1,
+                                   'coalesced': 0})
+
+    def test_drop_newest(self):
+        q = OutboundQueue(maxsize=2, overflow_policy=DROP_NEWEST)
+        for subject in ['1', '2', '3']:
+            self.assertTrue(q.put(self.notification('/a', subject)))
+        self.assertEqual([i.message.data['subject'] for i in q.get_all()],
+                         ['1', '2'])
+        self.assertEqual(q.dropped, 1)
+
+    def test_coalesce_by_resource(self):
+        q = OutboundQueue(maxsize=2, overflow_policy=COALESCE_BY_RESOURCE)
+        q.put(self.notification('/a', '1'))
+        q.put(self.notification('/b', '2'))
+        q.put(self.notification('/a', '3'))
+        q.put(self.notification('/c', '4'))
+        self.assertEqual([i.message.data['subject'] for i in q.get_all()],
+                         ['2', '4'])
+        self.assertEqual(q.coalesced, 1)
+        self.assertEqual(q.dropped, 1)
+
+    def test_replayed_exempt(self):
+        q = OutboundQueue(maxsize=1, overflow_policy=DISCONNECT)
+        for subject in ['1', '2', '3']:
+            self.assertTrue(q.put(self.notification('/a', subject),
+                                  replayed=True))
+        self.assertTrue(q.put(self.notification('/a', '4')))
+        self.assertFalse(q.put(self.notification('/a', '5')))
+        self.assertEqual([i.message.data['subject'] for i in q.get_all()],
+                         ['1', '2', '3', '4'])
+
+    def test_disconnect(self):
+        q = OutboundQueue(maxsize=1, overflow_policy=DISCONNECT)
+        self.assertTrue(q.put(self.notification('/a')))
+        self.assertFalse(q.put(self.notification('/a')))
+        q.close()
+        self.assertFalse(q.put(self.notification('/a')))
+        self.assertEqual(q.get_all(), [])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, OutboundQueue, overflow_policy='lel')
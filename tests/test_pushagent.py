@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from os import stat
+from os.path import join
+from socket import socket, socketpair, AF_UNIX, SOCK_STREAM
+from tempfile import mkdtemp
+from threading import Thread, Event
+from time import sleep
+from unittest import TestCase
+
+from notifyme.notification import Notification
+from notifyme.messages import NotificationMessage, NotificationBatchMessage
+from notifyme.pushagent import PushAgent, send_to_agent
+
+
+class TestPushAgent(TestCase):
+    def test_forwarding(self):
+        class TestClient:
+            def __init__(self):
+                self.received = []
+                self.done = Event()
+
+            def send_message(self, message):
+                if type(message) is NotificationMessage:
+                    self.received.append(message.notification)
+                else:
+                    self.assertIs(type(message), NotificationBatchMessage)
+                    self.received.extend(message.notifications)
+                if len(self.received) == 5:
+                    self.done.set()
+
+        client = TestClient()
+        client.assertIs = self.assertIs
+        path = join(mkdtemp(), 'pushd.sock')
+        agent = PushAgent(client, socket_path=path)
+        Thread(target=agent.serve_forever, daemon=True).start()
+        for _ in range(100):
+            try:
+                send_to_agent([Notification(subject='0', resource='/lel',
+                                            urgency=10)], socket_path=path)
+                break
+            except OSError:
+                sleep(0.01)
+        send_to_agent([Notification(subject=str(i), resource='/lel',
+                                    urgency=10) for i in range(1, 5)],
+                      socket_path=path)
+        self.assertTrue(client.done.wait(5))
+        agent.shutdown()
+        self.assertEqual(sorted(n.subject for n in client.received),
+                         [str(i) for i in range(5)])
+
+    def test_socket(self):
+        path = join(mkdtemp(), 'pushd.sock')
+        # left behind by an agent that crashed
+        stale = socket(AF_UNIX, SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+
+        agent = PushAgent(None, socket_path=path)
+        Thread(target=agent.serve_forever, daemon=True).start()
+        for _ in range(100):
+            try:
+                with socket(AF_UNIX, SOCK_STREAM) as s:
+                    s.connect(path)
+                break
+            except OSError:
+                sleep(0.01)
+        self.assertEqual(stat(path).st_mode & 0o777, 0o600)
+        # a running agent isn't replaced
+        self.assertRaises(OSError, PushAgent(None, socket_path=path)
+                          .serve_forever)
+        agent.shutdown()
+
+    def test_invalid_message(self):
+        agent = PushAgent(None, socket_path=join(mkdtemp(), 'pushd.sock'))
+
+        def enqueue(message):
+            raise ValueError()
+
+        agent._enqueue = enqueue
+        conn, client = socketpair()
+        client.sendall(NotificationMessage(
+            Notification(subject='0', resource='/lel', urgency=10)
+        ).wrapped.frame)
+        client.close()
+        with self.assertLogs(level='WARNING'):
+            agent._handle(conn)
@@ -0,0 +1,104 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+import os
+from itertools import count
+from socket import socket, socketpair
+from threading import active_count
+from time import sleep, monotonic
+from unittest import TestCase
+
+from notifyme.pushclient import batched, SSLPushClient
+from notifyme.messages import FrameDecoder, ErrorMessage, encode_frame, \
+    FRAME_HEADER
+from tests.test_subscriber import make_pem
+
+
+class Connection(socket):
+    """
+    Plain socket that looks enough like an :class:`OpenSSL.SSL.Connection`
+    """
+    def pending(self):
+        return 0
+
+    def shutdown(self):
+        pass
+
+
+class TestBatching(TestCase):
+    def test_batch_size(self):
+        batches = list(batched(range(250), max_batch_size=100,
+                               max_delay=60))
+        self.assertEqual([len(b) for b in batches], [100, 100, 50])
+
+    def test_batch_delay(self):
+        batches = list(batched(range(3), max_batch_size=100, max_delay=0))
+        self.assertEqual(batches, [[0], [1], [2]])
+
+    def test_batch_delay_without_next_notification(self):
+        def slow():
+            yield 0
+            yield 1
+            sleep(1)
+            yield 2
+
+        started = monotonic()
+        batches = batched(slow(), max_batch_size=100, max_delay=0.05)
+        self.assertEqual(next(batches), [0, 1])
+        self.assertLess(monotonic() - started, 0.5)
+        self.assertEqual(list(batches), [[2]])
+
+    def test_error(self):
+        def broken():
+            yield 0
+            raise ValueError("lel")
+
+        batches = batched(broken(), max_delay=60)
+        self.assertEqual(next(batches), [0])
+        self.assertRaises(ValueError, next, batches)
+
+    def test_stop_early(self):
+        threads = active_count()
+        batches = batched(count(), max_batch_size=2, max_delay=60)
+        self.assertEqual(next(batches), [0, 1])
+        batches.close()
+        for _ in range(100):
+            if active_count() == threads:
+                break
+            sleep(0.01)
+        self.assertEqual(active_count(), threads)
+
+
+class TestSSLPushClient(TestCase):
+    def setUp(self):
+        self.pem = make_pem()
+
+    def tearDown(self):
+        os.unlink(self.pem)
+
+    def connected_client(self):
+        client = SSLPushClient('127.0.0.1', 0, self.pem, self.pem)
+        ours, collector = socketpair()
+        client._conn = Connection(fileno=ours.detach())
+        client._decoder = FrameDecoder()
+        self.addCleanup(client.close)
+        self.addCleanup(collector.close)
+        return client, collector
+
+    def test_connection_alive(self):
+        client, collector = self.connected_client()
+        self.assertTrue(client._connection_alive())
+        collector.sendall(ErrorMessage("lel").wrapped.frame)
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(client._connection_alive())
+        collector.close()
+        self.assertFalse(client._connection_alive())
+
+    def test_invalid_reply(self):
+        for data in (encode_frame(b'{"lel": 1}'), encode_frame(b'lel'),
+                     FRAME_HEADER.pack(2 ** 31)):
+            client, collector = self.connected_client()
+            collector.sendall(data)
+            with self.assertLogs(level='WARNING'):
+                self.assertFalse(client._connection_alive())
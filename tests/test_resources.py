@@ -24,5 +24,45 @@ class TestResourceHelpers(TestCase):
         self.assertFalse(is_subresource("/foo", "/bar"))
 
 
+class TestResourceMatcher(TestCase):
+    def test_matches(self):
+        from notifyme.resources import ResourceMatcher
+        m = ResourceMatcher(['/foo/bar', '/baz/'])
+        self.assertTrue(m.matches('/foo/bar'))
+        self.assertTrue(m.matches('/foo/bar/qux'))
+        self.assertTrue(m.matches('/baz/qux'))
+        self.assertFalse(m.matches('/foo'))
+        self.assertFalse(m.matches('/qux'))
+        self.assertTrue(ResourceMatcher(['/']).matches('/anything'))
+        self.assertFalse(ResourceMatcher([]).matches('/'))
+
+
+class TestSubscriptionIndex(TestCase):
+    def test_lookup(self):
+        from notifyme.resources import SubscriptionIndex
+        i = SubscriptionIndex()
+        i.subscribe('a', ['/foo'])
+        i.subscribe('b', ['/foo/bar', '/baz/'])
+        i.subscribe('c', ['/'])
+        self.assertEqual(i.lookup('/foo/bar/qux'), {'a', 'b', 'c'})
+        self.assertEqual(i.lookup('/foo'), {'a', 'c'})
+        self.assertEqual(i.lookup('/baz'), {'b', 'c'})
+        self.assertEqual(i.lookup('/nothing'), {'c'})
+
+    def test_unsubscribe(self):
+        from notifyme.resources import SubscriptionIndex
+        i = SubscriptionIndex()
+        i.subscribe('a', ['/foo/bar', '/baz'])
+        i.subscribe('b', ['/foo'])
+        i.unsubscribe('a', ['/foo/bar'])
+        self.assertEqual(i.lookup('/foo/bar'), {'b'})
+        self.assertEqual(i.subscriptions('a'), ['/baz'])
+        i.unsubscribe('a')
+        i.unsubscribe('b')
+        self.assertEqual(i.lookup('/foo/bar'), set())
+        self.assertEqual(len(i), 0)
+        self.assertEqual(i._root.children, {})
+
+
 if __name__ == '__main__':
     unittest.main()
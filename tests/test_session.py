@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from unittest import TestCase
+
+from notifyme.session import ProtocolSession, ProtocolError
+from notifyme.publisher import PublisherProtocol
+from notifyme.subscriber import SubscriberProtocol
+from notifyme.collector import CollectorProtocol
+from notifyme.messages import NotificationMessage, \
+    ErrorMessage, PublishMessage, WrappedProtocolMessage, FrameError, \
+    FrameDecoder
+from notifyme.notification import Notification
+
+
+class TestProtocolSession(TestCase):
+    def test_publisher_and_subscriber(self):
+        received = []
+        publisher = PublisherProtocol(published_resources=['/lel'])
+        subscriber = SubscriberProtocol(notification_callback=received.append,
+                                        subscribed_resources=['/lel'])
+        p = ProtocolSession(publisher)
+        s = ProtocolSession(subscriber, answer_errors=False)
+        p.start()
+        s.start()
+        self.assertEqual(s.data_to_send(), b'')
+        events = s.receive_data(p.data_to_send())
+        self.assertIsInstance(events[0], PublishMessage)
+        events = p.receive_data(s.data_to_send())
+        s.receive_data(p.data_to_send())
+        self.assertEqual(subscriber.state, 'subscribed')
+        self.assertEqual(publisher.state, 'subscribed')
+
+        # several frames in one chunk, split at arbitrary points
+        n = Notification(resource='/lel', urgency=50, subject='lel')
+        for i in range(3):
+            p.send_message(NotificationMessage(n))
+        data = p.data_to_send()
+        for i in range(0, len(data), 7):
+            s.receive_data(data[i:i + 7])
+        self.assertEqual(len(received), 3)
+
+    def test_errors(self):
+        c = ProtocolSession(CollectorProtocol(
+            notification_callback=lambda n: None, allowed_resources=['/lel']))
+        events = c.receive_data(WrappedProtocolMessage(
+            PublishMessage(published_resources=[])).frame + b'\0\0\0\2{]')
+        self.assertIsInstance(events[0], PublishMessage)
+        self.assertIsInstance(events[1], ProtocolError)
+        decoder = FrameDecoder()
+        decoder.feed(c.data_to_send())
+        replies = [WrappedProtocolMessage.parse(f) for f in decoder.frames()]
+        self.assertEqual([type(r) for r in replies],
+                         [ErrorMessage, ErrorMessage])
+
+        s = ProtocolSession(SubscriberProtocol(
+            notification_callback=lambda n: None,
+            subscribed_resources=['/lel']), answer_errors=False)
+        with self.assertRaises(Exception):
+            s.receive_data(b'\0\0\0\2{]')
+
+        with self.assertRaises(FrameError):
+            c.receive_data(b'\xff\xff\xff\xff')
+
+    def test_output(self):
+        sent = []
+        p = ProtocolSession(PublisherProtocol(published_resources=['/lel']),
+                            output=sent.append)
+        p.start()
+        self.assertIsInstance(sent[0].message, PublishMessage)
+        self.assertEqual(p.data_to_send(), b'')
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from unittest import TestCase
+
+from notifyme.statemachine import TransitionTable, ProtocolStateMachine, \
+    TransitionStats, Stay, SEND, ANY
+from notifyme.messages import PublishMessage, SubscribeMessage, \
+    ConfirmationMessage, ErrorMessage
+
+
+def greet(context, in_msg):
+    return PublishMessage(published_resources=['/lel'])
+
+
+def subscribe(context, in_msg):
+    if in_msg.data['subscribed_resources'] != ['/lel']:
+        return Stay(ErrorMessage("nope"))
+    context.append(in_msg)
+    return ConfirmationMessage(confirmed_resources=['/lel'])
+
+
+def unexpected(context, in_msg):
+    return ErrorMessage("unexpected")
+
+
+TABLE = TransitionTable('greet', [
+    ('greet', SEND, greet, 'wait'),
+    ('wait', SubscribeMessage, subscribe, 'subscribed'),
+    ('wait', ANY, unexpected, 'wait'),
+])
+
+
+class TestStateMachine(TestCase):
+    def test_dispatch(self):
+        context = []
+        m = ProtocolStateMachine(TABLE, context)
+        self.assertFalse(m.wait_for_input)
+        self.assertIsInstance(m(), PublishMessage)
+        self.assertTrue(m.wait_for_input)
+        self.assertIsInstance(m(PublishMessage(published_resources=[])),
+                              ErrorMessage)
+        self.assertIsInstance(m(SubscribeMessage(['/lol'])), ErrorMessage)
+        self.assertEqual(m.state, 'wait')
+        self.assertIsInstance(m(SubscribeMessage(['/lel'])),
+                              ConfirmationMessage)
+        self.assertEqual(m.state, 'subscribed')
+        self.assertEqual(len(context), 1)
+        # no transitions at all, everything is ignored
+        self.assertIsNone(m(SubscribeMessage(['/lel'])))
+
+    def test_states_are_shared(self):
+        a = ProtocolStateMachine(TABLE, [])
+        b = ProtocolStateMachine(TABLE, [])
+        a()
+        b()
+        self.assertIs(a._state, b._state)
+
+    def test_invalid_tables(self):
+        with self.assertRaises(ValueError):
+            TransitionTable('nowhere', [('greet', SEND, greet, 'wait')])
+        with self.assertRaises(ValueError):
+            TransitionTable('wait', [
+                ('wait', SubscribeMessage, subscribe, 'wait'),
+                ('wait', SubscribeMessage, unexpected, 'wait')])
+        with self.assertRaises(ValueError):
+            TransitionTable('greet', [
+                ('greet', SEND, greet, 'greet'),
+                ('greet', ANY, unexpected, 'greet')])
+
+    def test_hooks(self):
+        stats = TransitionStats()
+        calls = []
+        m = ProtocolStateMachine(TABLE, [], hooks=[stats])
+        m.add_hook(lambda *args: calls.append(args[:3]))
+        m()
+        m(SubscribeMessage(['/lol']))
+        m(SubscribeMessage(['/lel']))
+        self.assertEqual(calls, [
+            ('greet', type(None), 'wait'),
+            ('wait', SubscribeMessage, 'wait'),
+            ('wait', SubscribeMessage, 'subscribed')])
+        s = stats.stats
+        self.assertEqual(s[('greet', 'NoneType', 'wait')]['count'], 1)
+        self.assertEqual(s[('wait', 'SubscribeMessage', 'wait')]['count'], 1)
+        self.assertGreaterEqual(
+            s[('wait', 'SubscribeMessage', 'subscribed')]['seconds'], 0)
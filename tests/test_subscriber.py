@@ -2,12 +2,65 @@
 # (c) Johannes Fürmann <johannes@weltraumpflege.org>
 # http://weltraumpflege.org/~johannes
 
+import asyncio
+import os
+from hashlib import sha256
+from socket import socket, socketpair
+from tempfile import mkstemp
+from threading import Event, Thread
+from time import sleep
 from unittest import TestCase
 
-from notifyme.subscriber import SubscriberProtocol
+from OpenSSL import SSL, crypto
+
+from notifyme.backoff import ExponentialBackoff
+from notifyme.subscriber import SubscriberProtocol, CallbackExecutor, \
+    SimpleSubscriber, AsyncSubscriber, SubscriptionError, DROP_OLDEST, \
+    DROP_NEWEST
 from notifyme.messages import PublishMessage, SubscribeMessage,\
     ConfirmationMessage, NotificationMessage, ErrorMessage
 from notifyme.notification import Notification
+from notifyme.publisher import AsyncPublisherDispatcher
+from notifyme.session import ProtocolSession
+
+
+def make_pem():
+    """
+    Self-signed certificate and key in a temporary file
+    """
+    k = crypto.PKey()
+    k.generate_key(crypto.TYPE_RSA, 2048)
+    c = crypto.X509()
+    c.get_subject().CN = "test"
+    c.set_serial_number(1000)
+    c.gmtime_adj_notBefore(0)
+    c.gmtime_adj_notAfter(60)
+    c.set_issuer(c.get_subject())
+    c.set_pubkey(k)
+    c.sign(k, 'sha256')
+    fd, path = mkstemp(suffix='.pem')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, c))
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
+    return path
+
+
+def cert_hash(pem):
+    with open(pem, 'rb') as f:
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+    return sha256(crypto.dump_certificate(crypto.FILETYPE_PEM, cert)) \
+        .hexdigest()
+
+
+def tls_context(pem, verifier=None):
+    # any version the local OpenSSL still allows
+    context = SSL.Context(SSL.TLS_METHOD)
+    context.use_privatekey_file(pem)
+    context.use_certificate_file(pem)
+    if verifier is not None:
+        context.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_CLIENT_ONCE,
+                           verifier)
+    return context
 
 
 class TestSubscriberProtocol(TestCase):
@@ -34,3 +87,241 @@ class TestSubscriberProtocol(TestCase):
         out_msg = p(NotificationMessage(notification=n))
         self.assertIsNone(out_msg)
         self.assertIsNotNone(ctest.called)
+
+    def test_resume(self):
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel'],
+                               since_sequence=41)
+        out_msg = p(PublishMessage(published_resources=['/lel']))
+        self.assertEqual(out_msg.data['since_sequence'], 41)
+        p(ConfirmationMessage(confirmed_resources=['/lel']))
+        n = Notification(subject='lel', resource='/lel', urgency=88)
+        p(NotificationMessage(n, sequence=42))
+        self.assertEqual(p.context['last_sequence'], 42)
+
+    def test_resume_after_restart(self):
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel'],
+                               since_sequence=41, epoch='old',
+                               last_timestamp=1000.0)
+        out_msg = p(PublishMessage(published_resources=['/lel'],
+                                   epoch='old'))
+        self.assertEqual(out_msg.data['since_sequence'], 41)
+
+        # the publisher's numbering started over
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel'],
+                               since_sequence=41, epoch='old',
+                               last_timestamp=1000.0)
+        out_msg = p(PublishMessage(published_resources=['/lel'],
+                                   epoch='new'))
+        self.assertNotIn('since_sequence', out_msg.data)
+        self.assertEqual(out_msg.data['since_timestamp'], 1000.0)
+        self.assertEqual(p.context['epoch'], 'new')
+        self.assertEqual(p.context['last_sequence'], 0)
+        p(ConfirmationMessage(confirmed_resources=['/lel']))
+        n = Notification(subject='lel', resource='/lel', urgency=88)
+        p(NotificationMessage(n, sequence=3, timestamp=1001.0))
+        self.assertEqual(p.context['last_sequence'], 3)
+        self.assertEqual(p.context['last_timestamp'], 1001.0)
+
+        # without a timestamp, the whole backlog is replayed
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel'],
+                               since_sequence=41, epoch='old')
+        out_msg = p(PublishMessage(published_resources=['/lel'],
+                                   epoch='new'))
+        self.assertEqual(out_msg.data['since_sequence'], 0)
+
+    def test_subscription_changes(self):
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel'])
+        p(PublishMessage(published_resources=['/lel', '/lol']))
+        p(ConfirmationMessage(confirmed_resources=['/lel']))
+        out_msg = p(ConfirmationMessage(confirmed_resources=['/lel', '/lol']))
+        self.assertIsNone(out_msg)
+        self.assertEqual(p.context['subscribed_resources'], ['/lel', '/lol'])
+        self.assertEqual(p.context['confirmations'], 2)
+        out_msg = p(ErrorMessage(error_message="lel"))
+        self.assertIsNone(out_msg)
+        self.assertEqual(p.state, 'subscribed')
+        self.assertEqual(p.context['confirmations'], 2)
+
+    def test_subscription_rejected(self):
+        p = SubscriberProtocol(notification_callback=lambda n: None,
+                               subscribed_resources=['/lel', '/lol'])
+        p(PublishMessage(published_resources=['/lel']))
+        self.assertRaises(SubscriptionError, p,
+                          ErrorMessage(error_message="lel"))
+
+
+class TestCallbackExecutor(TestCase):
+    def test_ordering(self):
+        received = []
+        e = CallbackExecutor(received.append, workers=4)
+        for i in range(100):
+            e.submit({'resource': '/r%d' % (i % 3), 'subject': i})
+        e.close()
+        self.assertEqual(len(received), 100)
+        for r in range(3):
+            subjects = [n['subject'] for n in received
+                        if n['resource'] == '/r%d' % r]
+            self.assertEqual(subjects, sorted(subjects))
+
+    def blocked_executor(self, policy):
+        received = []
+        release = Event()
+
+        def callback(notification):
+            release.wait()
+            received.append(notification['subject'])
+
+        e = CallbackExecutor(callback, workers=1, maxsize=2,
+                             full_policy=policy)
+        e.submit({'resource': '/a', 'subject': 0})
+        while len(e):
+            sleep(0.01)
+        return e, release, received
+
+    def test_drop_oldest(self):
+        e, release, received = self.blocked_executor(DROP_OLDEST)
+        for i in range(1, 5):
+            self.assertTrue(e.submit({'resource': '/a', 'subject': i}))
+        release.set()
+        e.close()
+        self.assertEqual(received, [0, 3, 4])
+        self.assertEqual(e.stats, {'depth': 0, 'dropped': 2})
+
+    def test_drop_newest(self):
+        e, release, received = self.blocked_executor(DROP_NEWEST)
+        results = [e.submit({'resource': '/a', 'subject': i})
+                   for i in range(1, 5)]
+        release.set()
+        e.close()
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(received, [0, 1, 2])
+
+
+class TestSimpleSubscriber(TestCase):
+    def setUp(self):
+        self.pem = make_pem()
+
+    def tearDown(self):
+        os.unlink(self.pem)
+
+    def test_handshake_interrupted(self):
+        server = socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def hang_up():
+            conn, _ = server.accept()
+            conn.close()
+
+        Thread(target=hang_up, daemon=True).start()
+        s = SimpleSubscriber('127.0.0.1', server.getsockname()[1], self.pem,
+                             self.pem, ['/lel'], lambda n: None)
+        s._ssl_context = tls_context(self.pem)
+        self.assertRaises(SSL.Error, s._connect)
+        # retried instead of giving up
+        self.assertTrue(s.running)
+        s._sock.close()
+        server.close()
+
+    def test_unsubscribe_before_confirmation(self):
+        s = SimpleSubscriber('127.0.0.1', 0, self.pem, self.pem,
+                             ['/lel', '/lol'], lambda n: None)
+        s._sock, publisher = socketpair()
+        s._protocol_session = ProtocolSession(s._protocol,
+                                              answer_errors=False)
+        s.connected = True
+        publisher.sendall(
+            PublishMessage(published_resources=['/']).wrapped.frame +
+            ConfirmationMessage(
+                confirmed_resources=['/lel', '/lol']).wrapped.frame)
+        session = Thread(target=self.assertRaises,
+                         args=(EOFError, s._session))
+        session.start()
+        for _ in range(100):
+            if s._protocol.context['confirmations']:
+                break
+            sleep(0.01)
+        s.unsubscribe(['/lol'])
+        # not the confirmation of the unsubscription yet
+        publisher.sendall(NotificationMessage(
+            Notification(resource='/lol', urgency=1, subject='1')
+        ).wrapped.frame)
+        publisher.close()
+        session.join()
+        self.assertEqual(s.subscribed_resources, ['/lel'])
+        s._sock.close()
+
+
+class TestAsyncSubscriber(TestCase):
+    def test_close_ends_iteration(self):
+        async def consume():
+            subscriber = AsyncSubscriber('cert.pem', 'key.pem')
+            subscriber.start()
+            subscriber._queue.put_nowait({'subject': 'lel'})
+            asyncio.get_running_loop().call_soon(
+                asyncio.ensure_future, subscriber.close())
+            return [n async for n in subscriber]
+
+        self.assertEqual(asyncio.run(consume()), [{'subject': 'lel'}])
+
+    def test_publisher(self):
+        pem = make_pem()
+        self.addCleanup(os.unlink, pem)
+
+        async def until(condition):
+            for _ in range(500):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            self.fail("timed out")
+
+        async def hang_up(reader, writer):
+            writer.close()
+
+        async def run():
+            dispatcher = AsyncPublisherDispatcher(
+                '127.0.0.1', 0, pem, pem, [(cert_hash(pem), ['/lel'])],
+                backlog_size=100)
+            dispatcher._ssl_context = tls_context(pem, dispatcher._verifier)
+            serving = asyncio.ensure_future(dispatcher.serve())
+            await until(lambda: hasattr(dispatcher, '_server'))
+            port = dispatcher._server.sockets[0].getsockname()[1]
+            # breaks every handshake
+            broken = await asyncio.start_server(hang_up, '127.0.0.1', 0)
+
+            subscriber = AsyncSubscriber(pem, pem)
+            subscriber._ssl_context = lambda serverhash: tls_context(pem)
+            publisher = subscriber.add_publisher('127.0.0.1', port, ['/lel'])
+            unreliable = subscriber.add_publisher(
+                '127.0.0.1', broken.sockets[0].getsockname()[1], ['/lel'],
+                backoff=ExponentialBackoff(initial=0.01, maximum=0.01))
+            async with subscriber:
+                await until(lambda: dispatcher.subscriptions.lookup('/lel'))
+                dispatcher.send_notification(
+                    Notification(resource='/lel', urgency=50, subject='1'))
+                notification = await asyncio.wait_for(
+                    subscriber.__anext__(), 5)
+                self.assertEqual(notification['subject'], '1')
+
+                # reconnects and resumes after the connection broke
+                for connection in list(dispatcher.active_connections):
+                    connection.disconnect()
+                dispatcher.send_notification(
+                    Notification(resource='/lel', urgency=50, subject='2'))
+                notification = await asyncio.wait_for(
+                    subscriber.__anext__(), 5)
+                self.assertEqual(notification['subject'], '2')
+                self.assertEqual(publisher.connections, 2)
+
+                # failed handshakes are retried
+                await until(lambda: unreliable.backoff.attempts >= 3)
+                self.assertEqual(unreliable.connections, 0)
+            broken.close()
+            serving.cancel()
+
+        asyncio.run(run())
@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+# (c) Johannes Fürmann <johannes@weltraumpflege.org>
+# http://weltraumpflege.org/~johannes
+
+from time import time, perf_counter
+from unittest import TestCase
+
+from notifyme.tracing import Trace, Tracer, TracedMessage, stamp
+from notifyme.collector import CollectorProtocol
+from notifyme.messages import NotificationMessage, WrappedProtocolMessage, \
+    NotificationBatchMessage, FRAME_HEADER
+from notifyme.notification import Notification
+from notifyme.backlog import Backlog
+
+
+class TestTracing(TestCase):
+    def test_wire_format(self):
+        n = Notification('/foo', 1, "traced")
+        self.assertNotIn('trace',
+                         NotificationMessage(n, with_trace=True).data)
+        stamp([n])
+        frame = NotificationMessage(n, with_trace=True).encoded.frame
+        message = WrappedProtocolMessage.parse(frame[FRAME_HEADER.size:])
+        self.assertEqual(message.notification.trace.pushed, n.trace.pushed)
+        # only the push time goes over the wire
+        n.trace.received = perf_counter()
+        self.assertEqual(NotificationMessage(n, with_trace=True).data['trace'],
+                         {'pushed': n.trace.pushed})
+        # and only from push clients to the collector
+        self.assertNotIn('trace', NotificationMessage(n).data)
+        batch = NotificationBatchMessage([n])
+        self.assertEqual(batch.notifications[0].trace.pushed, n.trace.pushed)
+        self.assertNotIn('trace', Backlog().append(n).message.data)
+        n.trace = Trace()
+        self.assertNotIn('trace',
+                         NotificationMessage(n, with_trace=True).data)
+        self.assertIsNone(Trace.from_dict({'pushed': 'yesterday'}))
+        self.assertIsNone(Trace.from_dict([]))
+
+    def test_stamp_sampling(self):
+        notifications = [Notification('/foo', 1, str(i)) for i in range(100)]
+        stamp(notifications, sample_rate=0)
+        self.assertTrue(all(n.trace is None for n in notifications))
+        stamp(notifications, sample_rate=0.5)
+        traced = sum(n.trace is not None for n in notifications)
+        self.assertTrue(0 < traced < 100)
+
+    def test_stages(self):
+        tracer = Tracer()
+        self.assertRaises(ValueError, Tracer, sample_rate=2)
+        n = Notification('/foo', 1, "traced", trace=Trace(pushed=time()))
+        untraced = Notification('/foo', 1, "untraced")
+        tracer.received(n)
+        tracer.received(untraced)
+        self.assertIsNone(untraced.trace)
+        tracer.routing(n.trace)
+        tracer.routed(n.trace)
+        message = TracedMessage(NotificationMessage(n).encoded, n.trace)
+        self.assertEqual(message.resource, '/foo')
+        tracer.sent(message.trace, perf_counter())
+        tracer.sent(message.trace, perf_counter())
+        text = tracer.registry.exposition()
+        for stage, count in (('push', 1), ('collect', 1), ('route', 1),
+                             ('send', 2), ('total', 2)):
+            self.assertIn('notifyme_trace_stage_seconds_count{stage="%s"} %d'
+                          % (stage, count), text)
+
+    def test_sampled_by_collector(self):
+        received = []
+        p = CollectorProtocol(['/foo'], received.append)
+        p.tracer = Tracer(sample_rate=1)
+        p(NotificationMessage(Notification('/foo', 1, "a")))
+        p(NotificationBatchMessage([Notification('/foo', 1, "b")]))
+        for n in received:
+            self.assertIsNotNone(n.trace.received)
+            self.assertIsNone(n.trace.pushed)